@@ -0,0 +1,190 @@
+import argparse
+import asyncio
+import json
+import os
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+
+from e2e import API_TOKEN, BOT_PATH, FIRST_USER_ID, WIZARDS, percentile, simulate_user, start_fake_ssh, stop_fake_ssh
+from fake_telegram import FakeTelegramAPI
+
+# every instance reads the same file; only the webhook port and log file differ, so the processes behave like replicas
+CONFIG = """import os
+API_TOKEN = {token!r}
+ADMIN_ID = 1
+ALLOWED_USER_IDS = [1] + list(range({first}, {last}))
+TELEGRAM_API_SERVER = {telegram!r}
+SSH_PORT = {ssh_port}
+METRICS_PORT = 0
+JOB_WORKERS = {workers}
+DB_PATH = {db!r}
+LOG_FILE = os.environ["EVARA_LOG_FILE"]
+FSM_STORAGE = "sqlite"
+WEBHOOK_URL = os.environ["EVARA_WEBHOOK_URL"]
+WEBHOOK_PORT = int(os.environ["EVARA_WEBHOOK_PORT"])
+HEARTBEAT_INTERVAL = 1
+TRAFFIC_INTERVAL = 0
+FAILOVER_INTERVAL = 0
+"""
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_instances(workdir, count):
+    instances = []
+    for index in range(count):
+        port = free_port()
+        env = dict(os.environ, PYTHONPATH=workdir, EVARA_WEBHOOK_PORT=str(port), EVARA_WEBHOOK_URL=f"http://127.0.0.1:{port}",
+                   EVARA_LOG_FILE=os.path.join(workdir, f"bot-{index}.log"))
+        instances.append(subprocess.Popen([sys.executable, BOT_PATH], cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+    return instances
+
+
+def stop_instances(instances):
+    for process in instances:
+        process.terminate()
+    for process in instances:
+        try:
+            process.wait(10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+async def wait_for_webhooks(api, count, timeout):
+    deadline = time.monotonic() + timeout
+    while len(api.webhooks) < count:
+        if time.monotonic() > deadline:
+            raise SystemExit(f"only {len(api.webhooks)} of {count} instances registered a webhook")
+        await asyncio.sleep(0.2)
+
+
+async def wait_for_jobs(db_path, timeout):
+    # users see the last message of a job just before it is marked finished
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        conn = sqlite3.connect(db_path, timeout=30)
+        active = conn.execute("SELECT COUNT(*) FROM jobs WHERE status IN ('queued', 'running')").fetchone()[0]
+        conn.close()
+        if not active:
+            return
+        await asyncio.sleep(0.2)
+
+
+def host_overlaps(db_path):
+    # every remote command batch of a job is an "ssh <host>" span; two jobs inside one host at once means a lock leaked
+    conn = sqlite3.connect(db_path)
+    rows = conn.execute("SELECT job_id, name, started_at, started_at + duration FROM spans WHERE name LIKE 'ssh %' AND duration IS NOT NULL").fetchall()
+    conn.close()
+    batches = defaultdict(list)
+    for job_id, name, started, finished in rows:
+        batches[name[4:]].append((started, finished, job_id))
+    overlaps = []
+    for host, spans in batches.items():
+        spans.sort()
+        for index, (started, finished, job_id) in enumerate(spans):
+            for other_started, _, other_job in spans[index + 1:]:
+                if other_started >= finished:
+                    break
+                if other_job != job_id:
+                    overlaps.append({"host": host, "jobs": [job_id, other_job], "seconds": round(finished - other_started, 3)})
+    return overlaps
+
+
+def job_distribution(db_path):
+    conn = sqlite3.connect(db_path)
+    rows = conn.execute("SELECT instance_id, kind, status FROM jobs").fetchall()
+    conn.close()
+    distribution = defaultdict(Counter)
+    for instance_id, kind, status in rows:
+        distribution[instance_id or "none"][f"{kind}:{status}"] += 1
+    return {instance_id: dict(counts) for instance_id, counts in distribution.items()}
+
+
+async def run(args):
+    ssh, ssh_port = start_fake_ssh(args)
+    api = FakeTelegramAPI(API_TOKEN).start()
+    workdir = tempfile.mkdtemp(prefix="evara-cluster-")
+    db_path = os.path.join(workdir, "tunnels.db")
+    with open(os.path.join(workdir, "config.py"), "w") as f:
+        f.write(CONFIG.format(token=API_TOKEN, first=FIRST_USER_ID, last=FIRST_USER_ID + args.users, telegram=api.url,
+                              ssh_port=ssh_port, workers=args.workers, db=db_path))
+    instances = start_instances(workdir, args.instances)
+    try:
+        await wait_for_webhooks(api, args.instances, args.start_timeout)
+        started = time.monotonic()
+        results = await asyncio.gather(*[
+            api.run(simulate_user(api, FIRST_USER_ID + index, index / args.ramp if args.ramp else 0, args))
+            for index in range(args.users)
+        ])
+        wall = time.monotonic() - started
+        await wait_for_jobs(db_path, args.step_timeout)
+    finally:
+        stop_instances(instances)
+        api.stop()
+        ssh_stats = stop_fake_ssh(ssh)
+
+    jobs = defaultdict(list)
+    for result in results:
+        for name, values in result["jobs"].items():
+            jobs[name].extend(values)
+    overlaps = host_overlaps(db_path)
+    return {
+        "instances": args.instances,
+        "users": args.users,
+        "mode": args.mode,
+        "servers": args.servers or args.users,
+        "tunnels_created": len([result for result in results if result["created_at"]]),
+        "failed_users": len([result for result in results if result["error"]]),
+        "wall_seconds": round(wall, 2),
+        "job_seconds": {name: {"p50": round(percentile(values, 0.5), 2), "p95": round(percentile(values, 0.95), 2)} for name, values in jobs.items()},
+        "jobs_per_instance": job_distribution(db_path),
+        "host_overlaps": overlaps[:10],
+        "host_overlap_count": len(overlaps),
+        "webhook_delivery_errors": api.delivery_errors,
+        "telegram_requests": dict(api.requests.most_common()),
+        "ssh_connections": ssh_stats.get("connections"),
+        "errors": [result["error"] for result in results if result["error"]][:10],
+        "workdir": workdir
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Cluster benchmark: several bot processes share one database and receive webhook updates round-robin")
+    parser.add_argument("--instances", type=int, default=3)
+    parser.add_argument("--users", type=int, default=12)
+    parser.add_argument("--servers", type=int, default=2, help="server pairs shared by the users; a server holds one tunnel, so users on a pair take turns and their jobs meet on the same hosts one after another; 0 gives every user its own pair")
+    parser.add_argument("--ramp", type=int, default=0, help="start this many users per second instead of all at once")
+    parser.add_argument("--workers", type=int, default=4, help="JOB_WORKERS for each instance")
+    parser.add_argument("--mode", choices=sorted(WIZARDS), default="gre")
+    parser.add_argument("--ssh-host", default="127.0.0.1")
+    parser.add_argument("--ssh-port", type=int, default=0)
+    parser.add_argument("--ssh-latency", type=float, default=0.05)
+    parser.add_argument("--install-latency", type=float, default=0.5)
+    parser.add_argument("--think", type=float, default=0.0)
+    parser.add_argument("--step-timeout", type=float, default=30.0)
+    parser.add_argument("--job-timeout", type=float, default=600.0)
+    parser.add_argument("--start-timeout", type=float, default=30.0)
+    parser.add_argument("--no-status", dest="status", action="store_false")
+    parser.add_argument("--no-delete", dest="delete", action="store_false")
+    parser.add_argument("--reuse-servers", action="store_true", help="after the first tunnel, build a second one from the saved servers")
+    parser.add_argument("--json", help="also write the report to this file")
+    parser.set_defaults(dpkg_fail=False)
+    args = parser.parse_args()
+    report = asyncio.run(run(args))
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    sys.exit(1 if report["failed_users"] or report["host_overlap_count"] else 0)
@@ -0,0 +1,305 @@
+import argparse
+import asyncio
+import importlib.util
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+
+from fake_telegram import FakeTelegramAPI
+
+BOT_PATH = os.path.join(os.path.dirname(BENCH_DIR), "tunnel-m.py")
+API_TOKEN = "123456:BENCH"
+FIRST_USER_ID = 100001
+STALL_INTERVAL = 0.005
+STALL_THRESHOLD = 0.01
+
+WIZARD = [
+    ("text", "/start", "به ربات تانل اوارا"),
+    ("text", "🚀 ساخت تونل جدید", "✨ لطفاً یک نام"),
+    ("text", "bench-{user_id}", "🔗 لطفاً نوع تونل"),
+    ("text", "🔗 تونل 1 ایران به 1 خارج", "🌍 لطفاً IP سرور ایران را برای اتصال"),
+    ("text", "{iran_host}", "👤 لطفاً نام کاربری سرور ایران"),
+    ("text", "root", "🔒 لطفاً رمز عبور سرور ایران"),
+    ("text", "bench", "🌎 لطفاً IP سرور خارج را برای اتصال"),
+    ("text", "{kharej_host}", "👤 لطفاً نام کاربری سرور خارج"),
+    ("text", "root", "🔒 لطفاً رمز عبور سرور خارج"),
+    ("text", "bench", "🌍 لطفاً IP سرور ایران را وارد"),
+    ("text", "10.10.0.1", "🌎 لطفاً IP سرور خارج را وارد"),
+    ("text", "10.10.0.2", "🔑 لطفاً یک رمز سخت"),
+    ("text", "bench-psk-{user_id}", "📏 لطفاً MTU برای تونل 6to4"),
+    ("button", "mtu_6to4_default", "📏 لطفاً MTU برای تونل GRE"),
+    ("button", "mtu_gre_default", "🚦 لطفاً صف ترافیک"),
+    ("text", "⏭ بدون QoS", "⏰ لطفاً ساعت"),
+    ("text", "3", "📥 درخواست"),
+    ("job", "provision", "🎉 نصب تونل"),
+]
+
+WIREGUARD_WIZARD = WIZARD[:3] + [
+    ("text", "🛡 تونل WireGuard ایران به خارج", "🌍 لطفاً IP سرور ایران را برای اتصال"),
+] + WIZARD[4:11] + [
+    ("text", "10.10.0.2", "📏 لطفاً MTU برای تونل WireGuard"),
+    ("button", "mtu_gre_default", "🚦 لطفاً صف ترافیک"),
+] + WIZARD[15:]
+
+WIZARDS = {"gre": WIZARD, "wireguard": WIREGUARD_WIZARD}
+
+# the same wizard again, picking the servers saved by the first run instead of typing host, user and password
+SAVED_SERVERS = [
+    ("text", "🖥 {iran_host} (root)", "🌎 لطفاً IP سرور خارج را برای اتصال"),
+    ("text", "🖥 {kharej_host} (root)", "🌍 لطفاً IP سرور ایران را وارد"),
+]
+REUSE_WIZARDS = {mode: steps[:4] + SAVED_SERVERS + steps[10:] for mode, steps in WIZARDS.items()}
+
+STATUS = [
+    ("text", "📊 بررسی وضعیت تونل‌ها", "🔍 لطفاً تونل"),
+    ("button", "status:", "📊 *وضعیت"),
+]
+
+DELETE = [
+    ("text", "🗑 حذف تونل", "🗑 لطفاً تونل"),
+    ("button", "delete:", "📥 درخواست"),
+    ("job", "teardown", "✅ تونل"),
+]
+
+
+def load_bot(workdir, telegram_url, ssh_port, users, workers):
+    with open(os.path.join(workdir, "config.py"), "w") as f:
+        f.write(f"API_TOKEN = {API_TOKEN!r}\n")
+        f.write("ADMIN_ID = 1\n")
+        f.write(f"ALLOWED_USER_IDS = [1] + list(range({FIRST_USER_ID}, {FIRST_USER_ID + users}))\n")
+        f.write(f"TELEGRAM_API_SERVER = {telegram_url!r}\n")
+        f.write(f"SSH_PORT = {ssh_port}\n")
+        f.write("METRICS_PORT = 0\n")
+        f.write(f"JOB_WORKERS = {workers}\n")
+        f.write(f"DB_PATH = {os.path.join(workdir, 'tunnels.db')!r}\n")
+        f.write(f"LOG_FILE = {os.path.join(workdir, 'bot.log')!r}\n")
+        f.write(f"PACKAGE_CACHE_DIR = {os.path.join(workdir, 'packages')!r}\n")
+    sys.path.insert(0, workdir)
+    spec = importlib.util.spec_from_file_location("tunnel_m", BOT_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def seed_package_cache(workdir):
+    # what fake_ssh reports as its OS; the unparseable name must be skipped rather than break the install
+    bundle = os.path.join(workdir, "packages", "ubuntu-jammy-amd64")
+    os.makedirs(bundle)
+    for name in ("strongswan_5.9.5-2ubuntu2_all.deb", "strongswan-starter_5.9.5-2ubuntu2_amd64.deb", "strongswan.deb"):
+        with open(os.path.join(bundle, name), "wb") as f:
+            f.write(os.urandom(4096))
+
+
+def start_fake_ssh(args):
+    # a separate process, so the fake server's crypto threads do not hold the bot's GIL
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(BENCH_DIR, "fake_ssh.py"), "--host", args.ssh_host, "--port", str(args.ssh_port),
+         "--latency", str(args.ssh_latency), "--install-latency", str(args.install_latency)] + ([] if args.servers == 1 else ["--any-loopback"]) + (["--dpkg-fail"] if args.dpkg_fail else []),
+        stdout=subprocess.PIPE, text=True
+    )
+    port = int(process.stdout.readline().rsplit(":", 1)[1])
+    return process, port
+
+
+def stop_fake_ssh(process):
+    process.send_signal(signal.SIGINT)
+    stats = json.loads(process.stdout.readline() or "{}")
+    process.wait()
+    return stats
+
+
+def server_hosts(user_id, args):
+    # jobs on one server are serialised, so by default every user gets its own pair of loopback addresses
+    index = user_id - FIRST_USER_ID
+    if args.servers:
+        index %= args.servers
+        if args.servers == 1:
+            return args.ssh_host, args.ssh_host
+    return f"127.1.{index // 250}.{index % 250 + 1}", f"127.2.{index // 250}.{index % 250 + 1}"
+
+
+def find_button(message, prefix):
+    for row in message.get("reply_markup", {}).get("inline_keyboard", []):
+        for button in row:
+            if button.get("callback_data", "").startswith(prefix):
+                return button["callback_data"]
+    raise RuntimeError(f"no {prefix!r} button in message: {message['text'][:200]}")
+
+
+async def run_steps(api, user_id, steps, values, args, result):
+    last = None
+    for kind, value, needle in steps:
+        if kind == "text":
+            sent = api.send_text(user_id, value.format(**values))
+        elif kind == "button":
+            sent = api.press_button(user_id, last, find_button(last, value))
+        last = await api.expect(user_id, needle, args.job_timeout if kind == "job" else args.step_timeout)
+        elapsed = last["received_at"] - sent
+        if kind == "job":
+            result["jobs"].setdefault(value, []).append(elapsed)
+        else:
+            result["replies"].append(elapsed)
+        if args.think:
+            await asyncio.sleep(args.think)
+
+
+SERVER_PAIRS = {}
+
+
+async def simulate_user(api, user_id, delay, args):
+    await asyncio.sleep(delay)
+    iran_host, kharej_host = server_hosts(user_id, args)
+    # the bot allows one tunnel per server, so users sharing a pair take turns like real operators would
+    async with SERVER_PAIRS.setdefault((iran_host, kharej_host), asyncio.Lock()):
+        return await run_user(api, user_id, iran_host, kharej_host, args)
+
+
+async def run_user(api, user_id, iran_host, kharej_host, args):
+    result = {"user_id": user_id, "replies": [], "jobs": {}, "error": None, "created_at": None}
+    values = {"user_id": user_id, "iran_host": iran_host, "kharej_host": kharej_host}
+    try:
+        await run_steps(api, user_id, WIZARDS[args.mode], values, args, result)
+        result["created_at"] = time.monotonic()
+        if args.status:
+            await run_steps(api, user_id, STATUS, values, args, result)
+        if args.delete:
+            await run_steps(api, user_id, DELETE, values, args, result)
+        if args.reuse_servers:
+            await run_steps(api, user_id, REUSE_WIZARDS[args.mode], values, args, result)
+            if args.delete:
+                await run_steps(api, user_id, DELETE, values, args, result)
+    except (asyncio.TimeoutError, RuntimeError) as e:
+        result["error"] = str(e) or type(e).__name__
+    return result
+
+
+async def watch_event_loop(stalls):
+    while True:
+        before = time.monotonic()
+        await asyncio.sleep(STALL_INTERVAL)
+        lag = time.monotonic() - before - STALL_INTERVAL
+        if lag > STALL_THRESHOLD:
+            stalls["count"] += 1
+            stalls["total"] += lag
+            stalls["max"] = max(stalls["max"], lag)
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q * (len(values) - 1))))]
+
+
+def histogram_quantile(metric, q):
+    buckets = [0] * len(metric["buckets"])
+    count = 0
+    for series in metric["series"].values():
+        buckets = [a + b for a, b in zip(buckets, series["buckets"])]
+        count += series["count"]
+    if not count:
+        return None
+    rank = q * count
+    lower, below = 0.0, 0
+    for bound, cumulative in zip(metric["buckets"], buckets):
+        if cumulative >= rank:
+            inside = cumulative - below
+            return lower + (bound - lower) * ((rank - below) / inside if inside else 1)
+        lower, below = bound, cumulative
+    return metric["buckets"][-1]
+
+
+def milliseconds(value):
+    return None if value is None else round(value * 1000, 1)
+
+
+async def run(args):
+    ssh, ssh_port = start_fake_ssh(args)
+    api = FakeTelegramAPI(API_TOKEN).start()
+    workdir = tempfile.mkdtemp(prefix="evara-bench-")
+    if args.bundle:
+        seed_package_cache(workdir)
+    tm = load_bot(workdir, api.url, ssh_port, args.users, args.workers)
+    tm.start_job_workers()
+    stalls = {"count": 0, "total": 0.0, "max": 0.0}
+    watcher = asyncio.ensure_future(watch_event_loop(stalls))
+    polling = asyncio.ensure_future(tm.dp.start_polling(timeout=1))
+
+    started = time.monotonic()
+    results = await asyncio.gather(*[
+        api.run(simulate_user(api, FIRST_USER_ID + index, index / args.ramp if args.ramp else 0, args))
+        for index in range(args.users)
+    ])
+    wall = time.monotonic() - started
+
+    tm.dp.stop_polling()
+    polling.cancel()
+    watcher.cancel()
+    await (await tm.bot.get_session()).close()
+    api.stop()
+    ssh_stats = stop_fake_ssh(ssh)
+    tm.log_listener.stop()
+
+    created = [result for result in results if result["created_at"]]
+    replies = [value for result in results for value in result["replies"]]
+    jobs = {}
+    for result in results:
+        for name, values in result["jobs"].items():
+            jobs.setdefault(name, []).extend(values)
+    last_created = max((result["created_at"] for result in created), default=started)
+    report = {
+        "users": args.users,
+        "mode": args.mode,
+        "tunnels_created": len(created),
+        "failed_users": len([result for result in results if result["error"]]),
+        "wall_seconds": round(wall, 2),
+        "tunnels_per_minute": round(len(created) / (last_created - started) * 60, 2) if created else 0,
+        "reply_latency_ms": {"p50": milliseconds(percentile(replies, 0.5)), "p95": milliseconds(percentile(replies, 0.95))},
+        "handler_latency_ms": {
+            "p50": milliseconds(histogram_quantile(tm.METRICS["evara_handler_seconds"], 0.5)),
+            "p95": milliseconds(histogram_quantile(tm.METRICS["evara_handler_seconds"], 0.95))
+        },
+        "job_seconds": {name: {"p50": round(percentile(values, 0.5), 2), "p95": round(percentile(values, 0.95), 2)} for name, values in jobs.items()},
+        "event_loop_stalls": {"count": stalls["count"], "total_seconds": round(stalls["total"], 3), "max_ms": milliseconds(stalls["max"])},
+        "ssh": ssh_stats,
+        "telegram_requests": dict(api.requests.most_common()),
+        "errors": [result["error"] for result in results if result["error"]][:10],
+        "workdir": workdir
+    }
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="End-to-end benchmark: N simulated users run the tunnel wizard against fake SSH and Telegram servers")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--ramp", type=int, default=0, help="start this many users per second instead of all at once")
+    parser.add_argument("--workers", type=int, default=4, help="JOB_WORKERS for the bot")
+    parser.add_argument("--mode", choices=sorted(WIZARDS), default="gre", help="tunnel type the simulated users pick in the wizard")
+    parser.add_argument("--ssh-host", default="127.0.0.1", help="the single server every user shares with --servers 1")
+    parser.add_argument("--servers", type=int, default=0, help="share this many server pairs between the users instead of one pair each; 1 is the old all-on-one-host setup")
+    parser.add_argument("--ssh-port", type=int, default=0)
+    parser.add_argument("--ssh-latency", type=float, default=0.05, help="seconds per ordinary remote command")
+    parser.add_argument("--install-latency", type=float, default=1.0, help="seconds per apt command")
+    parser.add_argument("--think", type=float, default=0.0, help="pause between a reply and the user's next input")
+    parser.add_argument("--step-timeout", type=float, default=30.0)
+    parser.add_argument("--job-timeout", type=float, default=600.0)
+    parser.add_argument("--no-status", dest="status", action="store_false")
+    parser.add_argument("--no-delete", dest="delete", action="store_false")
+    parser.add_argument("--reuse-servers", action="store_true", help="after the first tunnel, build a second one from the saved servers")
+    parser.add_argument("--bundle", action="store_true", help="seed the local .deb cache, so strongswan is sent over SFTP and installed with dpkg -i")
+    parser.add_argument("--dpkg-fail", action="store_true", help="make dpkg -i fail on the fake servers; every tunnel must still be built through the apt fallback")
+    parser.add_argument("--json", help="also write the report to this file")
+    args = parser.parse_args()
+    report = asyncio.run(run(args))
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    sys.exit(1 if report["failed_users"] else 0)
@@ -0,0 +1,232 @@
+import argparse
+import itertools
+import json
+import os
+import random
+import re
+import shutil
+import socket
+import tempfile
+import threading
+import time
+from collections import Counter
+
+import paramiko
+
+PID_MARKER = "__EVARA_PID__"
+
+PING_LINE = "64 bytes from {target}: icmp_seq={seq} ttl=64 time={rtt:.3f} ms"
+PING_SUMMARY = """--- {target} ping statistics ---
+4 packets transmitted, 4 received, 0% packet loss, time 3004ms
+rtt min/avg/max/mdev = {rtt:.3f}/{rtt:.3f}/{rtt:.3f}/0.000 ms"""
+
+APT_LINES = [
+    "Hit:1 http://archive.ubuntu.com/ubuntu jammy InRelease",
+    "Reading package lists...",
+    "Building dependency tree...",
+    "Reading state information...",
+    "Setting up strongswan-starter (5.9.5-2ubuntu2) ...",
+    "Processing triggers for man-db (2.10.2-1) ..."
+]
+
+
+class FakeSFTPHandle(paramiko.SFTPHandle):
+    def stat(self):
+        return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+
+class FakeSFTPServer(paramiko.SFTPServerInterface):
+    # uploads land in a scratch directory, so the bot's package bundle can be sent without touching the real filesystem
+    def __init__(self, server, *args, **kwargs):
+        super().__init__(server, *args, **kwargs)
+        self.root = server.server.sftp_root
+
+    def path(self, remote):
+        return os.path.join(self.root, remote.lstrip("/"))
+
+    def stat(self, remote):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(self.path(remote)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    lstat = stat
+
+    def list_folder(self, remote):
+        try:
+            return [paramiko.SFTPAttributes.from_stat(os.stat(os.path.join(self.path(remote), name)), name) for name in os.listdir(self.path(remote))]
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def mkdir(self, remote, attr):
+        try:
+            os.makedirs(self.path(remote))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def open(self, remote, flags, attr):
+        os.makedirs(os.path.dirname(self.path(remote)), exist_ok=True)
+        mode = "wb" if flags & (os.O_WRONLY | os.O_RDWR) else "rb"
+        try:
+            f = open(self.path(remote), mode)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        handle = FakeSFTPHandle(flags)
+        handle.readfile = f
+        handle.writefile = f if mode == "wb" else None
+        return handle
+
+
+class FakeSSHServer:
+    def __init__(self, host="127.0.0.1", port=2222, latency=0.05, install_latency=2.0, ping_rtt=0.03, jitter=0.2, dpkg_fail=False):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.install_latency = install_latency
+        self.ping_rtt = ping_rtt
+        self.jitter = jitter
+        self.dpkg_fail = dpkg_fail
+        # hosts where a failed dpkg -i left packages unpacked but unconfigured; apt refuses to install until they are fixed
+        self.dpkg_broken = set()
+        self.sftp_root = tempfile.mkdtemp(prefix="fake-sftp-")
+        self.key = paramiko.RSAKey.generate(2048)
+        self.pids = itertools.count(1000)
+        self.commands = Counter()
+        self.connections = 0
+        self.lock = threading.Lock()
+        self.sock = None
+
+    def delay(self, seconds):
+        return max(0.0, seconds * random.uniform(1 - self.jitter, 1 + self.jitter))
+
+    def respond(self, command, host=None):
+        words = [word for word in command.split() if word != "sudo"]
+        with self.lock:
+            self.commands[words[0] if words else ""] += 1
+        ping = re.match(r"ping -c (\d+) (\S+)", command)
+        if ping:
+            lines = [PING_LINE.format(target=ping.group(2), seq=seq, rtt=self.ping_rtt * 1000) for seq in range(1, 5)]
+            return lines + PING_SUMMARY.format(target=ping.group(2), rtt=self.ping_rtt * 1000).splitlines(), self.delay(self.latency) + 3 * self.ping_rtt, 0
+        if re.search(r"\bapt-get -f install\b|--fix-broken", command):
+            with self.lock:
+                self.dpkg_broken.discard(host)
+            return APT_LINES, self.delay(self.install_latency), 0
+        if re.search(r"\bapt(-get)? (upgrade|install)\b", command) and host in self.dpkg_broken:
+            return ["E: Unmet dependencies. Try 'apt --fix-broken install' with no packages (or specify a solution)."], self.delay(self.latency), 100
+        if re.search(r"\bapt(-get)? (update|upgrade|install)\b", command):
+            return APT_LINES, self.delay(self.install_latency), 0
+        if "/etc/os-release" in command:
+            return ["facts ubuntu jammy amd64"], self.delay(self.latency), 0
+        if self.dpkg_fail and re.search(r"\bdpkg -i\b", command):
+            with self.lock:
+                self.dpkg_broken.add(host)
+            return ["dpkg: error processing archive strongswan-starter_5.9.5-2ubuntu2_amd64.deb (--install):", " package architecture (arm64) does not match system (amd64)"], self.delay(self.latency), 1
+        if "ipsecfacts" in command:
+            return ["ipsecfacts 4 6.8.0-45-generic 5.9.13 1"], self.delay(self.latency), 0
+        if "NET_RX" in command:
+            return ["4", "1", "NET_RX:     812345     603221     598112     587004"], self.delay(self.latency), 0
+        if "wg show all dump" in command:
+            now = int(time.time())
+            return [str(now)] + [f"{interface} 10.10.0.{peer}:51820 {now - 30} 1048576 2097152" for interface, peer in (("WG_To_IR", 2), ("WG_To_KH", 1))], self.delay(self.latency), 0
+        if "tc -s qdisc show" in command:
+            return [
+                "qdisc cake 8001: root refcnt 2 bandwidth 100Mbit diffserv3 triple-isolate nonat nowash no-ack-filter split-gso rtt 100ms raw overhead 0",
+                " Sent 129876543 bytes 98765 pkt (dropped 123, overlimits 4567 requeues 0)",
+                " backlog 15140b 10p requeues 0",
+                "  av_delay          0us        2.1ms          3us",
+                "  marks               0            5            0"
+            ], self.delay(self.latency), 0
+        if "lsmod" in command:
+            return ["ip6_gre 28672 0", "ip_gre 32768 0", "gre 16384 2 ip6_gre,ip_gre"], self.delay(self.latency), 0
+        return [], self.delay(self.latency), 0
+
+    def run_command(self, channel, command):
+        match = re.match(rf"echo {PID_MARKER}\$\$; (.*)", command, re.S)
+        try:
+            if not match:
+                channel.send_exit_status(0)
+                return
+            channel.sendall(f"{PID_MARKER}{next(self.pids)}\n".encode())
+            lines, duration, exit_status = self.respond(match.group(1), channel.get_transport().sock.getsockname()[0])
+            pause = duration / (len(lines) + 1)
+            for line in lines:
+                time.sleep(pause)
+                (channel.sendall_stderr if exit_status else channel.sendall)((line + "\n").encode())
+            time.sleep(pause)
+            channel.send_exit_status(exit_status)
+        except (EOFError, OSError, paramiko.SSHException):
+            pass
+        finally:
+            channel.close()
+
+    def serve(self):
+        while True:
+            try:
+                client, peer = self.sock.accept()
+            except OSError:
+                return
+            # --any-loopback binds every address, but only so each simulated server can be its own 127.x.y.z
+            if self.host == "0.0.0.0" and not peer[0].startswith("127."):
+                client.close()
+                continue
+            with self.lock:
+                self.connections += 1
+            transport = paramiko.Transport(client)
+            transport.add_server_key(self.key)
+            transport.set_subsystem_handler("sftp", paramiko.SFTPServer, FakeSFTPServer)
+            try:
+                transport.start_server(server=FakeSSHInterface(self))
+            except (EOFError, paramiko.SSHException):
+                transport.close()
+
+    def start(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((self.host, self.port))
+        self.sock.listen(512)
+        self.port = self.sock.getsockname()[1]
+        threading.Thread(target=self.serve, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self.sock:
+            self.sock.close()
+        shutil.rmtree(self.sftp_root, ignore_errors=True)
+
+
+class FakeSSHInterface(paramiko.ServerInterface):
+    def __init__(self, server):
+        self.server = server
+
+    def get_allowed_auths(self, username):
+        return "password"
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED if kind == "session" else paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(target=self.server.run_command, args=(channel, command.decode()), daemon=True).start()
+        return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake SSH server that answers the bot's provisioning commands")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=2222)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--install-latency", type=float, default=2.0)
+    parser.add_argument("--any-loopback", action="store_true", help="answer on every 127.0.0.0/8 address, so simulated users can have distinct servers")
+    parser.add_argument("--dpkg-fail", action="store_true", help="make every dpkg -i exit 1, as a broken package would")
+    args = parser.parse_args()
+    server = FakeSSHServer("0.0.0.0" if args.any_loopback else args.host, args.port, args.latency, args.install_latency, dpkg_fail=args.dpkg_fail).start()
+    print(f"fake ssh listening on {server.host}:{server.port}", flush=True)
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
+        print(json.dumps({"connections": server.connections, "commands": dict(server.commands.most_common())}), flush=True)
@@ -0,0 +1,177 @@
+import asyncio
+import itertools
+import json
+import threading
+import time
+from collections import Counter, defaultdict
+
+import aiohttp
+from aiohttp import web
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Evara", "username": "evara_bench_bot"}
+
+
+class FakeTelegramAPI:
+    def __init__(self, token, host="127.0.0.1", port=0, keep_inbox=True):
+        self.token = token
+        self.keep_inbox = keep_inbox
+        self.host = host
+        self.port = port
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.updates = []
+        self.update_event = None
+        self.inboxes = defaultdict(asyncio.Queue)
+        self.requests = Counter()
+        self.webhooks = []
+        self.deliveries = itertools.count()
+        self.delivery_errors = 0
+        self.session = None
+        self.loop = None
+        self.runner = None
+
+    @property
+    def url(self):
+        return f"http://{self.host}:{self.port}"
+
+    async def handle(self, request):
+        if request.match_info["token"] != self.token:
+            return web.json_response({"ok": False, "error_code": 401, "description": "Unauthorized"}, status=401)
+        method = request.match_info["method"]
+        self.requests[method] += 1
+        params = dict(request.query)
+        if request.can_read_body:
+            params.update(await request.post())
+        handler = getattr(self, f"api_{method.lower()}", None)
+        result = await handler(params) if handler else True
+        return web.json_response({"ok": True, "result": result})
+
+    async def api_getme(self, params):
+        return BOT_USER
+
+    async def api_setwebhook(self, params):
+        # every instance registers its own URL; updates are spread over them like a load balancer would
+        if params.get("url") and params["url"] not in self.webhooks:
+            self.webhooks.append(params["url"])
+        return True
+
+    async def api_deletewebhook(self, params):
+        self.webhooks = []
+        return True
+
+    async def deliver(self, update):
+        url = self.webhooks[next(self.deliveries) % len(self.webhooks)]
+        try:
+            async with self.session.post(url, json=update) as response:
+                await response.read()
+                if response.status != 200:
+                    self.delivery_errors += 1
+        except aiohttp.ClientError:
+            self.delivery_errors += 1
+
+    async def api_getupdates(self, params):
+        offset = int(params.get("offset") or 0)
+        self.updates = [update for update in self.updates if update["update_id"] >= offset]
+        if not self.updates:
+            self.update_event.clear()
+            try:
+                await asyncio.wait_for(self.update_event.wait(), float(params.get("timeout") or 0))
+            except asyncio.TimeoutError:
+                pass
+        return self.updates[:int(params.get("limit") or 100)]
+
+    def record(self, params, message_id):
+        chat_id = int(params["chat_id"])
+        message = {
+            "message_id": message_id,
+            "from": BOT_USER,
+            "chat": {"id": chat_id, "type": "private"},
+            "date": int(time.time()),
+            "text": params.get("text", ""),
+        }
+        if params.get("reply_markup"):
+            markup = json.loads(params["reply_markup"])
+            if "inline_keyboard" in markup:
+                message["reply_markup"] = markup
+        if self.keep_inbox:
+            self.inboxes[chat_id].put_nowait(dict(message, received_at=time.monotonic()))
+        return message
+
+    async def api_sendmessage(self, params):
+        return self.record(params, next(self.message_ids))
+
+    async def api_editmessagetext(self, params):
+        return self.record(params, int(params["message_id"]))
+
+    async def api_senddocument(self, params):
+        return self.record(dict(params, text="[document]"), next(self.message_ids))
+
+    def push(self, kind, payload):
+        update = {"update_id": next(self.update_ids), kind: payload}
+        if self.webhooks:
+            asyncio.ensure_future(self.deliver(update))
+        else:
+            self.updates.append(update)
+            self.update_event.set()
+        return time.monotonic()
+
+    def send_text(self, user_id, text):
+        user = {"id": user_id, "is_bot": False, "first_name": f"bench{user_id}"}
+        message = {
+            "message_id": next(self.message_ids),
+            "from": user,
+            "chat": {"id": user_id, "type": "private"},
+            "date": int(time.time()),
+            "text": text,
+        }
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return self.push("message", message)
+
+    def press_button(self, user_id, message, data):
+        message = {key: value for key, value in message.items() if key != "received_at"}
+        callback = {
+            "id": str(next(self.update_ids)),
+            "from": {"id": user_id, "is_bot": False, "first_name": f"bench{user_id}"},
+            "message": message,
+            "chat_instance": str(user_id),
+            "data": data,
+        }
+        return self.push("callback_query", callback)
+
+    async def expect(self, user_id, needle, timeout):
+        deadline = time.monotonic() + timeout
+        while True:
+            message = await asyncio.wait_for(self.inboxes[user_id].get(), max(deadline - time.monotonic(), 0.001))
+            if needle in message["text"]:
+                return message
+            if message["text"].startswith("❌"):
+                raise RuntimeError(f"user {user_id} got an error while waiting for {needle!r}: {message['text'][:200]}")
+
+    async def serve(self):
+        self.update_event = asyncio.Event()
+        self.session = aiohttp.ClientSession()
+        app = web.Application(client_max_size=16 * 1024 * 1024)
+        app.router.add_route("*", "/bot{token}/{method}", self.handle)
+        self.runner = web.AppRunner(app, access_log=None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    def start(self):
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        asyncio.run_coroutine_threadsafe(self.serve(), self.loop).result()
+        return self
+
+    def run(self, coroutine):
+        return asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coroutine, self.loop))
+
+    def stop(self):
+        self.loop.call_soon_threadsafe(self.update_event.set)
+        if self.runner:
+            asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result()
+        if self.session:
+            asyncio.run_coroutine_threadsafe(self.session.close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
@@ -0,0 +1,321 @@
+import argparse
+import asyncio
+import gc
+import itertools
+import json
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from urllib.parse import urlparse
+
+from aiogram import Bot, Dispatcher, types
+from aiogram.contrib.fsm_storage.memory import MemoryStorage
+
+from e2e import API_TOKEN, FIRST_USER_ID, load_bot, percentile, milliseconds, start_fake_ssh, stop_fake_ssh
+from fake_telegram import BOT_USER, FakeTelegramAPI
+
+BACK = "⬅️ بازگشت به مرحله قبل"
+
+STEPS = [
+    ("start", "text", "/start"),
+    ("MainMenu", "text", "🚀 ساخت تونل جدید"),
+    ("TunnelName", "text", "load-{user_id}"),
+    ("TunnelMenu", "text", "🔗 تونل 1 ایران به 1 خارج"),
+    ("IranServerIP", "text", "{ssh_host}"),
+    ("IranUsername", "text", "root"),
+    ("IranPassword", "text", "load"),
+    ("KharejServerIP", "text", "{ssh_host}"),
+    ("KharejUsername", "text", "root"),
+    ("KharejPassword", "text", "load"),
+    ("IranIP", "text", "10.20.0.1"),
+    ("KharejIP", "text", "10.20.0.2"),
+    ("PSK", "text", "load-psk-{user_id}"),
+    ("MTU_6to4", "button", "mtu_6to4_default"),
+    ("MTU_GRE", "button", "mtu_gre_default"),
+    ("QoS", "text", "⏭ بدون QoS"),
+    ("CrontabHour", "text", "4"),
+]
+
+BACK_BUTTONS = {
+    "MTU_6to4": "back_to_psk",
+    "MTU_GRE": "back_to_mtu_6to4",
+}
+
+STEP_INDEX = {name: index for index, (name, _, _) in enumerate(STEPS)}
+
+# these steps wait on a real SSH handshake, so they are reported but kept out of the FSM thresholds
+SSH_STEPS = {"IranPassword", "KharejPassword"}
+
+
+def make_storage(tm, spec):
+    if spec == "memory":
+        return MemoryStorage()
+    if spec == "sqlite":
+        return tm.SQLiteStorage()
+    url = urlparse(spec)
+    if url.scheme == "redis":
+        from aiogram.contrib.fsm_storage.redis import RedisStorage2
+        return RedisStorage2(url.hostname or "localhost", url.port or 6379, db=int(url.path.strip("/") or 0), prefix="fsm_load")
+    raise SystemExit(f"unknown storage backend: {spec}")
+
+
+async def storage_footprint(tm, storage):
+    if isinstance(storage, MemoryStorage):
+        return {"keys": sum(len(users) for users in storage.data.values()), "bytes": len(json.dumps(storage.data, default=str))}
+    if not hasattr(storage, "redis"):
+        keys, size = sqlite_rows(tm, "SELECT COUNT(*), COALESCE(SUM(LENGTH(chat) + LENGTH(user) + LENGTH(state) + LENGTH(data) + LENGTH(bucket)), 0) FROM fsm_state")
+        return {"keys": keys, "bytes": size}
+    redis = await storage.redis()
+    keys = [key async for key in redis.scan_iter(match="fsm_load:*")]
+    sizes = [await redis.memory_usage(key) or 0 for key in keys]
+    return {"keys": len(keys), "bytes": sum(sizes)}
+
+
+def sqlite_rows(tm, query):
+    conn = tm.db_connect()
+    row = conn.execute(query).fetchone()
+    conn.commit()
+    conn.close()
+    return row
+
+
+async def clear_storage(tm, storage):
+    if isinstance(storage, MemoryStorage):
+        storage.data.clear()
+    elif not hasattr(storage, "redis"):
+        sqlite_rows(tm, "DELETE FROM fsm_state")
+    else:
+        await storage.reset_all()
+
+
+class LoadDriver:
+    def __init__(self, tm, args):
+        self.tm = tm
+        self.args = args
+        self.message_ids = itertools.count(1)
+        self.update_ids = itertools.count(1)
+        self.latencies = {}
+        self.errors = []
+
+    def user(self, user_id):
+        return {"id": user_id, "is_bot": False, "first_name": f"load{user_id}"}
+
+    def text_update(self, user_id, text):
+        message = {
+            "message_id": next(self.message_ids),
+            "from": self.user(user_id),
+            "chat": {"id": user_id, "type": "private"},
+            "date": int(time.time()),
+            "text": text,
+        }
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text)}]
+        return {"update_id": next(self.update_ids), "message": message}
+
+    def button_update(self, user_id, data):
+        message = {
+            "message_id": next(self.message_ids),
+            "from": BOT_USER,
+            "chat": {"id": user_id, "type": "private"},
+            "date": int(time.time()),
+            "text": "keyboard",
+        }
+        callback = {"id": str(next(self.update_ids)), "from": self.user(user_id), "message": message, "chat_instance": str(user_id), "data": data}
+        return {"update_id": next(self.update_ids), "callback_query": callback}
+
+    async def send(self, label, update):
+        started = time.perf_counter()
+        # one task per update like polling does, so aiogram's per-context state cache starts empty
+        await asyncio.ensure_future(self.tm.dp.process_update(types.Update(**update)))
+        self.latencies.setdefault(label, []).append(time.perf_counter() - started)
+
+    async def current_step(self, user_id):
+        state = await self.tm.dp.storage.get_state(chat=user_id, user=user_id)
+        return STEP_INDEX.get((state or "").split(":")[-1], 0)
+
+    async def run_user(self, user_id, stop_at, back_steps):
+        values = {"user_id": user_id, "ssh_host": self.args.ssh_host}
+        index = 0
+        while index < stop_at:
+            name, kind, value = STEPS[index]
+            if index in back_steps:
+                back_steps.discard(index)
+                if name in BACK_BUTTONS:
+                    await self.send(f"{name}:back", self.button_update(user_id, BACK_BUTTONS[name]))
+                else:
+                    await self.send(f"{name}:back", self.text_update(user_id, BACK))
+                index = await self.current_step(user_id)
+                continue
+            if kind == "button":
+                await self.send(name, self.button_update(user_id, value))
+            else:
+                await self.send(name, self.text_update(user_id, value.format(**values)))
+            if name == "CrontabHour":
+                return
+            index += 1
+            if await self.current_step(user_id) != index:
+                self.errors.append(f"user {user_id} did not reach {STEPS[index][0]} after {name}")
+                return
+
+    def plan(self, user_id, rng):
+        stop_at = len(STEPS)
+        if rng.random() < self.args.abandon:
+            stop_at = rng.randint(2, len(STEPS) - 1)
+        back_steps = set()
+        if rng.random() < self.args.back:
+            candidates = list(range(STEP_INDEX["TunnelName"] + 1, stop_at))
+            back_steps = set(rng.sample(candidates, min(len(candidates), rng.randint(1, 3))))
+        return stop_at, back_steps
+
+    async def run_users(self, user_ids, rng):
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+
+        async def limited(user_id, plan):
+            async with semaphore:
+                await self.run_user(user_id, *plan)
+
+        await asyncio.gather(*[limited(user_id, self.plan(user_id, rng)) for user_id in user_ids])
+
+
+async def measure_memory(driver, user_ids):
+    stop_at = STEP_INDEX["CrontabHour"]
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for user_id in user_ids:
+        await driver.run_user(user_id, stop_at, set())
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (after - before) / len(user_ids)
+
+
+async def run_backend(tm, spec, args):
+    storage = make_storage(tm, spec)
+    tm.dp.storage = storage
+    await clear_storage(tm, storage)
+    driver = LoadDriver(tm, args)
+    rng = random.Random(args.seed)
+    users = range(FIRST_USER_ID, FIRST_USER_ID + args.users)
+
+    started = time.monotonic()
+    await driver.run_users(users, rng)
+    wall = time.monotonic() - started
+    footprint = await storage_footprint(tm, storage)
+
+    memory_users = range(FIRST_USER_ID + args.users, FIRST_USER_ID + args.users + args.memory_sample)
+    per_conversation = await measure_memory(driver, memory_users)
+    grown = await storage_footprint(tm, storage)
+
+    latencies = [value for name, values in driver.latencies.items() if name not in SSH_STEPS for value in values]
+    ssh_latencies = [value for name in SSH_STEPS for value in driver.latencies.get(name, [])]
+    slowest = sorted(driver.latencies.items(), key=lambda item: percentile(item[1], 0.95), reverse=True)[:5]
+    report = {
+        "backend": spec,
+        "users": args.users,
+        "updates": len(latencies) + len(ssh_latencies),
+        "wall_seconds": round(wall, 2),
+        "updates_per_second": round((len(latencies) + len(ssh_latencies)) / wall, 1),
+        "handler_latency_ms": {
+            "p50": milliseconds(percentile(latencies, 0.5)),
+            "p95": milliseconds(percentile(latencies, 0.95)),
+            "p99": milliseconds(percentile(latencies, 0.99))
+        },
+        "ssh_test_latency_ms": {
+            "p50": milliseconds(percentile(ssh_latencies, 0.5)),
+            "p95": milliseconds(percentile(ssh_latencies, 0.95))
+        },
+        "slowest_steps_p95_ms": {name: milliseconds(percentile(values, 0.95)) for name, values in slowest},
+        "memory_per_conversation_kib": round(per_conversation / 1024, 2),
+        "storage": {
+            "keys": footprint["keys"],
+            "bytes": footprint["bytes"],
+            "bytes_per_user": round(footprint["bytes"] / args.users, 1),
+            "bytes_per_active_conversation": round((grown["bytes"] - footprint["bytes"]) / args.memory_sample, 1)
+        },
+        "errors": driver.errors[:10]
+    }
+    await storage.close()
+    await storage.wait_closed()
+    return report
+
+
+def check_thresholds(report, args, baseline):
+    failures = []
+    if report["errors"]:
+        failures.append(f"{len(report['errors'])} flows got stuck")
+    if report["handler_latency_ms"]["p95"] > args.max_p95_ms:
+        failures.append(f"handler p95 {report['handler_latency_ms']['p95']} ms > {args.max_p95_ms} ms")
+    if report["memory_per_conversation_kib"] > args.max_kib_per_conversation:
+        failures.append(f"memory per conversation {report['memory_per_conversation_kib']} KiB > {args.max_kib_per_conversation} KiB")
+    if report["storage"]["bytes_per_user"] > args.max_storage_bytes_per_user:
+        failures.append(f"storage {report['storage']['bytes_per_user']} bytes per user > {args.max_storage_bytes_per_user}")
+    previous = baseline.get(report["backend"])
+    if previous:
+        for path in (("handler_latency_ms", "p95"), ("memory_per_conversation_kib",), ("storage", "bytes_per_user")):
+            old, new = previous, report
+            for key in path:
+                old, new = old[key], new[key]
+            if old and new > old * (1 + args.tolerance):
+                failures.append(f"{'.'.join(path)} regressed from {old} to {new}")
+    return failures
+
+
+async def run(args):
+    ssh, ssh_port = start_fake_ssh(args)
+    api = FakeTelegramAPI(API_TOKEN, keep_inbox=False).start()
+    workdir = tempfile.mkdtemp(prefix="evara-fsm-load-")
+    tm = load_bot(workdir, api.url, ssh_port, args.users + args.memory_sample, 0)
+    Bot.set_current(tm.bot)
+    Dispatcher.set_current(tm.dp)
+    reports = []
+    try:
+        for spec in args.storage:
+            reports.append(await run_backend(tm, spec, args))
+    finally:
+        await (await tm.bot.get_session()).close()
+        api.stop()
+        stop_fake_ssh(ssh)
+        tm.log_listener.stop()
+    return reports
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Drive thousands of simulated users through the ServerConfig wizard and check FSM latency, memory and storage growth")
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=20, help="users in flight at once")
+    parser.add_argument("--abandon", type=float, default=0.3, help="share of users that stop mid-wizard")
+    parser.add_argument("--back", type=float, default=0.3, help="share of users that press back one to three times")
+    parser.add_argument("--memory-sample", type=int, default=300, help="extra users left mid-wizard to measure memory per conversation")
+    parser.add_argument("--storage", action="append", help="memory, sqlite (the bot's database) or redis://host:port/db; repeat to compare backends")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--ssh-host", default="127.0.0.1")
+    parser.add_argument("--ssh-port", type=int, default=0)
+    parser.add_argument("--ssh-latency", type=float, default=0.0)
+    parser.add_argument("--install-latency", type=float, default=0.0)
+    parser.add_argument("--max-p95-ms", type=float, default=500)
+    parser.add_argument("--max-kib-per-conversation", type=float, default=32)
+    parser.add_argument("--max-storage-bytes-per-user", type=float, default=4096)
+    parser.add_argument("--baseline", help="previous report; fail if a metric grows by more than --tolerance")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    parser.add_argument("--json", help="also write the report to this file")
+    parser.set_defaults(servers=1, dpkg_fail=False)
+    args = parser.parse_args()
+    args.storage = args.storage or ["memory"]
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = {report["backend"]: report for report in json.load(f)}
+    reports = asyncio.run(run(args))
+    failed = False
+    for report in reports:
+        report["failures"] = check_thresholds(report, args, baseline)
+        failed = failed or bool(report["failures"])
+    print(json.dumps(reports, ensure_ascii=False, indent=2))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(reports, f, ensure_ascii=False, indent=2)
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,107 @@
+import argparse
+import json
+import re
+import sqlite3
+import sys
+import time
+
+import paramiko
+
+IRAN_TUNNEL_IP = "172.20.40.1"
+KHAREJ_TUNNEL_IP = "172.20.40.2"
+IPERF_PORT = 5201
+
+
+def load_tunnels(db_path, names):
+    conn = sqlite3.connect(db_path)
+    conn.row_factory = sqlite3.Row
+    tunnels = []
+    for name in names:
+        rows = conn.execute("SELECT * FROM tunnels WHERE tunnel_name = ? COLLATE NOCASE", (name,)).fetchall()
+        if len(rows) != 1:
+            raise SystemExit(f"expected exactly one tunnel named {name!r}, found {len(rows)}")
+        tunnels.append(dict(rows[0]))
+    conn.close()
+    return tunnels
+
+
+def connect(host, username, password, port):
+    client = paramiko.SSHClient()
+    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    client.connect(host, port=port, username=username, password=password, timeout=10)
+    return client
+
+
+def run(client, command, timeout):
+    _, stdout, stderr = client.exec_command(command, timeout=timeout)
+    output = stdout.read().decode(errors="replace")
+    status = stdout.channel.recv_exit_status()
+    if status != 0:
+        raise RuntimeError(f"{command!r} exited with {status}: {stderr.read().decode(errors='replace').strip()[-300:]}")
+    return output
+
+
+def iperf(iran, kharej, args, reverse):
+    # one-shot server: it exits after a single test, so nothing is left listening on the tunnel address
+    run(kharej, f"iperf3 -s -1 -D -B {KHAREJ_TUNNEL_IP} -p {IPERF_PORT}", 15)
+    time.sleep(0.5)
+    command = f"iperf3 -c {KHAREJ_TUNNEL_IP} -B {IRAN_TUNNEL_IP} -p {IPERF_PORT} -t {args.seconds} -P {args.streams} -J"
+    report = json.loads(run(iran, command + (" -R" if reverse else ""), args.seconds + 30))
+    end = report["end"]
+    return {
+        "mbps": round(end["sum_received"]["bits_per_second"] / 1e6, 1),
+        "retransmits": end["sum_sent"].get("retransmits"),
+        "cpu_percent": round(end["cpu_utilization_percent"]["host_total"], 1)
+    }
+
+
+def ping(iran, count):
+    output = run(iran, f"ping -c {count} -i 0.2 -q {KHAREJ_TUNNEL_IP}", count + 15)
+    loss = re.search(r"([\d.]+)% packet loss", output)
+    rtt = re.search(r"= [\d.]+/([\d.]+)/[\d.]+/([\d.]+) ms", output)
+    return {
+        "loss_percent": float(loss.group(1)) if loss else None,
+        "rtt_ms": float(rtt.group(1)) if rtt else None,
+        "jitter_ms": float(rtt.group(2)) if rtt else None
+    }
+
+
+def benchmark(tunnel, args):
+    result = {"tunnel": tunnel["tunnel_name"], "mode": tunnel.get("tunnel_mode") or "gre", "mtu": tunnel["mtu_gre"], "error": None}
+    iran = kharej = None
+    try:
+        iran = connect(tunnel["iran_server_ip"], tunnel["iran_username"], tunnel["iran_password"], args.ssh_port)
+        kharej = connect(tunnel["kharej_server_ip"], tunnel["kharej_username"], tunnel["kharej_password"], args.ssh_port)
+        if args.install:
+            for client in (iran, kharej):
+                run(client, "command -v iperf3 >/dev/null || sudo DEBIAN_FRONTEND=noninteractive apt-get install -y iperf3", 300)
+        result["ping"] = ping(iran, args.pings)
+        result["iran_to_kharej"] = iperf(iran, kharej, args, False)
+        result["kharej_to_iran"] = iperf(iran, kharej, args, True)
+    except (OSError, RuntimeError, ValueError, KeyError, paramiko.SSHException) as e:
+        result["error"] = str(e) or type(e).__name__
+    finally:
+        for client in (iran, kharej):
+            if client:
+                client.close()
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Data-plane benchmark: iperf3 and ping across existing tunnels, so GRE and WireGuard tunnels can be compared")
+    parser.add_argument("--db", default="tunnels.db", help="the bot's database, used to look up the tunnels' servers")
+    parser.add_argument("--tunnel", action="append", required=True, help="tunnel name; repeat to compare several tunnels")
+    parser.add_argument("--seconds", type=int, default=10, help="duration of each iperf3 direction")
+    parser.add_argument("--streams", type=int, default=4, help="parallel TCP streams")
+    parser.add_argument("--pings", type=int, default=20)
+    parser.add_argument("--ssh-port", type=int, default=22)
+    parser.add_argument("--install", action="store_true", help="install iperf3 on both servers if it is missing")
+    parser.add_argument("--json", help="also write the report to this file")
+    args = parser.parse_args()
+    # tunnels run one after another so they never compete for the same uplink
+    report = [benchmark(tunnel, args) for tunnel in load_tunnels(args.db, args.tunnel)]
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    sys.exit(1 if any(result["error"] for result in report) else 0)
@@ -37,6 +37,7 @@ install_bot() {
     cat > requirements.txt << EOL
 aiogram==2.25.1
 paramiko==3.3.1
+matplotlib==3.8.4
 EOL
 
     echo -e "${YELLOW}Installing Python dependencies from requirements.txt...${NC}"
@@ -145,7 +146,7 @@ uninstall_bot() {
     fi
 
     echo -e "${YELLOW}Removing Python dependencies...${NC}"
-    pip3 uninstall -y aiogram paramiko 2>/dev/null || echo -e "${YELLOW}Note: Some dependencies might not be removed if used by other applications.${NC}"
+    pip3 uninstall -y aiogram paramiko matplotlib 2>/dev/null || echo -e "${YELLOW}Note: Some dependencies might not be removed if used by other applications.${NC}"
 
     echo -e "${GREEN}Uninstallation completed successfully!${NC}"
 }
@@ -1,23 +1,484 @@
+import aiohttp
 import asyncio
+import base64
+import concurrent.futures
+import contextlib
+import contextvars
+import hashlib
+import hmac
+import io
+import json
+import logging
+import logging.handlers
+import os
 import sqlite3
 import paramiko
+import random
 import re
+import secrets
+import shutil
+import threading
+import time
 import uuid
+from collections import Counter, OrderedDict, deque
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+from queue import SimpleQueue
+from urllib.parse import unquote, urlparse
 from aiogram import Bot, Dispatcher, types
+from aiogram.bot.api import TelegramAPIServer
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.contrib.fsm_storage.memory import MemoryStorage
 from aiogram.dispatcher import FSMContext
+from aiogram.dispatcher.storage import BaseStorage
+from aiogram.dispatcher.webhook import get_new_configured_app
 from aiogram.dispatcher.filters.state import State, StatesGroup
+from aiogram.dispatcher.middlewares import BaseMiddleware
 from aiogram.utils.markdown import escape_md
+from aiohttp import web
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
+try:
+    from matplotlib.figure import Figure
+except ImportError:
+    Figure = None
+import config
 from config import API_TOKEN, ADMIN_ID, ALLOWED_USER_IDS
 
-storage = MemoryStorage()
-bot = Bot(token=API_TOKEN)
+LOG_FILE = getattr(config, 'LOG_FILE', 'bot.log')
+LOG_LEVEL = getattr(config, 'LOG_LEVEL', 'INFO')
+LOG_MAX_BYTES = getattr(config, 'LOG_MAX_BYTES', 10 * 1024 * 1024)
+LOG_BACKUP_COUNT = getattr(config, 'LOG_BACKUP_COUNT', 5)
+
+SECRET_PATTERNS = [
+    re.compile(r'(PSK\s+\\?")[^"\\]*'),
+    re.compile(r'((?:password|passwd|token|secret)\s*[=:]\s*)\S+', re.IGNORECASE),
+    # bodies of uploaded files (WireGuard configs, the agent token); one pattern instead of a secret per file
+    re.compile(r'(echo )[A-Za-z0-9+/]{16,}={0,2}(?= \| base64 -d)')
+]
+SECRETS = set()
+
+def register_secret(value):
+    if value and len(value) >= 4:
+        SECRETS.add(value)
+
+def redact(text):
+    for pattern in SECRET_PATTERNS:
+        text = pattern.sub(r'\1***', text)
+    for secret in SECRETS:
+        text = text.replace(secret, '***')
+    return text
+
+class RedactingQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        record = super().prepare(record)
+        record.msg = redact(record.msg)
+        record.fields = {key: redact(value) if isinstance(value, str) else value for key, value in getattr(record, 'fields', {}).items()}
+        return record
+
+class StructuredFormatter(logging.Formatter):
+    def format(self, record):
+        line = f"{self.formatTime(record)} level={record.levelname} msg={json.dumps(record.getMessage(), ensure_ascii=False)}"
+        for key, value in getattr(record, 'fields', {}).items():
+            if value is None:
+                continue
+            if isinstance(value, float):
+                value = f"{value:.3f}"
+            elif isinstance(value, str):
+                value = json.dumps(value, ensure_ascii=False)
+            line += f" {key}={value}"
+        if record.exc_text:
+            line += f" exc={json.dumps(record.exc_text, ensure_ascii=False)}"
+        return line
+
+def setup_logging():
+    log_queue = SimpleQueue()
+    formatter = StructuredFormatter()
+    file_handler = logging.handlers.RotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8')
+    file_handler.setFormatter(formatter)
+    console_handler = logging.StreamHandler()
+    console_handler.setLevel(logging.WARNING)
+    console_handler.setFormatter(formatter)
+    listener = logging.handlers.QueueListener(log_queue, file_handler, console_handler, respect_handler_level=True)
+    logger = logging.getLogger('evara')
+    logger.setLevel(LOG_LEVEL)
+    logger.addHandler(RedactingQueueHandler(log_queue))
+    logger.propagate = False
+    listener.start()
+    return listener
+
+log_listener = setup_logging()
+log = logging.getLogger('evara')
+
+def log_event(level, message, **fields):
+    log.log(level, message, extra={'fields': fields})
+
+METRICS_HOST = getattr(config, 'METRICS_HOST', '127.0.0.1')
+METRICS_PORT = getattr(config, 'METRICS_PORT', 9464)
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 900)
+DB_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5, 1)
+
+METRICS = {}
+METRICS_LOCK = threading.Lock()
+
+def define_metric(name, metric_type, help_text, buckets=None):
+    METRICS[name] = {"type": metric_type, "help": help_text, "buckets": buckets, "series": {}}
+
+def observe(name, value, **labels):
+    metric = METRICS[name]
+    key = tuple(sorted(labels.items()))
+    with METRICS_LOCK:
+        series = metric["series"].setdefault(key, {"buckets": [0] * len(metric["buckets"]), "sum": 0.0, "count": 0})
+        for index, bound in enumerate(metric["buckets"]):
+            if value <= bound:
+                series["buckets"][index] += 1
+        series["sum"] += value
+        series["count"] += 1
+
+def inc(name, amount=1, **labels):
+    key = tuple(sorted(labels.items()))
+    with METRICS_LOCK:
+        METRICS[name]["series"][key] = METRICS[name]["series"].get(key, 0) + amount
+
+def set_gauge(name, value, **labels):
+    with METRICS_LOCK:
+        METRICS[name]["series"][tuple(sorted(labels.items()))] = value
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{escape_label(value)}"' for key, value in pairs) + "}"
+
+def render_metrics():
+    lines = []
+    with METRICS_LOCK:
+        for name, metric in METRICS.items():
+            lines.append(f"# TYPE {name} {metric['type']}")
+            lines.append(f"# HELP {name} {metric['help']}")
+            for labels, value in metric["series"].items():
+                if metric["type"] == "histogram":
+                    for bound, count in zip(metric["buckets"], value["buckets"]):
+                        lines.append(f"{name}_bucket{format_labels(labels, [('le', bound)])} {count}")
+                    lines.append(f"{name}_bucket{format_labels(labels, [('le', '+Inf')])} {value['count']}")
+                    lines.append(f"{name}_sum{format_labels(labels)} {value['sum']}")
+                    lines.append(f"{name}_count{format_labels(labels)} {value['count']}")
+                elif metric["type"] == "counter":
+                    lines.append(f"{name}_total{format_labels(labels)} {value}")
+                else:
+                    lines.append(f"{name}{format_labels(labels)} {value}")
+    lines.append("# EOF")
+    return "\n".join(lines) + "\n"
+
+define_metric("evara_ssh_connect_seconds", "histogram", "Time to open and authenticate an SSH connection.", LATENCY_BUCKETS)
+define_metric("evara_ssh_command_seconds", "histogram", "Execution time of a remote command, by program.", LATENCY_BUCKETS)
+define_metric("evara_ping_rtt_seconds", "histogram", "Average RTT reported by ping_ssh.", (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.2, 0.3, 0.5, 1, 2))
+define_metric("evara_db_query_seconds", "histogram", "SQLite statement time, by operation.", DB_BUCKETS)
+define_metric("evara_handler_seconds", "histogram", "Telegram handler latency, by FSM state.", LATENCY_BUCKETS)
+define_metric("evara_provision_steps", "counter", "Provisioning commands, by step and result.")
+define_metric("evara_jobs_active", "gauge", "Jobs currently queued or running in this instance.")
+define_metric("evara_ssh_connections_open", "gauge", "SSH connections currently open.")
+define_metric("evara_alerts_sent", "counter", "Alert and recovery notices pushed to users.")
+define_metric("evara_agent_requests", "counter", "Status requests to on-server agents, by result.")
+define_metric("evara_agent_request_seconds", "histogram", "Latency of a status request to an on-server agent.", LATENCY_BUCKETS)
+define_metric("evara_failovers", "counter", "Iran-side route switches between primary and standby Kharej servers, by reason.")
+define_metric("evara_alerts_firing", "gauge", "Alert rules currently firing.")
+define_metric("evara_chart_render_seconds", "histogram", "Time to render a tunnel chart PNG.", LATENCY_BUCKETS)
+define_metric("evara_chart_cache", "counter", "Chart requests, by cache result.")
+define_metric("evara_probes", "counter", "SSH-backed status probes, by kind and result (run, shared, limited).")
+
+SSH_CONNECTIONS = {"open": 0}
+
+def track_ssh_connection(delta):
+    with METRICS_LOCK:
+        SSH_CONNECTIONS["open"] += delta
+        METRICS["evara_ssh_connections_open"]["series"][()] = SSH_CONNECTIONS["open"]
+
+def command_program(command):
+    words = [word for word in re.split(r'[\s(;|&]+', command) if word and word != "sudo"]
+    return words[0][:32] if words else "unknown"
+
+async def metrics_handler(request):
+    running = len(RUNNING_JOBS)
+    set_gauge("evara_jobs_active", running, status="running")
+    conn = db_connect()
+    c = conn.cursor()
+    c.execute("SELECT COUNT(*) FROM jobs WHERE status = 'queued'")
+    set_gauge("evara_jobs_active", c.fetchone()[0], status="queued")
+    conn.close()
+    return web.Response(body=render_metrics().encode('utf-8'), headers={"Content-Type": "application/openmetrics-text; version=1.0.0; charset=utf-8"})
+
+async def start_metrics_server():
+    if not METRICS_PORT:
+        return None
+    app = web.Application()
+    app.router.add_get('/metrics', metrics_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    log_event(logging.INFO, "metrics endpoint started", host=METRICS_HOST, port=METRICS_PORT)
+    return runner
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    async def on_pre_process_message(self, message: types.Message, data: dict):
+        data['metrics_started'] = time.monotonic()
+        data['metrics_state'] = await dp.current_state(chat=message.chat.id, user=message.from_user.id).get_state()
+
+    async def on_post_process_message(self, message: types.Message, results, data: dict):
+        observe("evara_handler_seconds", time.monotonic() - data['metrics_started'], state=data['metrics_state'] or "none", update="message")
+
+    async def on_pre_process_callback_query(self, callback_query: types.CallbackQuery, data: dict):
+        data['metrics_started'] = time.monotonic()
+        chat_id = callback_query.message.chat.id if callback_query.message else callback_query.from_user.id
+        data['metrics_state'] = await dp.current_state(chat=chat_id, user=callback_query.from_user.id).get_state()
+
+    async def on_post_process_callback_query(self, callback_query: types.CallbackQuery, results, data: dict):
+        observe("evara_handler_seconds", time.monotonic() - data['metrics_started'], state=data['metrics_state'] or "none", update="callback_query")
+
+FSM_STORAGE = getattr(config, 'FSM_STORAGE', 'memory')
+# several instances can share one deployment only when the conversation state lives outside the process
+CLUSTER_MODE = getattr(config, 'CLUSTER_MODE', FSM_STORAGE != 'memory')
+
+class SQLiteStorage(BaseStorage):
+    # FSM state in the bot's database, so the next step of a conversation can land on any instance
+    def __init__(self):
+        # commits wait on fsync; off the event loop they only delay the conversation that made them
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix="fsm")
+
+    async def close(self):
+        self.executor.shutdown(wait=True)
+
+    async def wait_closed(self):
+        pass
+
+    async def read(self, chat, user):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self.load, chat, user)
+
+    async def write(self, chat, user, change):
+        await asyncio.get_running_loop().run_in_executor(self.executor, self.modify, chat, user, change)
+
+    def load(self, chat, user):
+        chat, user = map(str, self.check_address(chat=chat, user=user))
+        conn = db_connect()
+        c = conn.cursor()
+        c.execute('SELECT state, data, bucket FROM fsm_state WHERE chat = ? AND user = ?', (chat, user))
+        row = c.fetchone()
+        conn.close()
+        if not row:
+            return {"state": None, "data": {}, "bucket": {}}
+        return {"state": row[0], "data": json.loads(row[1]), "bucket": json.loads(row[2])}
+
+    def modify(self, chat, user, change):
+        chat, user = map(str, self.check_address(chat=chat, user=user))
+        conn = db_connect()
+        c = conn.cursor()
+        # read-modify-write under the write lock, so two instances updating one conversation do not lose keys
+        c.execute('BEGIN IMMEDIATE')
+        c.execute('SELECT state, data, bucket FROM fsm_state WHERE chat = ? AND user = ?', (chat, user))
+        row = c.fetchone()
+        record = {"state": row[0], "data": json.loads(row[1]), "bucket": json.loads(row[2])} if row else {"state": None, "data": {}, "bucket": {}}
+        change(record)
+        if record == {"state": None, "data": {}, "bucket": {}}:
+            c.execute('DELETE FROM fsm_state WHERE chat = ? AND user = ?', (chat, user))
+        else:
+            c.execute(
+                'INSERT OR REPLACE INTO fsm_state (chat, user, state, data, bucket, updated_at) VALUES (?, ?, ?, ?, ?, ?)',
+                (chat, user, record['state'], json.dumps(record['data'], ensure_ascii=False), json.dumps(record['bucket'], ensure_ascii=False), time.time())
+            )
+        conn.commit()
+        conn.close()
+
+    async def get_state(self, *, chat=None, user=None, default=None):
+        return (await self.read(chat, user))['state'] or self.resolve_state(default)
+
+    async def get_data(self, *, chat=None, user=None, default=None):
+        return (await self.read(chat, user))['data'] or dict(default or {})
+
+    async def set_state(self, *, chat=None, user=None, state=None):
+        await self.write(chat, user, lambda record: record.update(state=self.resolve_state(state)))
+
+    async def set_data(self, *, chat=None, user=None, data=None):
+        await self.write(chat, user, lambda record: record.update(data=dict(data or {})))
+
+    async def update_data(self, *, chat=None, user=None, data=None, **kwargs):
+        await self.write(chat, user, lambda record: record['data'].update(data or {}, **kwargs))
+
+    async def reset_state(self, *, chat=None, user=None, with_data=True):
+        await self.write(chat, user, lambda record: record.update(state=None, **({"data": {}} if with_data else {})))
+
+    def has_bucket(self):
+        return True
+
+    async def get_bucket(self, *, chat=None, user=None, default=None):
+        return (await self.read(chat, user))['bucket'] or dict(default or {})
+
+    async def set_bucket(self, *, chat=None, user=None, bucket=None):
+        await self.write(chat, user, lambda record: record.update(bucket=dict(bucket or {})))
+
+    async def update_bucket(self, *, chat=None, user=None, bucket=None, **kwargs):
+        await self.write(chat, user, lambda record: record['bucket'].update(bucket or {}, **kwargs))
+
+CONVERSATION_LOCK = contextvars.ContextVar('conversation_lock', default=None)
+
+class ConversationLockMiddleware(BaseMiddleware):
+    # handlers reply before they move the state, so the user's next update may reach another instance first;
+    # holding a per-user lock until the handler has stored the new state makes that update wait for the state change
+    async def on_pre_process_update(self, update: types.Update, data: dict):
+        event = update.message or update.callback_query
+        if event:
+            data['conversation_lock'] = DistributedLock(f"user:{event.from_user.id}", CONVERSATION_LOCK_POLL_INTERVAL)
+            await data['conversation_lock'].__aenter__()
+            CONVERSATION_LOCK.set(data['conversation_lock'])
+
+    async def on_post_process_update(self, update: types.Update, results, data: dict):
+        if 'conversation_lock' in data:
+            await data['conversation_lock'].__aexit__(None, None, None)
+
+async def release_conversation_lock():
+    # called by handlers once their state is stored, before slow work such as SSH probes
+    lock = CONVERSATION_LOCK.get()
+    if lock:
+        await lock.__aexit__(None, None, None)
+
+def create_fsm_storage():
+    if FSM_STORAGE == "sqlite":
+        return SQLiteStorage()
+    if FSM_STORAGE.startswith("redis://"):
+        from aiogram.contrib.fsm_storage.redis import RedisStorage2
+        url = urlparse(FSM_STORAGE)
+        return RedisStorage2(url.hostname or "localhost", url.port or 6379, db=int(url.path.strip("/") or 0), password=url.password, prefix="evara_fsm")
+    return MemoryStorage()
+
+TELEGRAM_API_SERVER = getattr(config, 'TELEGRAM_API_SERVER', None)
+
+storage = create_fsm_storage()
+if TELEGRAM_API_SERVER:
+    bot = Bot(token=API_TOKEN, server=TelegramAPIServer.from_base(TELEGRAM_API_SERVER))
+else:
+    bot = Bot(token=API_TOKEN)
 dp = Dispatcher(bot, storage=storage)
+dp.middleware.setup(HandlerMetricsMiddleware())
+if CLUSTER_MODE:
+    dp.middleware.setup(ConversationLockMiddleware())
+
+class MeteredCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        started = time.monotonic()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            observe("evara_db_query_seconds", time.monotonic() - started, operation=sql.split(None, 1)[0].upper())
+
+class MeteredConnection(sqlite3.Connection):
+    def cursor(self, factory=MeteredCursor):
+        return super().cursor(factory)
+
+DB_PATH = getattr(config, 'DB_PATH', 'tunnels.db')
+DB_BUSY_TIMEOUT = getattr(config, 'DB_BUSY_TIMEOUT', 30)
+
+def db_connect(timeout=DB_BUSY_TIMEOUT):
+    return sqlite3.connect(DB_PATH, timeout=timeout, factory=MeteredConnection)
+
+def add_missing_columns(c, table, columns):
+    c.execute(f'PRAGMA table_info({table})')
+    existing = [row[1] for row in c.fetchall()]
+    for column, definition in columns:
+        if column not in existing:
+            c.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+SERVER_VERIFY_TTL = getattr(config, 'SERVER_VERIFY_TTL', 86400)
+SERVER_FACTS_TTL = getattr(config, 'SERVER_FACTS_TTL', 7 * 86400)
+SERVER_PICKER_LIMIT = 8
+SERVER_BUTTON_PREFIX = "🖥 "
+
+def register_server(c, user_id, host, username, password, verified=False):
+    c.execute('INSERT OR IGNORE INTO servers (user_id, host, username, password, created_at) VALUES (?, ?, ?, ?, ?)', (user_id, host, username, password, time.time()))
+    c.execute('UPDATE servers SET username = ?, password = ? WHERE user_id = ? AND host = ?', (username, password, user_id, host))
+    if verified:
+        c.execute('UPDATE servers SET verified_at = ? WHERE user_id = ? AND host = ?', (time.time(), user_id, host))
+    c.execute('SELECT server_id FROM servers WHERE user_id = ? AND host = ?', (user_id, host))
+    return c.fetchone()[0]
+
+def remember_server(user_id, host, username, password):
+    conn = db_connect()
+    c = conn.cursor()
+    server_id = register_server(c, user_id, host, username, password, verified=True)
+    conn.commit()
+    conn.close()
+    return server_id
+
+# tunnels keep their own copy of the credentials; new ones from the registry reach them only when the user confirms
+def count_stale_tunnels(server_id):
+    conn = db_connect()
+    c = conn.cursor()
+    c.execute('''
+        SELECT COUNT(*) FROM tunnels JOIN servers ON server_id = ?
+        WHERE (iran_server_id = server_id AND (iran_username != username OR iran_password != password))
+           OR (kharej_server_id = server_id AND (kharej_username != username OR kharej_password != password))
+    ''', (server_id,))
+    count = c.fetchone()[0]
+    conn.close()
+    return count
+
+def sync_tunnel_credentials(user_id, server_id):
+    conn = db_connect()
+    c = conn.cursor()
+    c.execute('SELECT username, password FROM servers WHERE server_id = ? AND user_id = ?', (server_id, user_id))
+    row = c.fetchone()
+    if row:
+        c.execute('UPDATE tunnels SET iran_username = ?, iran_password = ? WHERE iran_server_id = ?', (row[0], row[1], server_id))
+        c.execute('UPDATE tunnels SET kharej_username = ?, kharej_password = ? WHERE kharej_server_id = ?', (row[0], row[1], server_id))
+    conn.commit()
+    conn.close()
+    return row is not None
+
+def list_servers(user_id, excluded_host=None):
+    conn = db_connect()
+    conn.row_factory = sqlite3.Row
+    c = conn.cursor()
+    c.execute('SELECT * FROM servers WHERE user_id = ? AND host != ? ORDER BY verified_at DESC, server_id DESC LIMIT ?', (user_id, excluded_host or "", SERVER_PICKER_LIMIT))
+    servers = [dict(server) for server in c.fetchall()]
+    conn.close()
+    return servers
+
+def get_server(user_id, host):
+    conn = db_connect()
+    conn.row_factory = sqlite3.Row
+    c = conn.cursor()
+    c.execute('SELECT * FROM servers WHERE user_id = ? AND host = ?', (user_id, host))
+    server = c.fetchone()
+    conn.close()
+    return dict(server) if server else None
+
+def server_button(server):
+    return f"{SERVER_BUTTON_PREFIX}{server['host']} ({server['username']})"
+
+def get_cached_facts(user_id, host):
+    # per owner: another user's entry for the same address may be a different machine behind it
+    conn = db_connect()
+    c = conn.cursor()
+    c.execute('SELECT facts FROM servers WHERE user_id = ? AND host = ? AND facts IS NOT NULL AND facts_at > ?', (user_id, host, time.time() - SERVER_FACTS_TTL))
+    row = c.fetchone()
+    conn.close()
+    return json.loads(row[0]) if row else None
+
+def save_facts(user_id, host, facts):
+    conn = db_connect()
+    c = conn.cursor()
+    c.execute('UPDATE servers SET facts = ?, facts_at = ? WHERE user_id = ? AND host = ?', (json.dumps(facts), time.time(), user_id, host))
+    conn.commit()
+    conn.close()
 
 def init_db():
-    conn = sqlite3.connect('tunnels.db')
+    conn = db_connect()
     c = conn.cursor()
+    if CLUSTER_MODE:
+        # readers no longer block the writer, which matters once several processes share the file
+        c.execute('PRAGMA journal_mode=WAL')
     c.execute('''
         CREATE TABLE IF NOT EXISTS tunnels (
             tunnel_id TEXT PRIMARY KEY,
@@ -37,7 +498,216 @@ def init_db():
             mtu_6to4 TEXT,
             mtu_gre TEXT,
             crontab_hour TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            tunnel_mode TEXT DEFAULT 'gre',
+            qdisc TEXT DEFAULT '',
+            qos_bandwidth INTEGER DEFAULT 0,
+            iran_server_id INTEGER,
+            kharej_server_id INTEGER
+        )
+    ''')
+    add_missing_columns(c, "tunnels", (("tunnel_mode", "TEXT DEFAULT 'gre'"), ("qdisc", "TEXT DEFAULT ''"), ("qos_bandwidth", "INTEGER DEFAULT 0"), ("iran_server_id", "INTEGER"), ("kharej_server_id", "INTEGER")))
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS servers (
+            server_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            host TEXT,
+            username TEXT,
+            password TEXT,
+            facts TEXT,
+            facts_at REAL,
+            verified_at REAL,
+            created_at REAL,
+            UNIQUE (user_id, host)
+        )
+    ''')
+    # tunnels from before the registry: their servers are registered in creation order, so the newest credentials win
+    c.execute('SELECT tunnel_id, user_id, iran_server_ip, iran_username, iran_password, kharej_server_ip, kharej_username, kharej_password FROM tunnels WHERE iran_server_id IS NULL ORDER BY created_at, rowid')
+    for tunnel_id, user_id, iran_host, iran_username, iran_password, kharej_host, kharej_username, kharej_password in c.fetchall():
+        iran_server_id = register_server(c, user_id, iran_host, iran_username, iran_password)
+        kharej_server_id = register_server(c, user_id, kharej_host, kharej_username, kharej_password)
+        c.execute('UPDATE tunnels SET iran_server_id = ?, kharej_server_id = ? WHERE tunnel_id = ?', (iran_server_id, kharej_server_id, tunnel_id))
+    c.execute('CREATE INDEX IF NOT EXISTS idx_tunnels_created ON tunnels (created_at, tunnel_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_tunnels_user_created ON tunnels (user_id, created_at, tunnel_id)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_tunnels_name ON tunnels (tunnel_name COLLATE NOCASE)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_tunnels_iran_server_ip ON tunnels (iran_server_ip)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_tunnels_kharej_server_ip ON tunnels (kharej_server_ip)')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS jobs (
+            job_id TEXT PRIMARY KEY,
+            kind TEXT,
+            user_id INTEGER,
+            chat_id INTEGER,
+            tunnel_id TEXT,
+            title TEXT,
+            status TEXT,
+            progress TEXT,
+            payload TEXT,
+            error TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            started_at TIMESTAMP,
+            finished_at TIMESTAMP,
+            instance_id TEXT,
+            cancel_requested INTEGER DEFAULT 0
+        )
+    ''')
+    add_missing_columns(c, "jobs", (("instance_id", "TEXT"), ("cancel_requested", "INTEGER DEFAULT 0")))
+    c.execute('CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, created_at)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_jobs_user_status ON jobs (user_id, status)')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS spans (
+            span_id TEXT PRIMARY KEY,
+            parent_id TEXT,
+            job_id TEXT,
+            tunnel_id TEXT,
+            name TEXT,
+            started_at REAL,
+            duration REAL,
+            status TEXT,
+            attributes TEXT
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_spans_tunnel ON spans (tunnel_id, started_at)')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS traffic_counters (
+            tunnel_id TEXT,
+            side TEXT,
+            interface TEXT,
+            sampled_at REAL,
+            rx_bytes INTEGER,
+            rx_packets INTEGER,
+            rx_errors INTEGER,
+            rx_drops INTEGER,
+            tx_bytes INTEGER,
+            tx_packets INTEGER,
+            tx_errors INTEGER,
+            tx_drops INTEGER,
+            PRIMARY KEY (tunnel_id, side, interface)
+        )
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS traffic_samples (
+            tunnel_id TEXT,
+            side TEXT,
+            interface TEXT,
+            sampled_at REAL,
+            interval REAL,
+            rx_bytes INTEGER,
+            rx_packets INTEGER,
+            rx_errors INTEGER,
+            rx_drops INTEGER,
+            tx_bytes INTEGER,
+            tx_packets INTEGER,
+            tx_errors INTEGER,
+            tx_drops INTEGER
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_traffic_samples_tunnel ON traffic_samples (tunnel_id, sampled_at)')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS latency_samples (
+            tunnel_id TEXT,
+            side TEXT,
+            sampled_at REAL,
+            rtt_ms REAL,
+            loss REAL
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_latency_samples_tunnel ON latency_samples (tunnel_id, sampled_at)')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS standby_servers (
+            tunnel_id TEXT,
+            slot INTEGER,
+            server_ip TEXT,
+            username TEXT,
+            password TEXT,
+            active INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (tunnel_id, slot)
+        )
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS failover_events (
+            tunnel_id TEXT,
+            happened_at REAL,
+            from_slot INTEGER,
+            to_slot INTEGER,
+            reason TEXT
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_failover_events_tunnel ON failover_events (tunnel_id, happened_at)')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS agents (
+            host TEXT PRIMARY KEY,
+            port INTEGER,
+            token TEXT,
+            installed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_seen REAL
+        )
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS alert_thresholds (
+            tunnel_id TEXT PRIMARY KEY,
+            loss REAL,
+            rtt REAL,
+            fails INTEGER,
+            muted INTEGER DEFAULT 0
+        )
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS alert_state (
+            tunnel_id TEXT,
+            side TEXT,
+            rule TEXT,
+            firing INTEGER DEFAULT 0,
+            bad_streak INTEGER DEFAULT 0,
+            good_streak INTEGER DEFAULT 0,
+            notified INTEGER DEFAULT 0,
+            changed_at REAL,
+            notified_at REAL,
+            last_sample_at REAL,
+            PRIMARY KEY (tunnel_id, side, rule)
+        )
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS fsm_state (
+            chat TEXT,
+            user TEXT,
+            state TEXT,
+            data TEXT,
+            bucket TEXT,
+            updated_at REAL,
+            PRIMARY KEY (chat, user)
+        )
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS leases (
+            name TEXT PRIMARY KEY,
+            owner TEXT,
+            expires_at REAL
+        )
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS ssh_rate (
+            user_id INTEGER PRIMARY KEY,
+            tokens REAL,
+            updated_at REAL
+        )
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS instances (
+            instance_id TEXT PRIMARY KEY,
+            started_at REAL,
+            heartbeat_at REAL
+        )
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS port_forwards (
+            tunnel_id TEXT,
+            protocol TEXT,
+            port_start INTEGER,
+            port_end INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (tunnel_id, protocol, port_start)
         )
     ''')
     conn.commit()
@@ -45,6 +715,61 @@ def init_db():
 
 init_db()
 
+TUNNELS_PAGE_SIZE = 8
+
+def fetch_tunnels_page(role, user_id, page):
+    conn = db_connect()
+    c = conn.cursor()
+    offset = page * TUNNELS_PAGE_SIZE
+    if role == 'admin':
+        c.execute('SELECT tunnel_id, tunnel_name, user_id FROM tunnels ORDER BY created_at DESC, tunnel_id DESC LIMIT ? OFFSET ?', (TUNNELS_PAGE_SIZE + 1, offset))
+    else:
+        c.execute('SELECT tunnel_id, tunnel_name, user_id FROM tunnels WHERE user_id = ? ORDER BY created_at DESC, tunnel_id DESC LIMIT ? OFFSET ?', (user_id, TUNNELS_PAGE_SIZE + 1, offset))
+    tunnels = c.fetchall()
+    conn.close()
+    return tunnels[:TUNNELS_PAGE_SIZE], len(tunnels) > TUNNELS_PAGE_SIZE
+
+SEARCH_RESULTS_LIMIT = 10
+
+def search_tunnels(query, role, user_id, limit=SEARCH_RESULTS_LIMIT):
+    query = query.strip()
+    if not query:
+        return []
+    upper = query + '\U0010ffff'
+    sql = '''
+        SELECT tunnel_id, tunnel_name, user_id, iran_server_ip, kharej_server_ip FROM tunnels
+        WHERE tunnel_id IN (
+            SELECT tunnel_id FROM tunnels WHERE tunnel_name >= ? COLLATE NOCASE AND tunnel_name < ? COLLATE NOCASE
+            UNION SELECT tunnel_id FROM tunnels WHERE iran_server_ip >= ? AND iran_server_ip < ?
+            UNION SELECT tunnel_id FROM tunnels WHERE kharej_server_ip >= ? AND kharej_server_ip < ?
+            UNION SELECT tunnel_id FROM tunnels WHERE user_id = ?
+        )
+    '''
+    params = [query, upper, query, upper, query, upper, int(query) if query.isdigit() else None]
+    if role != 'admin':
+        sql += ' AND user_id = ?'
+        params.append(user_id)
+    sql += ' ORDER BY created_at DESC, tunnel_id DESC LIMIT ?'
+    params.append(limit)
+    conn = db_connect()
+    c = conn.cursor()
+    c.execute(sql, params)
+    tunnels = c.fetchall()
+    conn.close()
+    return tunnels
+
+def get_tunnel(tunnel_id, role, user_id):
+    conn = db_connect()
+    conn.row_factory = sqlite3.Row
+    c = conn.cursor()
+    if role == 'admin':
+        c.execute('SELECT * FROM tunnels WHERE tunnel_id = ?', (tunnel_id,))
+    else:
+        c.execute('SELECT * FROM tunnels WHERE tunnel_id = ? AND user_id = ?', (tunnel_id, user_id))
+    tunnel = c.fetchone()
+    conn.close()
+    return dict(tunnel) if tunnel else None
+
 class ServerConfig(StatesGroup):
     MainMenu = State()
     TunnelMenu = State()
@@ -60,9 +785,8 @@ class ServerConfig(StatesGroup):
     PSK = State()
     MTU_6to4 = State()
     MTU_GRE = State()
+    QoS = State()
     CrontabHour = State()
-    SelectTunnel = State()
-    DeleteTunnel = State()
 
 def get_main_menu_keyboard():
     keyboard = ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
@@ -74,6 +798,7 @@ def get_main_menu_keyboard():
 def get_tunnel_menu_keyboard():
     keyboard = ReplyKeyboardMarkup(resize_keyboard=True, row_width=1)
     keyboard.add(KeyboardButton("🔗 تونل 1 ایران به 1 خارج"))
+    keyboard.add(KeyboardButton("🛡 تونل WireGuard ایران به خارج"))
     keyboard.add(KeyboardButton("⬅️ بازگشت به منوی اصلی"))
     return keyboard
 
@@ -82,6 +807,13 @@ def get_back_buttons():
     keyboard.add(KeyboardButton("⬅️ بازگشت به مرحله قبل"), KeyboardButton("🏠 بازگشت به منوی اصلی"))
     return keyboard
 
+def get_server_keyboard(servers):
+    keyboard = ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
+    for server in servers:
+        keyboard.add(KeyboardButton(server_button(server)))
+    keyboard.add(KeyboardButton("⬅️ بازگشت به مرحله قبل"), KeyboardButton("🏠 بازگشت به منوی اصلی"))
+    return keyboard
+
 def get_mtu_6to4_selection_keyboard():
     keyboard = InlineKeyboardMarkup(row_width=1)
     keyboard.add(InlineKeyboardButton("📏 پیش‌فرض (1480)", callback_data="mtu_6to4_default"))
@@ -90,14 +822,54 @@ def get_mtu_6to4_selection_keyboard():
     keyboard.add(InlineKeyboardButton("🏠 بازگشت به منوی اصلی", callback_data="back_to_main"))
     return keyboard
 
-def get_mtu_gre_selection_keyboard():
+def get_mtu_gre_selection_keyboard(mode="gre"):
+    default, back = (WG_DEFAULT_MTU, "back_to_kharej_ip") if mode == "wireguard" else ("1424", "back_to_mtu_6to4")
     keyboard = InlineKeyboardMarkup(row_width=1)
-    keyboard.add(InlineKeyboardButton("📏 پیش‌فرض (1424)", callback_data="mtu_gre_default"))
+    keyboard.add(InlineKeyboardButton(f"📏 پیش‌فرض ({default})", callback_data="mtu_gre_default"))
     keyboard.add(InlineKeyboardButton("✍️ وارد کردن دستی", callback_data="mtu_gre_manual"))
-    keyboard.add(InlineKeyboardButton("⬅️ بازگشت به مرحله قبل", callback_data="back_to_mtu_6to4"))
+    keyboard.add(InlineKeyboardButton("⬅️ بازگشت به مرحله قبل", callback_data=back))
     keyboard.add(InlineKeyboardButton("🏠 بازگشت به منوی اصلی", callback_data="back_to_main"))
     return keyboard
 
+def get_tunnel_picker_keyboard(action, tunnels, role, page, has_next, selected=()):
+    keyboard = InlineKeyboardMarkup(row_width=2)
+    for tunnel in tunnels:
+        tunnel_name = f"{tunnel[1]} (کاربر: {tunnel[2]})" if role == 'admin' else tunnel[1]
+        if action == "dsel":
+            mark = "✅" if tunnel[0] in selected else "⬜️"
+            keyboard.add(InlineKeyboardButton(f"{mark} {tunnel_name}", callback_data=f"dsel:{tunnel[0]}:{page}"))
+        else:
+            keyboard.add(InlineKeyboardButton(tunnel_name, callback_data=f"{action}:{tunnel[0]}"))
+    navigation = []
+    if page > 0:
+        navigation.append(InlineKeyboardButton("◀️ قبلی", callback_data=f"page:{action}:{page - 1}"))
+    if has_next:
+        navigation.append(InlineKeyboardButton("بعدی ▶️", callback_data=f"page:{action}:{page + 1}"))
+    if navigation:
+        keyboard.row(*navigation)
+    if action == "delete":
+        keyboard.add(InlineKeyboardButton("☑️ حذف چندتایی", callback_data=f"page:dsel:{page}"))
+    elif action == "dsel":
+        keyboard.row(
+            InlineKeyboardButton(f"🗑 حذف {len(selected)} تونل", callback_data="dbulk"),
+            InlineKeyboardButton("❌ انصراف", callback_data="dclear")
+        )
+    return keyboard
+
+def get_tunnel_actions_keyboard(tunnel_id):
+    keyboard = InlineKeyboardMarkup(row_width=1)
+    keyboard.add(InlineKeyboardButton("📈 نمودار تأخیر و ترافیک", callback_data=f"chart:{tunnel_id}"))
+    keyboard.add(InlineKeyboardButton("🧾 زمان‌بندی مراحل (JSON)", callback_data=f"trace:{tunnel_id}"))
+    keyboard.row(
+        InlineKeyboardButton("🔔 هشدارها", callback_data=f"tact:alerts:{tunnel_id}"),
+        InlineKeyboardButton("🛟 پشتیبان", callback_data=f"tact:standby:{tunnel_id}")
+    )
+    keyboard.row(
+        InlineKeyboardButton("🔀 فوروارد پورت", callback_data=f"tact:forward:{tunnel_id}"),
+        InlineKeyboardButton("🚦 QoS", callback_data=f"tact:qos:{tunnel_id}")
+    )
+    return keyboard
+
 def is_valid_crontab_hour(hour):
     try:
         hour = int(hour)
@@ -120,6 +892,11 @@ def check_user_access(user_id):
         return 'user'
     return None
 
+def parse_ping(output):
+    loss_match = re.search(r'([\d.]+)% packet loss', output)
+    rtt_match = re.search(r'rtt min/avg/max/mdev = [\d.]+/([\d.]+)/[\d.]+/[\d.]+ ms', output)
+    return (float(rtt_match.group(1)) if rtt_match else None, float(loss_match.group(1)) if loss_match else None)
+
 async def ping_ssh(host, username, password, target_ip, message, operation="بررسی وضعیت"):
     try:
         await bot.send_message(
@@ -129,8 +906,8 @@ async def ping_ssh(host, username, password, target_ip, message, operation="بر
         )
         
         command = f"ping -c 4 {target_ip}"
-        output = await execute_ssh_command(host, username, password, command)
-        print(f"خروجی پینگ در {host} به {target_ip}: {output}")
+        output = await execute_ssh_command(host, username, password, command, step="ping")
+        log_event(logging.DEBUG, "ping output", host=host, target=target_ip, output=tail_lines(output, 3))
 
         if not output:
             await bot.send_message(
@@ -141,10 +918,11 @@ async def ping_ssh(host, username, password, target_ip, message, operation="بر
             return {"status": "error", "rtt": "N/A", "error": "هیچ خروجی از پینگ دریافت نشد"}
 
         
-        packet_loss = re.search(r'(\d+)% packet loss', output)
-        if packet_loss and int(packet_loss.group(1)) == 0:
-            rtt_match = re.search(r'rtt min/avg/max/mdev = [\d.]+/([\d.]+)/[\d.]+/[\d.]+ ms', output)
-            rtt = rtt_match.group(1) if rtt_match else "N/A"
+        rtt_ms, loss = parse_ping(output)
+        if loss == 0:
+            rtt = f"{rtt_ms:g}" if rtt_ms is not None else "N/A"
+            if rtt_ms is not None:
+                observe("evara_ping_rtt_seconds", rtt_ms / 1000)
             await bot.send_message(
                 chat_id=message.chat.id,
                 text=escape_md(f"✅ پینگ موفق در {host} به {target_ip} (RTT: {rtt} ms)"),
@@ -160,7 +938,7 @@ async def ping_ssh(host, username, password, target_ip, message, operation="بر
             return {"status": "disconnected", "rtt": "N/A", "error": f"پکت‌ها از دست رفتند: {output}"}
     except Exception as e:
         error_msg = f"خطا در پینگ از {host} به {target_ip}: {str(e)}"
-        print(error_msg)
+        log_event(logging.WARNING, "ping failed", host=host, target=target_ip, error=str(e))
         await bot.send_message(
             chat_id=message.chat.id,
             text=escape_md(f"❌ {error_msg}"),
@@ -168,208 +946,512 @@ async def ping_ssh(host, username, password, target_ip, message, operation="بر
         )
         return {"status": "error", "rtt": "N/A", "error": str(e)}
 
-@dp.message_handler(commands=['start'])
-async def start_command(message: types.Message, state: FSMContext):
-    user_id = message.from_user.id
-    role = check_user_access(user_id)
-    if not role:
-        await bot.send_message(
-            chat_id=message.chat.id,
-            text=escape_md("❌ متأسفیم، شما دسترسی استفاده از این ربات را ندارید. لطفاً با مدیر تماس بگیرید."),
-            parse_mode="MarkdownV2"
+def format_ping_status(ping):
+    if ping["status"] == "connected":
+        rtt_text = f"(زمان پاسخ: {ping['rtt']} ms)"
+        return f"   ✅ *وصل است* {escape_md(rtt_text)}\n"
+    elif ping["status"] == "disconnected":
+        return f"   ❌ *قطع است* {escape_md('(پاسخی دریافت نشد)')}\n"
+    return f"   ⚠️ *خطا:* {escape_md(ping['error'])}\n"
+
+TRAFFIC_INTERVAL = getattr(config, 'TRAFFIC_INTERVAL', 300)
+TRAFFIC_RETENTION_DAYS = getattr(config, 'TRAFFIC_RETENTION_DAYS', 30)
+TRAFFIC_CONCURRENCY = getattr(config, 'TRAFFIC_CONCURRENCY', 10)
+TRAFFIC_FIELDS = ("rx_bytes", "rx_packets", "rx_errors", "rx_drops", "tx_bytes", "tx_packets", "tx_errors", "tx_drops")
+TRAFFIC_COLUMNS = (0, 1, 2, 3, 8, 9, 10, 11)
+TUNNEL_MODES = {
+    "gre": "6to4 + GRE + IPsec",
+    "wireguard": "WireGuard"
+}
+TUNNEL_INTERFACES = {
+    "gre": {"iran": ("GRE6Tun_To_IR", "6to4_To_IR"), "kharej": ("GRE6Tun_To_KH", "6to4_To_KH")},
+    "wireguard": {"iran": ("WG_To_IR",), "kharej": ("WG_To_KH",)}
+}
+GRE_PEERS = {
+    "iran": "172.20.40.2",
+    "kharej": "172.20.40.1"
+}
+PING_MARKER = "__EVARA_PING__"
+SIDE_LABELS = {
+    "iran": "ایران",
+    "kharej": "خارج"
+}
+
+def parse_net_dev(output):
+    counters = {}
+    for line in output.splitlines():
+        name, sep, values = line.partition(":")
+        fields = values.split()
+        if sep and len(fields) >= 16:
+            counters[name.strip()] = {field: int(fields[column]) for field, column in zip(TRAFFIC_FIELDS, TRAFFIC_COLUMNS)}
+    return counters
+
+def counter_delta(old, new):
+    if new >= old:
+        return new - old
+    if 2 ** 31 <= old < 2 ** 32:
+        return new + 2 ** 32 - old
+    # the interface was recreated or the server rebooted, so the counter restarted from zero
+    return new
+
+def record_traffic(tunnel_id, side, interface, sampled_at, counters):
+    conn = db_connect()
+    c = conn.cursor()
+    c.execute(f'SELECT sampled_at, {", ".join(TRAFFIC_FIELDS)} FROM traffic_counters WHERE tunnel_id = ? AND side = ? AND interface = ?', (tunnel_id, side, interface))
+    previous = c.fetchone()
+    if previous and sampled_at > previous[0]:
+        deltas = [counter_delta(old, counters[field]) for field, old in zip(TRAFFIC_FIELDS, previous[1:])]
+        c.execute(
+            f'INSERT INTO traffic_samples (tunnel_id, side, interface, sampled_at, interval, {", ".join(TRAFFIC_FIELDS)}) VALUES (?, ?, ?, ?, ?, {", ".join("?" * len(TRAFFIC_FIELDS))})',
+            [tunnel_id, side, interface, sampled_at, sampled_at - previous[0]] + deltas
         )
-        return
-    
-    welcome_msg = (
-        escape_md("به ربات تانل اوارا خوش اومدی 😍\n") +
-        escape_md("  عضو چنل ما بشین : ") +
-        "[@evara_tu](https://t.me/evara_tu)"
+    c.execute(
+        f'INSERT OR REPLACE INTO traffic_counters (tunnel_id, side, interface, sampled_at, {", ".join(TRAFFIC_FIELDS)}) VALUES (?, ?, ?, ?, {", ".join("?" * len(TRAFFIC_FIELDS))})',
+        [tunnel_id, side, interface, sampled_at] + [counters[field] for field in TRAFFIC_FIELDS]
     )
-    try:
-        await bot.send_message(
-            chat_id=message.chat.id,
-            text=welcome_msg,
-            reply_markup=get_main_menu_keyboard(),
-            parse_mode="MarkdownV2"
-        )
-    except Exception as e:
-        await bot.send_message(
-            chat_id=message.chat.id,
-            text=escape_md(f"به ربات تانل اوارا خوش اومدی 😍\n"
-        " عضو چنل ما بشین: کانال تلگرام پشتیبانی:https://t.me/amirkohr   (https://t.me/evara_tu) /start"),
-            reply_markup=get_main_menu_keyboard(),
-            parse_mode="MarkdownV2"
-        )
-    await ServerConfig.MainMenu.set()
+    conn.commit()
+    conn.close()
 
-@dp.message_handler(state=ServerConfig.MainMenu)
-async def main_menu(message: types.Message, state: FSMContext):
-    user_id = message.from_user.id
-    role = check_user_access(user_id)
-    if not role:
-        await bot.send_message(
-            chat_id=message.chat.id,
-            text=escape_md("❌ دسترسی غیرمجاز! لطفاً دوباره وارد شوید."),
-            parse_mode="MarkdownV2"
-        )
-        await state.finish()
+def record_latency(tunnel_id, side, sampled_at, rtt_ms, loss):
+    conn = db_connect()
+    c = conn.cursor()
+    c.execute('INSERT INTO latency_samples (tunnel_id, side, sampled_at, rtt_ms, loss) VALUES (?, ?, ?, ?, ?)', (tunnel_id, side, sampled_at, rtt_ms, loss))
+    conn.commit()
+    conn.close()
+
+def prune_traffic():
+    conn = db_connect()
+    c = conn.cursor()
+    c.execute('DELETE FROM traffic_samples WHERE sampled_at < ?', (time.time() - TRAFFIC_RETENTION_DAYS * 86400,))
+    c.execute('DELETE FROM latency_samples WHERE sampled_at < ?', (time.time() - TRAFFIC_RETENTION_DAYS * 86400,))
+    conn.commit()
+    conn.close()
+
+def list_traffic_targets():
+    conn = db_connect()
+    c = conn.cursor()
+    c.execute('SELECT tunnel_id, iran_server_ip, iran_username, iran_password, kharej_server_ip, kharej_username, kharej_password, tunnel_mode FROM tunnels')
+    rows = c.fetchall()
+    conn.close()
+    servers = {}
+    for row in rows:
+        for side, (host, username, password) in (("iran", row[1:4]), ("kharej", row[4:7])):
+            server = servers.setdefault(host, {"host": host, "username": username, "password": password, "tunnels": []})
+            server["tunnels"].append((row[0], side, row[7]))
+    return list(servers.values())
+
+def traffic_command(server):
+    command = "cat /proc/net/dev"
+    for side in sorted({side for _, side, _ in server["tunnels"]}):
+        command += f"; echo {PING_MARKER} {side}; ping -c 3 -W 1 -q {GRE_PEERS[side]}"
+    return command + "; true"
+
+async def collect_server_traffic(server, semaphore):
+    async with semaphore:
+        status = await fetch_agent_status(server['host'])
+        if status:
+            record_agent_traffic(server, status)
+            return
+        result = await stream_ssh_command(server['host'], server['username'], server['password'], traffic_command(server), timeout=COMMAND_TIMEOUTS["short"], step="traffic")
+    sampled_at = time.time()
+    if result["error"] or result["exit_status"] != 0:
+        log_event(logging.INFO, "traffic collection failed", host=server['host'], error=result["error"] or tail_lines(result["stderr"], 3))
+        for tunnel_id, side, _ in server["tunnels"]:
+            record_latency(tunnel_id, side, sampled_at, None, None)
         return
+    sections = result["stdout"].split(PING_MARKER)
+    counters = parse_net_dev(sections[0])
+    pings = {}
+    for section in sections[1:]:
+        side, _, output = section.strip().partition("\n")
+        pings[side] = parse_ping(output)
+    for tunnel_id, side, mode in server["tunnels"]:
+        for interface in TUNNEL_INTERFACES[mode][side]:
+            if interface in counters:
+                record_traffic(tunnel_id, side, interface, sampled_at, counters[interface])
+        # no ping summary means the peer was unreachable (e.g. the GRE interface is gone); stored as a failed probe
+        rtt_ms, loss = pings.get(side, (None, None))
+        record_latency(tunnel_id, side, sampled_at, rtt_ms, loss)
 
-    if message.text == "🚀 ساخت تونل جدید":
-        await state.update_data(tunnel_id=str(uuid.uuid4()), user_id=user_id)
-        await bot.send_message(
-            chat_id=message.chat.id,
-            text=escape_md("✨ لطفاً یک نام برای تونل جدید وارد کنید:"),
-            reply_markup=get_back_buttons(),
-            parse_mode="MarkdownV2"
-        )
-        await ServerConfig.TunnelName.set()
-    elif message.text == "📊 بررسی وضعیت تونل‌ها":
-        conn = sqlite3.connect('tunnels.db')
-        c = conn.cursor()
-        if role == 'admin':
-            c.execute('SELECT tunnel_id, tunnel_name, user_id FROM tunnels ORDER BY created_at DESC')
-        else:
-            c.execute('SELECT tunnel_id, tunnel_name, user_id FROM tunnels WHERE user_id = ? ORDER BY created_at DESC', (user_id,))
-        tunnels = c.fetchall()
-        conn.close()
-        
-        if not tunnels:
-            await bot.send_message(
-                chat_id=message.chat.id,
-                text=escape_md("⚠️ هیچ تونلی یافت نشد!"),
-                reply_markup=get_main_menu_keyboard(),
-                parse_mode="MarkdownV2"
-            )
-            await ServerConfig.MainMenu.set()
-        else:
-            keyboard = ReplyKeyboardMarkup(resize_keyboard=True, row_width=1)
-            for tunnel in tunnels:
-                tunnel_name = f"{tunnel[1]} (کاربر: {tunnel[2]})" if role == 'admin' else tunnel[1]
-                keyboard.add(KeyboardButton(tunnel_name))
-            keyboard.add(KeyboardButton("⬅️ بازگشت به منوی اصلی"))
-            await bot.send_message(
-                chat_id=message.chat.id,
-                text=escape_md("🔍 لطفاً تونل موردنظر را برای بررسی انتخاب کنید:"),
-                reply_markup=keyboard,
-                parse_mode="MarkdownV2"
-            )
-            await ServerConfig.SelectTunnel.set()
-    elif message.text == "🗑 حذف تونل":
-        conn = sqlite3.connect('tunnels.db')
-        c = conn.cursor()
-        if role == 'admin':
-            c.execute('SELECT tunnel_id, tunnel_name, user_id FROM tunnels ORDER BY created_at DESC')
-        else:
-            c.execute('SELECT tunnel_id, tunnel_name, user_id FROM tunnels WHERE user_id = ? ORDER BY created_at DESC', (user_id,))
-        tunnels = c.fetchall()
-        conn.close()
-        
-        if not tunnels:
-            await bot.send_message(
-                chat_id=message.chat.id,
-                text=escape_md("⚠️ هیچ تونلی برای حذف یافت نشد!"),
-                reply_markup=get_main_menu_keyboard(),
-                parse_mode="MarkdownV2"
-            )
-            await ServerConfig.MainMenu.set()
-        else:
-            keyboard = ReplyKeyboardMarkup(resize_keyboard=True, row_width=1)
-            for tunnel in tunnels:
-                tunnel_name = f"{tunnel[1]} (کاربر: {tunnel[2]})" if role == 'admin' else tunnel[1]
-                keyboard.add(KeyboardButton(tunnel_name))
-            keyboard.add(KeyboardButton("⬅️ بازگشت به منوی اصلی"))
-            await bot.send_message(
-                chat_id=message.chat.id,
-                text=escape_md("🗑 لطفاً تونل موردنظر را برای حذف انتخاب کنید:"),
-                reply_markup=keyboard,
-                parse_mode="MarkdownV2"
-            )
-            await ServerConfig.DeleteTunnel.set()
+async def traffic_collector():
+    semaphore = asyncio.Semaphore(TRAFFIC_CONCURRENCY)
+    while True:
+        started = time.monotonic()
+        if not IS_LEADER:
+            # one instance samples the counters; the others would only double the SSH load and the alerts
+            await asyncio.sleep(TRAFFIC_INTERVAL)
+            continue
+        try:
+            servers = list_traffic_targets()
+            await asyncio.gather(*[collect_server_traffic(server, semaphore) for server in servers])
+            prune_traffic()
+            if ALERTS_ENABLED:
+                await evaluate_alerts()
+            log_event(logging.DEBUG, "traffic collected", servers=len(servers), duration=time.monotonic() - started)
+        except Exception as e:
+            log_event(logging.WARNING, "traffic collector failed", error=str(e))
+        await asyncio.sleep(max(TRAFFIC_INTERVAL - (time.monotonic() - started), 1))
+
+ALERTS_ENABLED = getattr(config, 'ALERTS_ENABLED', True)
+ALERT_DEFAULTS = {
+    "loss": getattr(config, 'ALERT_LOSS_PCT', 20),
+    "rtt": getattr(config, 'ALERT_RTT_FACTOR', 2.0),
+    "fails": getattr(config, 'ALERT_FAILURES', 3)
+}
+ALERT_RTT_MIN_JUMP_MS = getattr(config, 'ALERT_RTT_MIN_JUMP_MS', 30)
+ALERT_TRIGGER_PROBES = getattr(config, 'ALERT_TRIGGER_PROBES', 2)
+ALERT_CLEAR_PROBES = getattr(config, 'ALERT_CLEAR_PROBES', 3)
+ALERT_COOLDOWN = getattr(config, 'ALERT_COOLDOWN', 1800)
+ALERT_BASELINE_WINDOW = getattr(config, 'ALERT_BASELINE_WINDOW', 86400)
+ALERT_BASELINE_MIN_SAMPLES = 6
+ALERT_RULES = {
+    "down": "قطعی تونل",
+    "loss": "از دست رفتن بسته",
+    "rtt": "افزایش تأخیر"
+}
+
+def get_alert_thresholds(tunnel_id):
+    conn = db_connect()
+    c = conn.cursor()
+    c.execute('SELECT loss, rtt, fails, muted FROM alert_thresholds WHERE tunnel_id = ?', (tunnel_id,))
+    row = c.fetchone()
+    conn.close()
+    thresholds = dict(ALERT_DEFAULTS, muted=False)
+    if row:
+        for key, value in zip(("loss", "rtt", "fails"), row[:3]):
+            if value is not None:
+                thresholds[key] = value
+        thresholds["muted"] = bool(row[3])
+    return thresholds
+
+def set_alert_thresholds(tunnel_id, **values):
+    conn = db_connect()
+    c = conn.cursor()
+    c.execute('INSERT OR IGNORE INTO alert_thresholds (tunnel_id) VALUES (?)', (tunnel_id,))
+    for key, value in values.items():
+        c.execute(f'UPDATE alert_thresholds SET {key} = ? WHERE tunnel_id = ?', (value, tunnel_id))
+    conn.commit()
+    conn.close()
+
+def rtt_baseline(c, tunnel_id, side, before):
+    c.execute(
+        'SELECT rtt_ms FROM latency_samples WHERE tunnel_id = ? AND side = ? AND sampled_at < ? AND sampled_at >= ? AND rtt_ms IS NOT NULL ORDER BY rtt_ms',
+        (tunnel_id, side, before, before - ALERT_BASELINE_WINDOW)
+    )
+    values = [row[0] for row in c.fetchall()]
+    return values[len(values) // 2] if len(values) >= ALERT_BASELINE_MIN_SAMPLES else None
+
+def classify_probe(rule, rtt_ms, loss, baseline, thresholds):
+    # None means the probe says nothing about this rule, so its streaks are left alone
+    failed = loss is None or loss >= 100
+    if rule == "down":
+        return failed
+    if failed:
+        return None
+    if rule == "loss":
+        return loss >= thresholds["loss"]
+    if rtt_ms is None or baseline is None:
+        return None
+    return rtt_ms > baseline * thresholds["rtt"] and rtt_ms - baseline >= ALERT_RTT_MIN_JUMP_MS
+
+def advance_alert(state, bad, sampled_at, thresholds):
+    if bad is None:
+        return None
+    if bad:
+        state["bad_streak"] += 1
+        state["good_streak"] = 0
+    else:
+        state["good_streak"] += 1
+        state["bad_streak"] = 0
+    needed = thresholds["fails"] if state["rule"] == "down" else ALERT_TRIGGER_PROBES
+    if not state["firing"] and state["bad_streak"] >= needed:
+        state["firing"] = 1
+        state["changed_at"] = sampled_at
+        # a link that keeps flapping only gets one firing/recovery pair per cooldown
+        state["notified"] = int(not thresholds["muted"] and sampled_at - (state["notified_at"] or 0) >= ALERT_COOLDOWN)
+        if state["notified"]:
+            state["notified_at"] = sampled_at
+            return "firing"
+    elif state["firing"] and state["good_streak"] >= ALERT_CLEAR_PROBES:
+        state["firing"] = 0
+        state["changed_at"] = sampled_at
+        if state["notified"]:
+            return "resolved"
+    return None
+
+def format_alert(tunnel, side, rule, transition, rtt_ms, loss, baseline, thresholds):
+    target = f"{ALERT_RULES[rule]} در سمت {SIDE_LABELS[side]}"
+    if transition == "resolved":
+        return f"✅ برطرف شد: {target}"
+    if rule == "down":
+        detail = f"{thresholds['fails']} بررسی پیاپی بدون پاسخ"
+    elif rule == "loss":
+        detail = f"{loss:g}% (آستانه {thresholds['loss']:g}%)"
+    else:
+        detail = f"{rtt_ms:g} ms در برابر میانگین معمول {baseline:g} ms"
+    return f"🚨 {target}: {detail}"
+
+async def send_alert(tunnel, lines):
+    text = escape_md(f"🔔 هشدار تونل '{tunnel['tunnel_name']}':\n\n" + "\n".join(lines))
+    for chat_id in dict.fromkeys((tunnel['user_id'], ADMIN_ID)):
+        try:
+            await bot.send_message(chat_id=chat_id, text=text, parse_mode="MarkdownV2")
+        except Exception as e:
+            log_event(logging.WARNING, "alert delivery failed", chat_id=chat_id, tunnel_id=tunnel['tunnel_id'], error=str(e))
+    inc("evara_alerts_sent", len(lines))
+
+async def evaluate_alerts():
+    conn = db_connect()
+    conn.row_factory = sqlite3.Row
+    c = conn.cursor()
+    c.execute('SELECT tunnel_id, tunnel_name, user_id FROM tunnels')
+    tunnels = [dict(row) for row in c.fetchall()]
+    c.execute('SELECT * FROM alert_state')
+    states = {(row['tunnel_id'], row['side'], row['rule']): dict(row) for row in c.fetchall()}
+    notices = {}
+    for tunnel in tunnels:
+        thresholds = get_alert_thresholds(tunnel['tunnel_id'])
+        for side in SIDE_LABELS:
+            side_states = [states.setdefault((tunnel['tunnel_id'], side, rule), {
+                "tunnel_id": tunnel['tunnel_id'], "side": side, "rule": rule, "firing": 0, "bad_streak": 0, "good_streak": 0,
+                "notified": 0, "changed_at": None, "notified_at": None, "last_sample_at": None
+            }) for rule in ALERT_RULES]
+            # a tunnel seen for the first time is judged from the latest collection pass only, not from old history
+            since = max(state["last_sample_at"] or 0 for state in side_states) or time.time() - TRAFFIC_INTERVAL
+            c.execute('SELECT sampled_at, rtt_ms, loss FROM latency_samples WHERE tunnel_id = ? AND side = ? AND sampled_at > ? ORDER BY sampled_at', (tunnel['tunnel_id'], side, since))
+            for sampled_at, rtt_ms, loss in c.fetchall():
+                baseline = rtt_baseline(conn.cursor(), tunnel['tunnel_id'], side, sampled_at)
+                for state in side_states:
+                    state["last_sample_at"] = sampled_at
+                    transition = advance_alert(state, classify_probe(state["rule"], rtt_ms, loss, baseline, thresholds), sampled_at, thresholds)
+                    if transition:
+                        notices.setdefault(tunnel['tunnel_id'], (tunnel, []))[1].append(format_alert(tunnel, side, state["rule"], transition, rtt_ms, loss, baseline, thresholds))
+    c.executemany('''
+        INSERT OR REPLACE INTO alert_state (tunnel_id, side, rule, firing, bad_streak, good_streak, notified, changed_at, notified_at, last_sample_at)
+        VALUES (:tunnel_id, :side, :rule, :firing, :bad_streak, :good_streak, :notified, :changed_at, :notified_at, :last_sample_at)
+    ''', [state for state in states.values() if state["last_sample_at"] is not None])
+    conn.commit()
+    conn.close()
+    set_gauge("evara_alerts_firing", sum(state["firing"] for state in states.values()))
+    for tunnel, lines in notices.values():
+        await send_alert(tunnel, lines)
+
+TUNNEL_COMMAND_PENDING_LIMIT = 10
+
+def find_tunnels_by_name(name, role, user_id):
+    conn = db_connect()
+    c = conn.cursor()
+    if role == 'admin':
+        c.execute('SELECT tunnel_id, tunnel_name, user_id, iran_server_ip, kharej_server_ip FROM tunnels WHERE tunnel_name = ? COLLATE NOCASE ORDER BY created_at', (name,))
     else:
+        c.execute('SELECT tunnel_id, tunnel_name, user_id, iran_server_ip, kharej_server_ip FROM tunnels WHERE tunnel_name = ? COLLATE NOCASE AND user_id = ? ORDER BY created_at', (name, user_id))
+    tunnels = [(row[0], f"{row[1]} ({row[3]} ⇄ {row[4]})", row[2]) for row in c.fetchall()]
+    conn.close()
+    return tunnels
+
+def format_alert_thresholds(tunnel_name, thresholds):
+    status = "خاموش 🔕" if thresholds["muted"] else "روشن 🔔"
+    return (
+        f"🔔 هشدارهای تونل '{tunnel_name}': {status}\n"
+        f"• از دست رفتن بسته: بیشتر از {thresholds['loss']:g}%\n"
+        f"• تأخیر: بیشتر از {thresholds['rtt']:g} برابر میانگین معمول\n"
+        f"• قطعی: {thresholds['fails']} بررسی پیاپی بدون پاسخ"
+    )
+
+def traffic_summary(tunnel_id, window=86400):
+    conn = db_connect()
+    c = conn.cursor()
+    c.execute('''
+        SELECT side, interface, rx_bytes, tx_bytes, interval, rx_errors + tx_errors, rx_drops + tx_drops FROM traffic_samples
+        WHERE tunnel_id = ? AND sampled_at = (
+            SELECT MAX(sampled_at) FROM traffic_samples latest WHERE latest.tunnel_id = traffic_samples.tunnel_id AND latest.side = traffic_samples.side AND latest.interface = traffic_samples.interface
+        )
+    ''', (tunnel_id,))
+    current = {(row[0], row[1]): row[2:] for row in c.fetchall()}
+    c.execute('''
+        SELECT side, interface, SUM(rx_bytes), SUM(tx_bytes), SUM(interval), SUM(rx_errors + tx_errors), SUM(rx_drops + tx_drops) FROM traffic_samples
+        WHERE tunnel_id = ? AND sampled_at >= ? GROUP BY side, interface
+    ''', (tunnel_id, time.time() - window))
+    average = {(row[0], row[1]): row[2:] for row in c.fetchall()}
+    conn.close()
+    return current, average
+
+def mbps(byte_count, seconds):
+    return byte_count * 8 / seconds / 1e6 if seconds else 0.0
+
+def format_traffic_status(tunnel_id, mode):
+    current, average = traffic_summary(tunnel_id)
+    response = f"📶 *ترافیک تونل {escape_md(TUNNEL_MODES[mode])}:*\n"
+    if not current:
+        return response + f"   {escape_md('هنوز داده‌ای جمع‌آوری نشده است.')}\n"
+    for side, interfaces in TUNNEL_INTERFACES[mode].items():
+        key = (side, interfaces[0])
+        if key not in current:
+            continue
+        rx, tx, interval, _, _ = current[key]
+        avg_rx, avg_tx, avg_interval, errors, drops = average.get(key, (0, 0, 0, 0, 0))
+        line = f"{SIDE_LABELS[side]}: اکنون ⬇️ {mbps(rx, interval):.2f} / ⬆️ {mbps(tx, interval):.2f} Mbps، میانگین 24 ساعت ⬇️ {mbps(avg_rx, avg_interval):.2f} / ⬆️ {mbps(avg_tx, avg_interval):.2f} Mbps"
+        if errors or drops:
+            line += f" (خطا: {errors}، دراپ: {drops})"
+        response += f"   {escape_md(line)}\n"
+    return response
+
+CHART_WINDOWS = {
+    "1h": ("1 ساعت", 3600),
+    "6h": ("6 ساعت", 6 * 3600),
+    "24h": ("24 ساعت", 86400),
+    "7d": ("7 روز", 7 * 86400)
+}
+CHART_CACHE_SIZE = getattr(config, 'CHART_CACHE_SIZE', 64)
+CHART_CACHE = OrderedDict()
+CHART_RENDERS = {}
+# one thread is enough for a handful of PNGs and keeps rendering from competing with the SSH pumps in the default executor
+chart_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="chart")
+
+def last_sample_time(tunnel_id):
+    conn = db_connect()
+    c = conn.cursor()
+    c.execute('''
+        SELECT MAX(sampled_at) FROM (
+            SELECT MAX(sampled_at) AS sampled_at FROM traffic_samples WHERE tunnel_id = ?
+            UNION ALL SELECT MAX(sampled_at) FROM latency_samples WHERE tunnel_id = ?
+        )
+    ''', (tunnel_id, tunnel_id))
+    row = c.fetchone()
+    conn.close()
+    return row[0]
+
+def load_chart_data(tunnel_id, mode, window):
+    since = time.time() - window
+    conn = db_connect()
+    c = conn.cursor()
+    c.execute('SELECT side, sampled_at, rtt_ms, loss FROM latency_samples WHERE tunnel_id = ? AND sampled_at >= ? ORDER BY sampled_at', (tunnel_id, since))
+    latency = c.fetchall()
+    c.execute(
+        'SELECT side, sampled_at, rx_bytes, tx_bytes, interval FROM traffic_samples WHERE tunnel_id = ? AND interface IN (?, ?) AND sampled_at >= ? ORDER BY sampled_at',
+        (tunnel_id, TUNNEL_INTERFACES[mode]["iran"][0], TUNNEL_INTERFACES[mode]["kharej"][0], since)
+    )
+    traffic = c.fetchall()
+    conn.close()
+    data = {side: {"latency": [], "traffic": []} for side in SIDE_LABELS}
+    for side, sampled_at, rtt_ms, loss in latency:
+        data[side]["latency"].append((datetime.fromtimestamp(sampled_at), rtt_ms, loss))
+    for side, sampled_at, rx, tx, interval in traffic:
+        data[side]["traffic"].append((datetime.fromtimestamp(sampled_at), mbps(rx, interval), mbps(tx, interval)))
+    return data
+
+def render_chart(tunnel_name, window_key, data):
+    figure = Figure(figsize=(9, 8), dpi=100)
+    rtt_axis, loss_axis, traffic_axis = figure.subplots(3, 1, sharex=True)
+    for side, series in data.items():
+        if series["latency"]:
+            times, rtts, losses = zip(*series["latency"])
+            rtt_axis.plot(times, [float("nan") if rtt is None else rtt for rtt in rtts], label=side, marker=".")
+            loss_axis.plot(times, [100 if loss is None else loss for loss in losses], label=side, marker=".")
+        if series["traffic"]:
+            times, rx, tx = zip(*series["traffic"])
+            traffic_axis.plot(times, rx, label=f"{side} rx")
+            traffic_axis.plot(times, tx, label=f"{side} tx", linestyle="--")
+    rtt_axis.set_ylabel("RTT (ms)")
+    loss_axis.set_ylabel("loss (%)")
+    loss_axis.set_ylim(0, 100)
+    traffic_axis.set_ylabel("Mbps")
+    for axis in (rtt_axis, loss_axis, traffic_axis):
+        axis.grid(alpha=0.3)
+        if axis.has_data():
+            axis.legend(loc="upper left", fontsize="small")
+    figure.suptitle(f"{tunnel_name} - {window_key}")
+    figure.autofmt_xdate()
+    buffer = io.BytesIO()
+    figure.savefig(buffer, format="png")
+    return buffer.getvalue()
+
+async def get_tunnel_chart(tunnel, window_key):
+    last_sample = last_sample_time(tunnel['tunnel_id'])
+    if last_sample is None:
+        return None
+    key = (tunnel['tunnel_id'], window_key, last_sample)
+    if key in CHART_CACHE:
+        CHART_CACHE.move_to_end(key)
+        inc("evara_chart_cache", result="hit")
+        return CHART_CACHE[key]
+    if key not in CHART_RENDERS:
+        inc("evara_chart_cache", result="miss")
+        label, window = CHART_WINDOWS[window_key]
+        data = load_chart_data(tunnel['tunnel_id'], tunnel['tunnel_mode'], window)
+        started = time.monotonic()
+        CHART_RENDERS[key] = asyncio.get_running_loop().run_in_executor(chart_executor, render_chart, tunnel['tunnel_name'], window_key, data)
+        try:
+            image = await CHART_RENDERS[key]
+        finally:
+            del CHART_RENDERS[key]
+        observe("evara_chart_render_seconds", time.monotonic() - started)
+        CHART_CACHE[key] = image
+        while len(CHART_CACHE) > CHART_CACHE_SIZE:
+            CHART_CACHE.popitem(last=False)
+        return image
+    inc("evara_chart_cache", result="shared")
+    return await asyncio.shield(CHART_RENDERS[key])
+
+def get_chart_windows_keyboard(tunnel_id):
+    keyboard = InlineKeyboardMarkup(row_width=len(CHART_WINDOWS))
+    keyboard.add(*[InlineKeyboardButton(label, callback_data=f"chartw:{tunnel_id}:{key}") for key, (label, _) in CHART_WINDOWS.items()])
+    return keyboard
+
+async def send_tunnel_picker(chat_id, role, user_id, action):
+    tunnels, has_next = fetch_tunnels_page(role, user_id, 0)
+    if not tunnels:
         await bot.send_message(
-            chat_id=message.chat.id,
-            text=escape_md(
-        "به ربات تانل اوارا خوش اومدی 😍\n"
-        "برای حمایت از ما به پروژه داخل [GitHub] (https://github.com/evara/tunnel)  ستاره بدین و عضو چنل ما بشین: کانال تلگرام (https://t.me/evara_tu) "),
+            chat_id=chat_id,
+            text=escape_md("⚠️ هیچ تونلی یافت نشد!" if action == "status" else "⚠️ هیچ تونلی برای حذف یافت نشد!"),
             reply_markup=get_main_menu_keyboard(),
             parse_mode="MarkdownV2"
         )
+        return
+    prompt = "🔍 لطفاً تونل موردنظر را برای بررسی انتخاب کنید:" if action == "status" else "🗑 لطفاً تونل موردنظر را برای حذف انتخاب کنید:"
+    await bot.send_message(
+        chat_id=chat_id,
+        text=escape_md(prompt),
+        reply_markup=get_tunnel_picker_keyboard(action, tunnels, role, 0, has_next),
+        parse_mode="MarkdownV2"
+    )
 
-@dp.message_handler(state=ServerConfig.SelectTunnel)
-async def select_tunnel(message: types.Message, state: FSMContext):
+@dp.message_handler(commands=['start'])
+async def start_command(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
     role = check_user_access(user_id)
     if not role:
         await bot.send_message(
             chat_id=message.chat.id,
-            text=escape_md("❌ دسترسی غیرمجاز!"),
+            text=escape_md("❌ متأسفیم، شما دسترسی استفاده از این ربات را ندارید. لطفاً با مدیر تماس بگیرید."),
             parse_mode="MarkdownV2"
         )
-        await state.finish()
         return
     
-    if message.text == "⬅️ بازگشت به منوی اصلی":
-        await back_to_main_menu(message, state)
-        return
-    
-    tunnel_name = message.text.split(" (کاربر:")[0]
-    conn = sqlite3.connect('tunnels.db')
-    c = conn.cursor()
-    if role == 'admin':
-        c.execute('SELECT tunnel_id, iran_server_ip, iran_username, iran_password, kharej_server_ip, kharej_username, kharej_password, iran_ipv6, kharej_ipv6, user_id FROM tunnels WHERE tunnel_name = ?', (tunnel_name,))
-    else:
-        c.execute('SELECT tunnel_id, iran_server_ip, iran_username, iran_password, kharej_server_ip, kharej_username, kharej_password, iran_ipv6, kharej_ipv6, user_id FROM tunnels WHERE tunnel_name = ? AND user_id = ?', (tunnel_name, user_id))
-    tunnel = c.fetchone()
-    conn.close()
-    
-    if not tunnel:
+    welcome_msg = (
+        escape_md("به ربات تانل اوارا خوش اومدی 😍\n") +
+        escape_md("  عضو چنل ما بشین : ") +
+        "[@evara_tu](https://t.me/evara_tu)"
+    )
+    try:
         await bot.send_message(
             chat_id=message.chat.id,
-            text=escape_md("⚠️ تونل با این نام یافت نشد یا متعلق به شما نیست!"),
+            text=welcome_msg,
+            reply_markup=get_main_menu_keyboard(),
+            parse_mode="MarkdownV2"
+        )
+    except Exception as e:
+        await bot.send_message(
+            chat_id=message.chat.id,
+            text=escape_md(f"به ربات تانل اوارا خوش اومدی 😍\n"
+        " عضو چنل ما بشین: کانال تلگرام پشتیبانی:https://t.me/amirkohr   (https://t.me/evara_tu) /start"),
             reply_markup=get_main_menu_keyboard(),
             parse_mode="MarkdownV2"
         )
-        await ServerConfig.MainMenu.set()
-        return
-    
-    tunnel_id, iran_server_ip, iran_username, iran_password, kharej_server_ip, kharej_username, kharej_password, iran_ipv6, kharej_ipv6, tunnel_user_id = tunnel
-    
-    iran_gre_ip = "172.20.40.1"
-    kharej_gre_ip = "172.20.40.2"
-    
-    iran_ping = await ping_ssh(iran_server_ip, iran_username, iran_password, kharej_gre_ip, message, "بررسی وضعیت تونل ایران")
-    kharej_ping = await ping_ssh(kharej_server_ip, kharej_username, kharej_password, iran_gre_ip, message, "بررسی وضعیت تونل خارج")
-    
-    response = f"📊 *وضعیت تونل '{escape_md(tunnel_name)}'* 📊\n\n"
-    if role == 'admin':
-        response += f"👤 *کاربر:* {tunnel_user_id}\n"
-    response += f"🌍 *سرور ایران ({escape_md(iran_gre_ip)}):*\n"
-    if iran_ping["status"] == "connected":
-        response += f"   ✅ *وصل است* (زمان پاسخ: {iran_ping['rtt']} ms)\n"
-    elif iran_ping["status"] == "disconnected":
-        response += "   ❌ *قطع است* (پاسخی دریافت نشد)\n"
-    else:
-        response += f"   ⚠️ *خطا:* {escape_md(iran_ping['error'])}\n"
-    
-    response += f"🌎 *سرور خارج ({escape_md(kharej_gre_ip)}):*\n"
-    if kharej_ping["status"] == "connected":
-        response += f"   ✅ *وصل است* (زمان پاسخ: {kharej_ping['rtt']} ms)\n"
-    elif kharej_ping["status"] == "disconnected":
-        response += "   ❌ *قطع است* (پاسخی دریافت نشد)\n"
-    else:
-        response += f"   ⚠️ *خطا:* {escape_md(kharej_ping['error'])}\n"
-    
-    await bot.send_message(
-        chat_id=message.chat.id,
-        text=response,
-        reply_markup=get_main_menu_keyboard(),
-        parse_mode="MarkdownV2"
-    )
     await ServerConfig.MainMenu.set()
 
-@dp.message_handler(state=ServerConfig.DeleteTunnel)
-async def delete_tunnel(message: types.Message, state: FSMContext):
+@dp.message_handler(commands=['find'], state='*')
+async def find_command(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
     role = check_user_access(user_id)
     if not role:
@@ -378,1057 +1460,4144 @@ async def delete_tunnel(message: types.Message, state: FSMContext):
             text=escape_md("❌ دسترسی غیرمجاز!"),
             parse_mode="MarkdownV2"
         )
-        await state.finish()
         return
-    
-    if message.text == "⬅️ بازگشت به منوی اصلی":
-        await back_to_main_menu(message, state)
+    query = message.get_args()
+    if not query:
+        await bot.send_message(
+            chat_id=message.chat.id,
+            text=escape_md("🔎 لطفاً عبارت جستجو را بعد از دستور وارد کنید (نام تونل، IP سرور یا آیدی کاربر)، مثلاً:\n/find 5.12"),
+            parse_mode="MarkdownV2"
+        )
         return
-    
-    tunnel_name = message.text.split(" (کاربر:")[0]
-    conn = sqlite3.connect('tunnels.db')
-    c = conn.cursor()
-    if role == 'admin':
-        c.execute('SELECT tunnel_id, iran_server_ip, iran_username, iran_password, kharej_server_ip, kharej_username, kharej_password FROM tunnels WHERE tunnel_name = ?', (tunnel_name,))
-    else:
-        c.execute('SELECT tunnel_id, iran_server_ip, iran_username, iran_password, kharej_server_ip, kharej_username, kharej_password FROM tunnels WHERE tunnel_name = ? AND user_id = ?', (tunnel_name, user_id))
-    tunnel = c.fetchone()
-    conn.close()
-    
-    if not tunnel:
+    tunnels = search_tunnels(query, role, user_id)
+    if not tunnels:
         await bot.send_message(
             chat_id=message.chat.id,
-            text=escape_md("⚠️ تونل با این نام یافت نشد یا متعلق به شما نیست!"),
-            reply_markup=get_main_menu_keyboard(),
+            text=escape_md(f"⚠️ هیچ تونلی برای «{query}» یافت نشد!"),
             parse_mode="MarkdownV2"
         )
-        await ServerConfig.MainMenu.set()
         return
-    
-    tunnel_id, iran_server_ip, iran_username, iran_password, kharej_server_ip, kharej_username, kharej_password = tunnel
-    
-    await bot.send_message(
-        chat_id=message.chat.id,
-        text=escape_md(f"⏳ لطفاً منتظر بمانید، در حال حذف تونل '{tunnel_name}' هستیم..."),
-        parse_mode="MarkdownV2"
-    )
-    
-    iran_cleanup_commands = [
-        "sudo rm -f /etc/rc.local",
-        "sudo rm -f /etc/ipsec.conf",
-        "sudo rm -f /etc/ipsec.secrets",
-        "sudo rm -f /usr/local/bin/recycle-gre-ipsec.sh",
-        "sudo ip tun del GRE6Tun_To_IR || true",
-        "sudo ip tun del 6to4_To_IR || true",
-        "crontab -r || true"
-    ]
-    
-    kharej_cleanup_commands = [
-        "sudo rm -f /etc/rc.local",
-        "sudo rm -f /etc/ipsec.conf",
-        "sudo rm -f /etc/ipsec.secrets",
-        "sudo rm -f /usr/local/bin/recycle-gre-ipsec.sh",
-        "sudo ip tun del GRE6Tun_To_KH || true",
-        "sudo ip tun del 6to4_To_KH || true",
-        "crontab -r || true"
-    ]
-    
-    for cmd in iran_cleanup_commands:
-        result = await execute_ssh_command(iran_server_ip, iran_username, iran_password, cmd)
-        if "خطا" in result:
-            await bot.send_message(
-                chat_id=message.chat.id,
-                text=escape_md(f"❌ خطا در حذف تنظیمات سرور ایران: {result}"),
-                reply_markup=get_main_menu_keyboard(),
-                parse_mode="MarkdownV2"
-            )
-            await ServerConfig.MainMenu.set()
-            return
-    
-    for cmd in kharej_cleanup_commands:
-        result = await execute_ssh_command(kharej_server_ip, kharej_username, kharej_password, cmd)
-        if "خطا" in result:
-            await bot.send_message(
-                chat_id=message.chat.id,
-                text=escape_md(f"❌ خطا در حذف تنظیمات سرور خارج: {result}"),
-                reply_markup=get_main_menu_keyboard(),
-                parse_mode="MarkdownV2"
-            )
-            await ServerConfig.MainMenu.set()
-            return
-    
-    conn = sqlite3.connect('tunnels.db')
-    c = conn.cursor()
-    c.execute('DELETE FROM tunnels WHERE tunnel_id = ?', (tunnel_id,))
-    conn.commit()
-    conn.close()
-    
+    response = escape_md(f"🔎 نتایج جستجو برای «{query}»:\n\n")
+    for tunnel in tunnels:
+        response += escape_md(f"• {tunnel[1]}: {tunnel[3]} ⇄ {tunnel[4]}")
+        if role == 'admin':
+            response += escape_md(f" (کاربر: {tunnel[2]})")
+        response += "\n"
     await bot.send_message(
         chat_id=message.chat.id,
-        text=escape_md(f"✅ تونل '{tunnel_name}' با موفقیت از هر دو سرور و دیتابیس حذف شد!"),
-        reply_markup=get_main_menu_keyboard(),
+        text=response,
+        reply_markup=get_tunnel_picker_keyboard("status", tunnels, role, 0, False),
         parse_mode="MarkdownV2"
     )
-    await ServerConfig.MainMenu.set()
 
-@dp.message_handler(state=ServerConfig.TunnelName)
-async def process_tunnel_name(message: types.Message, state: FSMContext):
-    if message.text == "🏠 بازگشت به منوی اصلی":
-        await back_to_main_menu(message, state)
-        return
-    if message.text == "⬅️ بازگشت به مرحله قبل":
+@dp.message_handler(commands=['jobs'], state='*')
+async def jobs_command(message: types.Message, state: FSMContext):
+    user_id = message.from_user.id
+    role = check_user_access(user_id)
+    if not role:
         await bot.send_message(
             chat_id=message.chat.id,
-            text=escape_md("🏠 به منوی اصلی بازگشتید! لطفاً یک گزینه را انتخاب کنید:"),
-            reply_markup=get_main_menu_keyboard(),
+            text=escape_md("❌ دسترسی غیرمجاز!"),
             parse_mode="MarkdownV2"
         )
-        await ServerConfig.MainMenu.set()
         return
-    tunnel_name = message.text.strip()
-    if not tunnel_name:
+    jobs = list_active_jobs(role, user_id)
+    if not jobs:
         await bot.send_message(
             chat_id=message.chat.id,
-            text=escape_md("❌ لطفاً یک نام معتبر برای تونل وارد کنید:"),
-            reply_markup=get_back_buttons(),
+            text=escape_md("📭 هیچ کار فعالی در صف یا در حال اجرا نیست."),
             parse_mode="MarkdownV2"
         )
         return
-    await state.update_data(tunnel_name=tunnel_name)
+    response = escape_md("🧰 کارهای فعال:\n\n")
+    keyboard = InlineKeyboardMarkup(row_width=1)
+    for index, job in enumerate(jobs, 1):
+        line = f"{index}. {JOB_KINDS[job['kind']]} '{job['title']}' — {JOB_STATUS_LABELS[job['status']]}"
+        if job['progress']:
+            line += f": {job['progress']}"
+        if role == 'admin':
+            line += f" (کاربر: {job['user_id']})"
+        response += escape_md(line) + "\n"
+        keyboard.add(InlineKeyboardButton(f"❌ لغو {index}. {JOB_KINDS[job['kind']]} '{job['title']}'", callback_data=f"jobcancel:{job['job_id']}"))
     await bot.send_message(
         chat_id=message.chat.id,
-        text=escape_md("🔗 لطفاً نوع تونل را انتخاب کنید:"),
-        reply_markup=get_tunnel_menu_keyboard(),
+        text=response,
+        reply_markup=keyboard,
         parse_mode="MarkdownV2"
     )
-    await ServerConfig.TunnelMenu.set()
 
-@dp.message_handler(state=ServerConfig.TunnelMenu)
-async def tunnel_menu(message: types.Message, state: FSMContext):
-    if message.text == "🔗 تونل 1 ایران به 1 خارج":
-        await bot.send_message(
-            chat_id=message.chat.id,
-            text=escape_md("🌍 لطفاً IP سرور ایران را برای اتصال SSH وارد کنید:"),
-            reply_markup=get_back_buttons(),
-            parse_mode="MarkdownV2"
-        )
-        await ServerConfig.IranServerIP.set()
-    elif message.text == "⬅️ بازگشت به منوی اصلی":
-        await back_to_main_menu(message, state)
-    else:
+@dp.message_handler(commands=['fleet'], state='*')
+async def fleet_command(message: types.Message, state: FSMContext):
+    if check_user_access(message.from_user.id) != 'admin':
         await bot.send_message(
             chat_id=message.chat.id,
-            text=escape_md("❌ لطفاً گزینه‌ای معتبر انتخاب کنید:"),
-            reply_markup=get_tunnel_menu_keyboard(),
+            text=escape_md("❌ این دستور فقط برای مدیر است!"),
             parse_mode="MarkdownV2"
         )
-
-async def back_to_main_menu(message: types.Message, state: FSMContext):
-    await state.finish()
-    await bot.send_message(
-        chat_id=message.chat.id,
-        text=escape_md("🏠 به منوی اصلی بازگشتید! لطفاً یک گزینه را انتخاب کنید:"),
-        reply_markup=get_main_menu_keyboard(),
-        parse_mode="MarkdownV2"
-    )
-    await ServerConfig.MainMenu.set()
-
-@dp.message_handler(state=ServerConfig.IranServerIP)
-async def process_iran_server_ip(message: types.Message, state: FSMContext):
-    if message.text == "🏠 بازگشت به منوی اصلی":
-        await back_to_main_menu(message, state)
         return
-    if message.text == "⬅️ بازگشت به مرحله قبل":
+    args = message.get_args().split()
+    if not args or args[0] not in FLEET_OPERATIONS:
+        operations = "\n".join(f"• {name}: {title}" for name, (title, _) in FLEET_OPERATIONS.items())
         await bot.send_message(
             chat_id=message.chat.id,
-            text=escape_md("✨ لطفاً یک نام برای تونل وارد کنید:"),
-            reply_markup=get_back_buttons(),
+            text=escape_md(f"🛰 استفاده: /fleet <عملیات> [user=<آیدی>] [name=<شروع نام تونل>] [ip=<شروع آی‌پی>] [side=iran|kharej]\n\nعملیات مجاز:\n{operations}"),
             parse_mode="MarkdownV2"
         )
-        await ServerConfig.TunnelName.set()
         return
-    if not is_valid_ip(message.text.strip()):
+    filters = {}
+    for arg in args[1:]:
+        key, _, value = arg.partition("=")
+        if key not in FLEET_FILTERS or not value or (key == "side" and value not in ("iran", "kharej")) or (key == "user" and not value.isdigit()):
+            await bot.send_message(
+                chat_id=message.chat.id,
+                text=escape_md(f"❌ فیلتر نامعتبر: {arg}"),
+                parse_mode="MarkdownV2"
+            )
+            return
+        filters[key] = value
+    servers = select_fleet_servers(filters)
+    if not servers:
         await bot.send_message(
             chat_id=message.chat.id,
-            text=escape_md("❌ لطفاً یک IP معتبر وارد کنید (مثلاً 192.168.1.1):"),
-            reply_markup=get_back_buttons(),
+            text=escape_md("⚠️ هیچ سروری با این فیلتر یافت نشد!"),
             parse_mode="MarkdownV2"
         )
         return
-    await state.update_data(iran_server_ip=message.text)
+    token = uuid.uuid4().hex[:12]
+    # kept in the FSM storage bucket, so the confirmation can be handled by any instance
+    pending = (await dp.storage.get_bucket(chat=message.chat.id, user=message.from_user.id)).get("fleet_pending", {})
+    pending[token] = {"user_id": message.from_user.id, "operation": args[0], "filters": filters}
+    await dp.storage.update_bucket(chat=message.chat.id, user=message.from_user.id, fleet_pending=pending)
+    hosts = ", ".join(server['host'] for server in servers[:20]) + (" ..." if len(servers) > 20 else "")
+    keyboard = InlineKeyboardMarkup(row_width=2)
+    keyboard.row(
+        InlineKeyboardButton("✅ اجرا", callback_data=f"fleetrun:{token}"),
+        InlineKeyboardButton("❌ انصراف", callback_data=f"fleetdrop:{token}")
+    )
     await bot.send_message(
         chat_id=message.chat.id,
-        text=escape_md("👤 لطفاً نام کاربری سرور ایران را وارد کنید:"),
-        reply_markup=get_back_buttons(),
+        text=escape_md(f"🛰 «{FLEET_OPERATIONS[args[0]][0]}» روی {len(servers)} سرور اجرا شود؟\n\n{hosts}"),
+        reply_markup=keyboard,
         parse_mode="MarkdownV2"
     )
-    await ServerConfig.IranUsername.set()
 
-@dp.message_handler(state=ServerConfig.IranUsername)
-async def process_iran_username(message: types.Message, state: FSMContext):
-    if message.text == "🏠 بازگشت به منوی اصلی":
-        await back_to_main_menu(message, state)
-        return
-    if message.text == "⬅️ بازگشت به مرحله قبل":
+async def resolve_tunnel(message, command, name, args, role, user_id):
+    tunnels = find_tunnels_by_name(name, role, user_id)
+    if len(tunnels) == 1:
+        return get_tunnel(tunnels[0][0], role, user_id)
+    if not tunnels:
         await bot.send_message(
             chat_id=message.chat.id,
-            text=escape_md("🌍 لطفاً IP سرور ایران را برای اتصال SSH وارد کنید:"),
-            reply_markup=get_back_buttons(),
+            text=escape_md("⚠️ تونل یافت نشد یا متعلق به شما نیست!"),
             parse_mode="MarkdownV2"
         )
-        await ServerConfig.IranServerIP.set()
-        return
-    await state.update_data(iran_username=message.text)
+        return None
+    token = uuid.uuid4().hex[:12]
+    # names aren't unique: keep the parsed arguments until the user picks a tunnel by id
+    pending = (await dp.storage.get_bucket(chat=message.chat.id, user=user_id)).get("tunnel_commands", {})
+    pending[token] = {"user_id": user_id, "command": command, "args": args}
+    pending = dict(list(pending.items())[-TUNNEL_COMMAND_PENDING_LIMIT:])
+    await dp.storage.update_bucket(chat=message.chat.id, user=user_id, tunnel_commands=pending)
     await bot.send_message(
         chat_id=message.chat.id,
-        text=escape_md("🔒 لطفاً رمز عبور سرور ایران را وارد کنید:"),
-        reply_markup=get_back_buttons(),
+        text=escape_md(f"🔢 چند تونل با نام «{name}» وجود دارد؛ تونل موردنظر را انتخاب کنید:"),
+        reply_markup=get_tunnel_picker_keyboard(f"tcmd:{token}", tunnels, role, 0, False),
         parse_mode="MarkdownV2"
     )
-    await ServerConfig.IranPassword.set()
+    return None
 
-@dp.message_handler(state=ServerConfig.IranPassword)
-async def process_iran_password(message: types.Message, state: FSMContext):
-    if message.text == "🏠 بازگشت به منوی اصلی":
-        await back_to_main_menu(message, state)
+@dp.message_handler(commands=['alerts'], state='*')
+async def alerts_command(message: types.Message, state: FSMContext):
+    user_id = message.from_user.id
+    role = check_user_access(user_id)
+    if not role:
+        await bot.send_message(
+            chat_id=message.chat.id,
+            text=escape_md("❌ دسترسی غیرمجاز!"),
+            parse_mode="MarkdownV2"
+        )
         return
-    if message.text == "⬅️ بازگشت به مرحله قبل":
+    words = message.get_args().split()
+    split = len(words)
+    while split and ("=" in words[split - 1] or words[split - 1] in ("on", "off")):
+        split -= 1
+    name = " ".join(words[:split])
+    if not name:
         await bot.send_message(
             chat_id=message.chat.id,
-            text=escape_md("👤 لطفاً نام کاربری سرور ایران را وارد کنید:"),
-            reply_markup=get_back_buttons(),
+            text=escape_md("🔔 استفاده: /alerts <نام تونل> [loss=<درصد>] [rtt=<ضریب>] [fails=<تعداد>] [on|off]\nمثلاً:\n/alerts my-tunnel loss=30 rtt=2.5"),
             parse_mode="MarkdownV2"
         )
-        await ServerConfig.IranUsername.set()
         return
-    await state.update_data(iran_password=message.text)
-    data = await state.get_data()
-    iran_server_ip = data['iran_server_ip']
-    iran_username = data['iran_username']
-    iran_password = data['iran_password']
+    tunnel = await resolve_tunnel(message, "alerts", name, words[split:], role, user_id)
+    if tunnel:
+        await alerts_for_tunnel(message, user_id, role, tunnel, words[split:])
 
+async def alerts_for_tunnel(message, user_id, role, tunnel, args):
+    settings = {}
+    for word in args:
+        key, _, value = word.partition("=")
+        try:
+            if key in ("on", "off"):
+                settings["muted"] = int(key == "off")
+            elif key == "loss" and 0 < float(value) <= 100:
+                settings["loss"] = float(value)
+            elif key == "rtt" and float(value) > 1:
+                settings["rtt"] = float(value)
+            elif key == "fails" and int(value) >= 1:
+                settings["fails"] = int(value)
+            else:
+                raise ValueError(key)
+        except ValueError:
+            await bot.send_message(
+                chat_id=message.chat.id,
+                text=escape_md(f"❌ مقدار نامعتبر: {key}={value}"),
+                parse_mode="MarkdownV2"
+            )
+            return
+    if settings:
+        set_alert_thresholds(tunnel['tunnel_id'], **settings)
     await bot.send_message(
         chat_id=message.chat.id,
-        text=escape_md("⏳ لطفاً منتظر بمانید، در حال تست اتصال به سرور ایران هستیم..."),
+        text=escape_md(format_alert_thresholds(tunnel['tunnel_name'], get_alert_thresholds(tunnel['tunnel_id']))),
         parse_mode="MarkdownV2"
     )
-    
-    try:
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(iran_server_ip, username=iran_username, password=iran_password, timeout=10)
-        ssh.close()
+
+@dp.message_handler(commands=['standby'], state='*')
+async def standby_command(message: types.Message, state: FSMContext):
+    user_id = message.from_user.id
+    role = check_user_access(user_id)
+    if not role:
         await bot.send_message(
             chat_id=message.chat.id,
-            text=escape_md("✅ با موفقیت به سرور ایران متصل شد!"),
+            text=escape_md("❌ دسترسی غیرمجاز!"),
             parse_mode="MarkdownV2"
         )
-    except Exception as e:
+        return
+    words = message.get_args().split()
+    server = words[-3:] if len(words) >= 4 and is_valid_ip(words[-3]) else []
+    name = " ".join(words[:-3] if server else words)
+    if not name:
         await bot.send_message(
             chat_id=message.chat.id,
-            text=escape_md(f"❌ اتصال به سرور ایران ناموفق بود: {str(e)}\nلطفاً دوباره اطلاعات را وارد کنید."),
+            text=escape_md("🛟 استفاده:\n/standby <نام تونل> — نمایش سرورهای پشتیبان و جابه‌جایی‌ها\n/standby <نام تونل> <IP> <نام کاربری> <رمز عبور> — افزودن سرور خارج پشتیبان"),
             parse_mode="MarkdownV2"
         )
-        await back_to_main_menu(message, state)
         return
+    tunnel = await resolve_tunnel(message, "standby", name, server, role, user_id)
+    if tunnel:
+        await standby_for_tunnel(message, user_id, role, tunnel, server)
 
-    await bot.send_message(
-        chat_id=message.chat.id,
-        text=escape_md("🌎 لطفاً IP سرور خارج را برای اتصال SSH وارد کنید:"),
-        reply_markup=get_back_buttons(),
-        parse_mode="MarkdownV2"
-    )
-    await ServerConfig.KharejServerIP.set()
-
-@dp.message_handler(state=ServerConfig.KharejServerIP)
-async def process_kharej_server_ip(message: types.Message, state: FSMContext):
-    if message.text == "🏠 بازگشت به منوی اصلی":
-        await back_to_main_menu(message, state)
+async def standby_for_tunnel(message, user_id, role, tunnel, args):
+    if args and tunnel['tunnel_mode'] == "wireguard":
+        await bot.send_message(
+            chat_id=message.chat.id,
+            text=escape_md("⚠️ سرور پشتیبان فعلاً فقط برای تونل‌های 6to4 + GRE + IPsec پشتیبانی می‌شود."),
+            parse_mode="MarkdownV2"
+        )
         return
-    if message.text == "⬅️ بازگشت به مرحله قبل":
+    if args and host_in_use(args[0], []):
         await bot.send_message(
             chat_id=message.chat.id,
-            text=escape_md("🔒 لطفاً رمز عبور سرور ایران را وارد کنید:"),
-            reply_markup=get_back_buttons(),
+            text=escape_md(HOST_IN_USE_MESSAGE.format(host=args[0])),
             parse_mode="MarkdownV2"
         )
-        await ServerConfig.IranPassword.set()
         return
-    if not is_valid_ip(message.text.strip()):
+    if not args:
+        standbys = list_standbys(tunnel['tunnel_id'])
+        active = next((standby['slot'] for standby in standbys if standby['active']), 0)
+        response = f"🛟 سرورهای پشتیبان تونل '{tunnel['tunnel_name']}':\n"
+        response += "\n".join(f"• {standby['slot']}. {standby['server_ip']}" for standby in standbys) if standbys else "هیچ سرور پشتیبانی ثبت نشده است."
+        response += f"\n\nمسیر فعال: {endpoint_label(active)}"
+        events = get_failover_events(tunnel['tunnel_id'])
+        if events:
+            response += "\n\nآخرین جابه‌جایی‌ها:\n" + "\n".join(
+                f"• {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(happened_at))}: {endpoint_label(from_slot)} ← {endpoint_label(to_slot)} ({reason})"
+                for happened_at, from_slot, to_slot, reason in events
+            )
         await bot.send_message(
             chat_id=message.chat.id,
-            text=escape_md("❌ لطفاً یک IP معتبر وارد کنید (مثلاً 192.168.1.2):"),
-            reply_markup=get_back_buttons(),
+            text=escape_md(response),
             parse_mode="MarkdownV2"
         )
         return
-    await state.update_data(kharej_server_ip=message.text)
+    server_ip, username, password = args
     await bot.send_message(
         chat_id=message.chat.id,
-        text=escape_md("👤 لطفاً نام کاربری سرور خارج را وارد کنید:"),
-        reply_markup=get_back_buttons(),
+        text=escape_md(f"⏳ لطفاً منتظر بمانید، در حال تست اتصال به سرور پشتیبان {server_ip} هستیم..."),
         parse_mode="MarkdownV2"
     )
-    await ServerConfig.KharejUsername.set()
-
-@dp.message_handler(state=ServerConfig.KharejUsername)
-async def process_kharej_username(message: types.Message, state: FSMContext):
-    if message.text == "🏠 بازگشت به منوی اصلی":
-        await back_to_main_menu(message, state)
-        return
-    if message.text == "⬅️ بازگشت به مرحله قبل":
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, test_ssh_connection, server_ip, username, password)
+    except Exception as e:
         await bot.send_message(
             chat_id=message.chat.id,
-            text=escape_md("🌎 لطفاً IP سرور خارج را برای اتصال SSH وارد کنید:"),
-            reply_markup=get_back_buttons(),
+            text=escape_md(f"❌ اتصال به سرور پشتیبان ناموفق بود: {str(e)}"),
             parse_mode="MarkdownV2"
         )
-        await ServerConfig.KharejServerIP.set()
         return
-    await state.update_data(kharej_username=message.text)
-    await bot.send_message(
-        chat_id=message.chat.id,
-        text=escape_md("🔒 لطفاً رمز عبور سرور خارج را وارد کنید:"),
-        reply_markup=get_back_buttons(),
-        parse_mode="MarkdownV2"
-    )
-    await ServerConfig.KharejPassword.set()
+    await offer_credential_sync(message, remember_server(user_id, server_ip, username, password), server_ip)
+    await submit_job(message.chat.id, user_id, "standby", tunnel['tunnel_id'], {"server_ip": server_ip, "username": username, "password": password}, tunnel['tunnel_name'])
 
-@dp.message_handler(state=ServerConfig.KharejPassword)
-async def process_kharej_password(message: types.Message, state: FSMContext):
-    if message.text == "🏠 بازگشت به منوی اصلی":
-        await back_to_main_menu(message, state)
+@dp.message_handler(commands=['forward'], state='*')
+async def forward_command(message: types.Message, state: FSMContext):
+    user_id = message.from_user.id
+    role = check_user_access(user_id)
+    if not role:
+        await bot.send_message(
+            chat_id=message.chat.id,
+            text=escape_md("❌ دسترسی غیرمجاز!"),
+            parse_mode="MarkdownV2"
+        )
         return
-    if message.text == "⬅️ بازگشت به مرحله قبل":
+    words = message.get_args().split()
+    action = next((index for index in range(len(words) - 1, -1, -1) if words[index] in ("add", "del")), len(words))
+    name = " ".join(words[:action])
+    if not name:
         await bot.send_message(
             chat_id=message.chat.id,
-            text=escape_md("👤 لطفاً نام کاربری سرور خارج را وارد کنید:"),
-            reply_markup=get_back_buttons(),
+            text=escape_md("🔀 استفاده:\n/forward <نام تونل> — نمایش پورت‌های فوروارد شده و تعداد بسته‌های هر کدام\n/forward <نام تونل> add <پورت|شروع-پایان> ... [tcp|udp] — فوروارد به سرور خارج\n/forward <نام تونل> del <پورت|شروع-پایان> ... [tcp|udp] — حذف فوروارد\nمثلاً:\n/forward my-tunnel add 443 8080 2000-2100 tcp"),
             parse_mode="MarkdownV2"
         )
-        await ServerConfig.KharejUsername.set()
         return
-    await state.update_data(kharej_password=message.text)
-    data = await state.get_data()
-    kharej_server_ip = data['kharej_server_ip']
-    kharej_username = data['kharej_username']
-    kharej_password = data['kharej_password']
+    tunnel = await resolve_tunnel(message, "forward", name, words[action:], role, user_id)
+    if tunnel:
+        await forward_for_tunnel(message, user_id, role, tunnel, words[action:])
 
-    await bot.send_message(
-        chat_id=message.chat.id,
-        text=escape_md("⏳ لطفاً منتظر بمانید، در حال تست اتصال به سرور خارج هستیم..."),
-        parse_mode="MarkdownV2"
-    )
-    
+async def forward_for_tunnel(message, user_id, role, tunnel, args):
+    rules = list_port_forwards(tunnel['iran_server_ip'])
+    if not args:
+        key = ("forward", tunnel['iran_server_ip'])
+        probe = await admit_probe(message, user_id, key, lambda: fetch_forward_counters(tunnel['iran_server_ip'], tunnel['iran_username'], tunnel['iran_password']))
+        if not probe:
+            return
+        counters = await probe
+        await bot.send_message(
+            chat_id=message.chat.id,
+            text=escape_md(format_port_forwards(tunnel, rules, counters)),
+            parse_mode="MarkdownV2"
+        )
+        return
+    action, ports = args[0], args[1:]
+    protocols = [word for word in ports if word in FORWARD_PROTOCOLS] or list(FORWARD_PROTOCOLS)
     try:
-        ssh = paramiko.SSHClient()
-        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(kharej_server_ip, username=kharej_username, password=kharej_password, timeout=10)
-        ssh.close()
+        ranges = [parse_port_range(word) for word in ports if word not in FORWARD_PROTOCOLS]
+    except ValueError as e:
         await bot.send_message(
             chat_id=message.chat.id,
-            text=escape_md("✅ با موفقیت به سرور خارج متصل شد!"),
+            text=escape_md(f"❌ پورت نامعتبر: {e}"),
             parse_mode="MarkdownV2"
         )
-    except Exception as e:
+        return
+    requested = [{"tunnel_id": tunnel['tunnel_id'], "protocol": protocol, "port_start": start, "port_end": end} for start, end in ranges for protocol in protocols]
+    if not requested:
         await bot.send_message(
             chat_id=message.chat.id,
-            text=escape_md(f"❌ اتصال به سرور خارج ناموفق بود: {str(e)}\nلطفاً دوباره اطلاعات را وارد کنید."),
+            text=escape_md("⚠️ هیچ پورتی وارد نشده است."),
             parse_mode="MarkdownV2"
         )
-        await back_to_main_menu(message, state)
         return
-
-    await bot.send_message(
-        chat_id=message.chat.id,
-        text=escape_md("⏳ لطفاً منتظر بمانید، در حال نصب پیش‌نیازها روی سرورها هستیم..."),
-        parse_mode="MarkdownV2"
-    )
-    
-    iran_initial_commands = [
-        "sudo modprobe ip_gre",
-        "sudo modprobe ip6gre",
-        "lsmod | grep gre",
-        "sudo apt update",
-        "sudo apt install strongswan strongswan-starter -y"
-    ]
-
-    kharej_initial_commands = [
-        "apt update && apt upgrade -y",
-        "sudo modprobe ip_gre",
-        "sudo modprobe ip6gre",
-        "lsmod | grep gre",
-        "sudo apt update",
-        "sudo apt install strongswan strongswan-starter -y"
-    ]
-
-    iran_server_ip = data['iran_server_ip']
-    iran_username = data['iran_username']
-    iran_password = data['iran_password']
-    for cmd in iran_initial_commands:
-        result = await execute_ssh_command(iran_server_ip, iran_username, iran_password, cmd)
-        if "خطا" in result:
-            await bot.send_message(
-                chat_id=message.chat.id,
-                text=escape_md(f"❌ خطا در نصب پیش‌نیازها روی سرور ایران: {result}"),
-                parse_mode="MarkdownV2"
-            )
-            await back_to_main_menu(message, state)
-            return
-
-    for cmd in kharej_initial_commands:
-        result = await execute_ssh_command(kharej_server_ip, kharej_username, kharej_password, cmd)
-        if "خطا" in result:
+    if action == "add":
+        conflict = None
+        for rule in requested:
+            conflict = forward_conflict(rules, rule)
+            if conflict:
+                break
+            rules.append(rule)
+        if not conflict and len([rule for rule in rules if rule['tunnel_id'] == tunnel['tunnel_id']]) > FORWARD_RULE_LIMIT:
+            conflict = f"⚠️ هر تونل حداکثر {FORWARD_RULE_LIMIT} قانون فوروارد می‌تواند داشته باشد؛ برای پورت‌های پشت سر هم از بازه استفاده کنید."
+        if conflict:
             await bot.send_message(
                 chat_id=message.chat.id,
-                text=escape_md(f"❌ خطا در نصب پیش‌نیازها روی سرور خارج: {result}"),
+                text=escape_md(conflict),
                 parse_mode="MarkdownV2"
             )
-            await back_to_main_menu(message, state)
             return
+    payload = {"action": action, "rules": [[rule['protocol'], rule['port_start'], rule['port_end']] for rule in requested]}
+    await submit_job(message.chat.id, user_id, "forward", tunnel['tunnel_id'], payload, tunnel['tunnel_name'])
 
-    await bot.send_message(
-        chat_id=message.chat.id,
-        text=escape_md("✅ پیش‌نیازها با موفقیت روی هر دو سرور نصب شدند!"),
-        parse_mode="MarkdownV2"
-    )
-    await bot.send_message(
-        chat_id=message.chat.id,
-        text=escape_md("🌍 لطفاً IP سرور ایران را وارد کنید:"),
-        reply_markup=get_back_buttons(),
-        parse_mode="MarkdownV2"
-    )
-    await ServerConfig.IranIP.set()
-
-@dp.message_handler(state=ServerConfig.IranIP)
-async def process_iran_ip(message: types.Message, state: FSMContext):
-    if message.text == "🏠 بازگشت به منوی اصلی":
-        await back_to_main_menu(message, state)
-        return
-    if message.text == "⬅️ بازگشت به مرحله قبل":
+@dp.message_handler(commands=['qos'], state='*')
+async def qos_command(message: types.Message, state: FSMContext):
+    user_id = message.from_user.id
+    role = check_user_access(user_id)
+    if not role:
         await bot.send_message(
             chat_id=message.chat.id,
-            text=escape_md("🔒 لطفاً رمز عبور سرور خارج را وارد کنید:"),
-            reply_markup=get_back_buttons(),
+            text=escape_md("❌ دسترسی غیرمجاز!"),
             parse_mode="MarkdownV2"
         )
-        await ServerConfig.KharejPassword.set()
         return
-    if not is_valid_ip(message.text.strip()):
+    words = message.get_args().split()
+    setting = next((index for index in range(len(words) - 1, -1, -1) if words[index].lower() in (*QOS_QDISCS, "off")), len(words))
+    name = " ".join(words[:setting])
+    if not name:
         await bot.send_message(
             chat_id=message.chat.id,
-            text=escape_md("❌ لطفاً یک IP معتبر برای سرور ایران وارد کنید (مثلاً 192.168.1.1):"),
-            reply_markup=get_back_buttons(),
+            text=escape_md("🚦 استفاده:\n/qos <نام تونل> — نمایش تنظیم و آمار صف (drop، backlog)\n/qos <نام تونل> cake [مگابیت] — CAKE با سقف اختیاری\n/qos <نام تونل> fq_codel [مگابیت] — fq_codel با سقف اختیاری\n/qos <نام تونل> off — برگرداندن صف پیش‌فرض\nمثلاً:\n/qos my-tunnel cake 95"),
             parse_mode="MarkdownV2"
         )
         return
-    await state.update_data(iran_ip=message.text)
-    await bot.send_message(
-        chat_id=message.chat.id,
-        text=escape_md("🌎 لطفاً IP سرور خارج را وارد کنید:"),
-        reply_markup=get_back_buttons(),
-        parse_mode="MarkdownV2"
-    )
-    await ServerConfig.KharejIP.set()
+    tunnel = await resolve_tunnel(message, "qos", name, words[setting:], role, user_id)
+    if tunnel:
+        await qos_for_tunnel(message, user_id, role, tunnel, words[setting:])
 
-@dp.message_handler(state=ServerConfig.KharejIP)
-async def process_kharej_ip(message: types.Message, state: FSMContext):
-    if message.text == "🏠 بازگشت به منوی اصلی":
-        await back_to_main_menu(message, state)
-        return
-    if message.text == "⬅️ بازگشت به مرحله قبل":
+async def qos_for_tunnel(message, user_id, role, tunnel, args):
+    if not args:
+        response = escape_md(f"🚦 QoS تونل '{tunnel['tunnel_name']}': {format_qos(tunnel['qdisc'], tunnel['qos_bandwidth'])}") + "\n"
+        if tunnel['qdisc']:
+            key = ("qos", tunnel['tunnel_id'])
+            probe = await admit_probe(message, user_id, key, lambda: fetch_tunnel_qdisc_stats(tunnel))
+            if not probe:
+                return
+            stats = await probe
+            for label, side_stats in zip(("🌍 سرور ایران", "🌎 سرور خارج"), stats):
+                response += escape_md(f"{label}:") + "\n" + format_qdisc_status(side_stats)
         await bot.send_message(
             chat_id=message.chat.id,
-            text=escape_md("🌍 لطفاً IP سرور ایران را وارد کنید:"),
-            reply_markup=get_back_buttons(),
+            text=response,
             parse_mode="MarkdownV2"
         )
-        await ServerConfig.IranIP.set()
         return
-    if not is_valid_ip(message.text.strip()):
+    try:
+        qdisc, bandwidth = parse_qos(" ".join(args))
+    except ValueError:
         await bot.send_message(
             chat_id=message.chat.id,
-            text=escape_md("❌ لطفاً یک IP معتبر برای سرور خارج وارد کنید (مثلاً 192.168.1.2):"),
-            reply_markup=get_back_buttons(),
+            text=escape_md(f"❌ مقدار نامعتبر! سقف پهنای باند باید عددی بین 1 و {QOS_MAX_MBIT} مگابیت باشد."),
             parse_mode="MarkdownV2"
         )
         return
-    await state.update_data(kharej_ip=message.text)
-    await bot.send_message(
-        chat_id=message.chat.id,
-        text=escape_md("🔑 لطفاً یک رمز سخت برای تونل وارد کنید:"),
-        reply_markup=get_back_buttons(),
-        parse_mode="MarkdownV2"
-    )
-    await ServerConfig.PSK.set()
+    await submit_job(message.chat.id, user_id, "qos", tunnel['tunnel_id'], {"qdisc": qdisc, "qos_bandwidth": bandwidth}, tunnel['tunnel_name'])
 
-@dp.message_handler(state=ServerConfig.PSK)
-async def process_psk(message: types.Message, state: FSMContext):
-    if message.text == "🏠 بازگشت به منوی اصلی":
-        await back_to_main_menu(message, state)
+TUNNEL_COMMANDS = {
+    "alerts": alerts_for_tunnel,
+    "standby": standby_for_tunnel,
+    "forward": forward_for_tunnel,
+    "qos": qos_for_tunnel,
+}
+
+@dp.callback_query_handler(lambda c: c.data.startswith("tcmd:"), state='*')
+async def process_tunnel_command_pick(callback_query: types.CallbackQuery, state: FSMContext):
+    _, token, tunnel_id = callback_query.data.split(":", 2)
+    user_id = callback_query.from_user.id
+    chat_id = callback_query.message.chat.id
+    role = check_user_access(user_id)
+    tunnel_commands = (await dp.storage.get_bucket(chat=chat_id, user=user_id)).get("tunnel_commands", {})
+    pending = tunnel_commands.pop(token, None)
+    if not role or not pending or pending['user_id'] != user_id:
+        await callback_query.answer("⚠️ این درخواست منقضی شده است.")
         return
-    if message.text == "⬅️ بازگشت به مرحله قبل":
+    await dp.storage.update_bucket(chat=chat_id, user=user_id, tunnel_commands=tunnel_commands)
+    await callback_query.answer()
+    try:
+        await callback_query.message.edit_reply_markup(reply_markup=None)
+    except:
+        pass
+    tunnel = get_tunnel(tunnel_id, role, user_id)
+    if not tunnel:
         await bot.send_message(
-            chat_id=message.chat.id,
-            text=escape_md("🌎 لطفاً IP سرور خارج را وارد کنید:"),
-            reply_markup=get_back_buttons(),
+            chat_id=chat_id,
+            text=escape_md("⚠️ تونل یافت نشد یا متعلق به شما نیست!"),
             parse_mode="MarkdownV2"
         )
-        await ServerConfig.KharejIP.set()
         return
-    psk = message.text.strip()
-    if not psk:
+    await TUNNEL_COMMANDS[pending['command']](callback_query.message, user_id, role, tunnel, pending['args'])
+
+@dp.callback_query_handler(lambda c: c.data.startswith("tact:"), state='*')
+async def process_tunnel_action(callback_query: types.CallbackQuery, state: FSMContext):
+    await callback_query.answer()
+    _, command, tunnel_id = callback_query.data.split(":", 2)
+    user_id = callback_query.from_user.id
+    role = check_user_access(user_id)
+    if not role or command not in TUNNEL_COMMANDS:
+        return
+    tunnel = get_tunnel(tunnel_id, role, user_id)
+    if not tunnel:
         await bot.send_message(
-            chat_id=message.chat.id,
-            text=escape_md("❌ لطفاً یک رمز سخت برای تونل وارد کنید:"),
-            reply_markup=get_back_buttons(),
+            chat_id=callback_query.message.chat.id,
+            text=escape_md("⚠️ تونل یافت نشد یا متعلق به شما نیست!"),
             parse_mode="MarkdownV2"
         )
         return
-    await state.update_data(psk=psk)
-    await bot.send_message(
-        chat_id=message.chat.id,
-        text=escape_md("📏 لطفاً MTU برای تونل 6to4 را انتخاب کنید:"),
-        reply_markup=get_mtu_6to4_selection_keyboard(),
-        parse_mode="MarkdownV2"
-    )
-    await ServerConfig.MTU_6to4.set()
+    await TUNNEL_COMMANDS[command](callback_query.message, user_id, role, tunnel, [])
 
-@dp.callback_query_handler(lambda c: c.data in ["mtu_6to4_default", "mtu_6to4_manual", "back_to_psk", "back_to_main"], state=ServerConfig.MTU_6to4)
-async def process_mtu_6to4_selection(callback_query: types.CallbackQuery, state: FSMContext):
+@dp.callback_query_handler(lambda c: c.data.startswith("fleetrun:") or c.data.startswith("fleetdrop:"), state='*')
+async def process_fleet_confirm(callback_query: types.CallbackQuery, state: FSMContext):
+    action, token = callback_query.data.split(":", 1)
+    chat_id = callback_query.message.chat.id
+    fleet_pending = (await dp.storage.get_bucket(chat=chat_id, user=callback_query.from_user.id)).get("fleet_pending", {})
+    pending = fleet_pending.pop(token, None)
+    if not pending or pending['user_id'] != callback_query.from_user.id or check_user_access(callback_query.from_user.id) != 'admin':
+        await callback_query.answer("⚠️ این درخواست منقضی شده است.")
+        return
+    await dp.storage.update_bucket(chat=chat_id, user=callback_query.from_user.id, fleet_pending=fleet_pending)
     await callback_query.answer()
-    if callback_query.data == "back_to_main":
-        try:
-            await callback_query.message.edit_text(
-                text=escape_md("🏠 به منوی اصلی بازگشتید! لطفاً یک گزینه را انتخاب کنید:"),
-                reply_markup=get_main_menu_keyboard(),
-                parse_mode="MarkdownV2"
-            )
-        except:
-            await bot.send_message(
-                chat_id=callback_query.message.chat.id,
-                text=escape_md("🏠 به منوی اصلی بازگشتید! لطفاً یک گزینه را انتخاب کنید:"),
-                reply_markup=get_main_menu_keyboard(),
-                parse_mode="MarkdownV2"
-            )
-        await state.finish()
-        await ServerConfig.MainMenu.set()
+    try:
+        await callback_query.message.edit_reply_markup(reply_markup=None)
+    except:
+        pass
+    if action == "fleetdrop":
         return
-    if callback_query.data == "back_to_psk":
-        try:
-            await callback_query.message.edit_text(
-                text=escape_md("🔑 لطفاً یک رمز سخت برای تونل وارد کنید:"),
-                reply_markup=get_back_buttons(),
-                parse_mode="MarkdownV2"
-            )
-        except:
-            await bot.send_message(
-                chat_id=callback_query.message.chat.id,
-                text=escape_md("🔑 لطفاً یک رمز سخت برای تونل وارد کنید:"),
-                reply_markup=get_back_buttons(),
-                parse_mode="MarkdownV2"
-            )
-        await ServerConfig.PSK.set()
+    title = FLEET_OPERATIONS[pending['operation']][0]
+    await submit_job(callback_query.message.chat.id, pending['user_id'], "fleet", None, pending, title)
+
+@dp.callback_query_handler(lambda c: c.data.startswith("jobcancel:"), state='*')
+async def process_job_cancel(callback_query: types.CallbackQuery, state: FSMContext):
+    user_id = callback_query.from_user.id
+    role = check_user_access(user_id)
+    job = get_job(callback_query.data.split(":", 1)[1])
+    if not role or not job or (role != 'admin' and job['user_id'] != user_id):
+        await callback_query.answer("⚠️ کار یافت نشد!")
         return
-    if callback_query.data == "mtu_6to4_default":
-        await state.update_data(mtu_6to4="1480")
-        try:
-            await callback_query.message.edit_text(
-                text=escape_md("✅ MTU برای تونل 6to4 به‌صورت پیش‌فرض (1480) تنظیم شد.\n📏 لطفاً MTU برای تونل GRE را انتخاب کنید:"),
-                reply_markup=get_mtu_gre_selection_keyboard(),
-                parse_mode="MarkdownV2"
-            )
-        except:
-            await bot.send_message(
-                chat_id=callback_query.message.chat.id,
-                text=escape_md("✅ MTU برای تونل 6to4 به‌صورت پیش‌فرض (1480) تنظیم شد.\n📏 لطفاً MTU برای تونل GRE را انتخاب کنید:"),
-                reply_markup=get_mtu_gre_selection_keyboard(),
-                parse_mode="MarkdownV2"
-            )
-        await ServerConfig.MTU_GRE.set()
+    if await cancel_job(job['job_id']):
+        await callback_query.answer("🚫 درخواست لغو ثبت شد.")
     else:
-        try:
-            await callback_query.message.edit_text(
-                text=escape_md("✍️ لطفاً مقدار MTU برای تونل 6to4 را به‌صورت دستی وارد کنید (بین 1280 و 1500):"),
-                reply_markup=get_back_buttons(),
-                parse_mode="MarkdownV2"
-            )
-        except:
-            await bot.send_message(
-                chat_id=callback_query.message.chat.id,
-                text=escape_md("✍️ لطفاً مقدار MTU برای تونل 6to4 را به‌صورت دستی وارد کنید (بین 1280 و 1500):"),
-                reply_markup=get_back_buttons(),
-                parse_mode="MarkdownV2"
-            )
-        await ServerConfig.MTU_6to4.set()
+        await callback_query.answer("⚠️ این کار قبلاً به پایان رسیده است.")
 
-@dp.message_handler(state=ServerConfig.MTU_6to4)
-async def process_manual_mtu_6to4(message: types.Message, state: FSMContext):
-    if message.text == "🏠 بازگشت به منوی اصلی":
-        await back_to_main_menu(message, state)
+@dp.inline_handler()
+async def inline_find(inline_query: types.InlineQuery):
+    user_id = inline_query.from_user.id
+    role = check_user_access(user_id)
+    if not role:
+        await inline_query.answer([], cache_time=0, is_personal=True)
         return
-    if message.text == "⬅️ بازگشت به مرحله قبل":
+    results = []
+    for tunnel in search_tunnels(inline_query.query, role, user_id):
+        description = f"{tunnel[3]} ⇄ {tunnel[4]}"
+        if role == 'admin':
+            description += f" (کاربر: {tunnel[2]})"
+        results.append(types.InlineQueryResultArticle(
+            id=tunnel[0],
+            title=tunnel[1],
+            description=description,
+            input_message_content=types.InputTextMessageContent(f"🔗 {tunnel[1]}: {description}")
+        ))
+    await inline_query.answer(results, cache_time=0, is_personal=True)
+
+@dp.message_handler(state=ServerConfig.MainMenu)
+async def main_menu(message: types.Message, state: FSMContext):
+    user_id = message.from_user.id
+    role = check_user_access(user_id)
+    if not role:
         await bot.send_message(
             chat_id=message.chat.id,
-            text=escape_md("📏 لطفاً MTU برای تونل 6to4 را انتخاب کنید:"),
-            reply_markup=get_mtu_6to4_selection_keyboard(),
+            text=escape_md("❌ دسترسی غیرمجاز! لطفاً دوباره وارد شوید."),
             parse_mode="MarkdownV2"
         )
-        await ServerConfig.MTU_6to4.set()
+        await state.finish()
         return
-    try:
-        mtu = int(message.text)
-        if 1280 <= mtu <= 1500:
-            await state.update_data(mtu_6to4=message.text)
-            await bot.send_message(
-                chat_id=message.chat.id,
-                text=escape_md(f"✅ MTU برای تونل 6to4 روی {mtu} تنظیم شد."),
-                parse_mode="MarkdownV2"
-            )
-            await bot.send_message(
-                chat_id=message.chat.id,
-                text=escape_md("📏 لطفاً MTU برای تونل GRE را انتخاب کنید:"),
-                reply_markup=get_mtu_gre_selection_keyboard(),
-                parse_mode="MarkdownV2"
-            )
-            await ServerConfig.MTU_GRE.set()
-        else:
-            await bot.send_message(
-                chat_id=message.chat.id,
-                text=escape_md("❌ لطفاً مقدار MTU بین 1280 و 1500 وارد کنید:"),
-                reply_markup=get_back_buttons(),
-                parse_mode="MarkdownV2"
-            )
-    except ValueError:
+
+    if message.text == "🚀 ساخت تونل جدید":
+        await state.update_data(tunnel_id=str(uuid.uuid4()), user_id=user_id)
         await bot.send_message(
             chat_id=message.chat.id,
-            text=escape_md("❌ لطفاً یک عدد معتبر برای MTU وارد کنید:"),
+            text=escape_md("✨ لطفاً یک نام برای تونل جدید وارد کنید:"),
             reply_markup=get_back_buttons(),
             parse_mode="MarkdownV2"
         )
+        await ServerConfig.TunnelName.set()
+    elif message.text == "📊 بررسی وضعیت تونل‌ها":
+        await send_tunnel_picker(message.chat.id, role, user_id, "status")
+    elif message.text == "🗑 حذف تونل":
+        await send_tunnel_picker(message.chat.id, role, user_id, "delete")
+    else:
+        await bot.send_message(
+            chat_id=message.chat.id,
+            text=escape_md(
+        "به ربات تانل اوارا خوش اومدی 😍\n"
+        "برای حمایت از ما به پروژه داخل [GitHub] (https://github.com/evara/tunnel)  ستاره بدین و عضو چنل ما بشین: کانال تلگرام (https://t.me/evara_tu) "),
+            reply_markup=get_main_menu_keyboard(),
+            parse_mode="MarkdownV2"
+        )
 
-@dp.callback_query_handler(lambda c: c.data in ["mtu_gre_default", "mtu_gre_manual", "back_to_mtu_6to4", "back_to_main"], state=ServerConfig.MTU_GRE)
-async def process_mtu_gre_selection(callback_query: types.CallbackQuery, state: FSMContext):
+@dp.callback_query_handler(lambda c: c.data.startswith("page:"), state='*')
+async def process_tunnel_page(callback_query: types.CallbackQuery, state: FSMContext):
     await callback_query.answer()
-    if callback_query.data == "back_to_main":
+    user_id = callback_query.from_user.id
+    role = check_user_access(user_id)
+    if not role:
+        return
+    _, action, page = callback_query.data.split(":")
+    page = max(int(page), 0)
+    tunnels, has_next = fetch_tunnels_page(role, user_id, page)
+    selected = (await state.get_data()).get('delete_selection', [])
+    try:
+        await callback_query.message.edit_reply_markup(
+            reply_markup=get_tunnel_picker_keyboard(action, tunnels, role, page, has_next, selected)
+        )
+    except:
+        pass
+
+@dp.callback_query_handler(lambda c: c.data.startswith("dsel:") or c.data in ["dbulk", "dclear"], state='*')
+async def process_delete_selection(callback_query: types.CallbackQuery, state: FSMContext):
+    user_id = callback_query.from_user.id
+    role = check_user_access(user_id)
+    if not role:
+        await callback_query.answer()
+        return
+    selected = (await state.get_data()).get('delete_selection', [])
+    if callback_query.data.startswith("dsel:"):
+        _, tunnel_id, page = callback_query.data.split(":")
+        selected = [item for item in selected if item != tunnel_id] if tunnel_id in selected else selected + [tunnel_id]
+        await state.update_data(delete_selection=selected)
+        await callback_query.answer()
+        tunnels, has_next = fetch_tunnels_page(role, user_id, int(page))
         try:
-            await callback_query.message.edit_text(
-                text=escape_md("🏠 به منوی اصلی بازگشتید! لطفاً یک گزینه را انتخاب کنید:"),
-                reply_markup=get_main_menu_keyboard(),
-                parse_mode="MarkdownV2"
+            await callback_query.message.edit_reply_markup(
+                reply_markup=get_tunnel_picker_keyboard("dsel", tunnels, role, int(page), has_next, selected)
             )
         except:
-            await bot.send_message(
-                chat_id=callback_query.message.chat.id,
-                text=escape_md("🏠 به منوی اصلی بازگشتید! لطفاً یک گزینه را انتخاب کنید:"),
-                reply_markup=get_main_menu_keyboard(),
-                parse_mode="MarkdownV2"
-            )
+            pass
+        return
+    await state.update_data(delete_selection=[])
+    try:
+        await callback_query.message.edit_reply_markup(reply_markup=None)
+    except:
+        pass
+    if callback_query.data == "dclear":
+        await callback_query.answer("انتخاب‌ها پاک شد.")
+        return
+    tunnels = [tunnel for tunnel in (get_tunnel(tunnel_id, role, user_id) for tunnel_id in selected) if tunnel]
+    if not tunnels:
+        await callback_query.answer("⚠️ هیچ تونلی انتخاب نشده است.")
+        return
+    await callback_query.answer()
+    title = tunnels[0]['tunnel_name'] if len(tunnels) == 1 else f"{len(tunnels)} تونل"
+    await submit_job(callback_query.message.chat.id, user_id, "delete", tunnels[0]['tunnel_id'] if len(tunnels) == 1 else None, {"tunnel_ids": [tunnel['tunnel_id'] for tunnel in tunnels]}, title)
+
+@dp.callback_query_handler(lambda c: c.data.startswith("status:"), state='*')
+async def select_tunnel(callback_query: types.CallbackQuery, state: FSMContext):
+    await callback_query.answer()
+    message = callback_query.message
+    user_id = callback_query.from_user.id
+    role = check_user_access(user_id)
+    if not role:
+        await bot.send_message(
+            chat_id=message.chat.id,
+            text=escape_md("❌ دسترسی غیرمجاز!"),
+            parse_mode="MarkdownV2"
+        )
         await state.finish()
+        return
+
+    tunnel = get_tunnel(callback_query.data.split(":", 1)[1], role, user_id)
+    if not tunnel:
+        await bot.send_message(
+            chat_id=message.chat.id,
+            text=escape_md("⚠️ تونل یافت نشد یا متعلق به شما نیست!"),
+            reply_markup=get_main_menu_keyboard(),
+            parse_mode="MarkdownV2"
+        )
         await ServerConfig.MainMenu.set()
         return
-    if callback_query.data == "back_to_mtu_6to4":
-        try:
-            await callback_query.message.edit_text(
-                text=escape_md("📏 لطفاً MTU برای تونل 6to4 را انتخاب کنید:"),
-                reply_markup=get_mtu_6to4_selection_keyboard(),
-                parse_mode="MarkdownV2"
-            )
-        except:
-            await bot.send_message(
-                chat_id=callback_query.message.chat.id,
-                text=escape_md("📏 لطفاً MTU برای تونل 6to4 را انتخاب کنید:"),
-                reply_markup=get_mtu_6to4_selection_keyboard(),
-                parse_mode="MarkdownV2"
-            )
-        await ServerConfig.MTU_6to4.set()
+    
+    tunnel_name = tunnel['tunnel_name']
+    tunnel_user_id = tunnel['user_id']
+    
+    iran_gre_ip = "172.20.40.1"
+    kharej_gre_ip = "172.20.40.2"
+    
+    mode = tunnel['tunnel_mode']
+    format_link_status = format_wireguard_status if mode == "wireguard" else format_ipsec_status
+    
+    key = ("status", tunnel['tunnel_id'])
+    await ServerConfig.MainMenu.set()
+    probe = await admit_probe(message, user_id, key, lambda: probe_tunnel_status(tunnel, message))
+    if not probe:
         return
-    if callback_query.data == "mtu_gre_default":
-        await state.update_data(mtu_gre="1424")
-        try:
-            await callback_query.message.edit_text(
-                text=escape_md("✅ MTU برای تونل GRE به‌صورت پیش‌فرض (1424) تنظیم شد."),
-                parse_mode="MarkdownV2"
-            )
-        except:
-            await bot.send_message(
-                chat_id=callback_query.message.chat.id,
-                text=escape_md("✅ MTU برای تونل GRE به‌صورت پیش‌فرض (1424) تنظیم شد."),
-                parse_mode="MarkdownV2"
-            )
-        await process_config_files(callback_query.message, state)
-    else:
-        try:
-            await callback_query.message.edit_text(
-                text=escape_md("✍️ لطفاً مقدار MTU برای تونل GRE را به‌صورت دستی وارد کنید (بین 1280 و 1500):"),
-                reply_markup=get_back_buttons(),
-                parse_mode="MarkdownV2"
-            )
-        except:
-            await bot.send_message(
-                chat_id=callback_query.message.chat.id,
-                text=escape_md("✍️ لطفاً مقدار MTU برای تونل GRE را به‌صورت دستی وارد کنید (بین 1280 و 1500):"),
-                reply_markup=get_back_buttons(),
-                parse_mode="MarkdownV2"
-            )
-        await ServerConfig.MTU_GRE.set()
+    status = await probe
+    iran_ping, iran_link = status['iran']
+    kharej_ping, kharej_link = status['kharej']
+    if tunnel['qdisc']:
+        iran_qos, kharej_qos = status['qos']
+    
+    response = f"📊 *وضعیت تونل '{escape_md(tunnel_name)}'* 📊\n\n"
+    if role == 'admin':
+        response += f"👤 *کاربر:* {tunnel_user_id}\n"
+    response += f"🧬 *نوع تونل:* {escape_md(TUNNEL_MODES[mode])}\n"
+    response += f"🌍 *سرور ایران \\({escape_md(iran_gre_ip)}\\):*\n"
+    response += format_ping_status(iran_ping)
+    response += format_link_status(iran_link)
+    if tunnel['qdisc']:
+        response += format_qdisc_status(iran_qos)
+    response += f"🌎 *سرور خارج \\({escape_md(kharej_gre_ip)}\\):*\n"
+    response += format_ping_status(kharej_ping)
+    response += format_link_status(kharej_link)
+    if tunnel['qdisc']:
+        response += format_qdisc_status(kharej_qos)
+    response += format_traffic_status(tunnel['tunnel_id'], mode)
+    
+    await bot.send_message(
+        chat_id=message.chat.id,
+        text=response,
+        reply_markup=get_tunnel_actions_keyboard(tunnel['tunnel_id']),
+        parse_mode="MarkdownV2"
+    )
 
-@dp.message_handler(state=ServerConfig.MTU_GRE)
-async def process_manual_mtu_gre(message: types.Message, state: FSMContext):
-    if message.text == "🏠 بازگشت به منوی اصلی":
-        await back_to_main_menu(message, state)
+@dp.callback_query_handler(lambda c: c.data.startswith("trace:"), state='*')
+async def export_tunnel_trace(callback_query: types.CallbackQuery, state: FSMContext):
+    await callback_query.answer()
+    message = callback_query.message
+    user_id = callback_query.from_user.id
+    role = check_user_access(user_id)
+    if not role:
         return
-    if message.text == "⬅️ بازگشت به مرحله قبل":
+    tunnel = get_tunnel(callback_query.data.split(":", 1)[1], role, user_id)
+    if not tunnel:
         await bot.send_message(
             chat_id=message.chat.id,
-            text=escape_md("📏 لطفاً MTU برای تونل GRE را انتخاب کنید:"),
-            reply_markup=get_mtu_gre_selection_keyboard(),
+            text=escape_md("⚠️ تونل یافت نشد یا متعلق به شما نیست!"),
             parse_mode="MarkdownV2"
         )
-        await ServerConfig.MTU_GRE.set()
         return
-    try:
-        mtu = int(message.text)
-        if 1280 <= mtu <= 1500:
-            await state.update_data(mtu_gre=message.text)
-            await bot.send_message(
-                chat_id=message.chat.id,
-                text=escape_md(f"✅ MTU برای تونل GRE روی {mtu} تنظیم شد."),
-                parse_mode="MarkdownV2"
-            )
-            await process_config_files(message, state)
-        else:
-            await bot.send_message(
-                chat_id=message.chat.id,
-                text=escape_md("❌ لطفاً مقدار MTU بین 1280 و 1500 وارد کنید:"),
-                reply_markup=get_back_buttons(),
-                parse_mode="MarkdownV2"
-            )
-    except ValueError:
+    spans = get_tunnel_spans(tunnel['tunnel_id'])
+    if not spans:
         await bot.send_message(
             chat_id=message.chat.id,
-            text=escape_md("❌ لطفاً یک عدد معتبر برای MTU وارد کنید:"),
-            reply_markup=get_back_buttons(),
+            text=escape_md("ℹ️ برای این تونل هنوز زمان‌بندی ثبت نشده است."),
             parse_mode="MarkdownV2"
         )
+        return
+    document = io.BytesIO(json.dumps({"tunnel_id": tunnel['tunnel_id'], "tunnel_name": tunnel['tunnel_name'], "spans": spans}, ensure_ascii=False, indent=2).encode('utf-8'))
+    document.name = f"trace-{tunnel['tunnel_id']}.json"
+    await bot.send_document(chat_id=message.chat.id, document=document)
 
-async def save_to_db(data):
-    conn = sqlite3.connect('tunnels.db')
-    c = conn.cursor()
-    c.execute('''
-        INSERT INTO tunnels (
-            tunnel_id, tunnel_name, user_id, iran_server_ip, iran_username, iran_password, 
-            kharej_server_ip, kharej_username, kharej_password, 
-            iran_ip, kharej_ip, iran_ipv6, kharej_ipv6, psk, mtu_6to4, mtu_gre, crontab_hour
-        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    ''', (
-        data['tunnel_id'], data['tunnel_name'], data['user_id'],
-        data['iran_server_ip'], data['iran_username'], data['iran_password'],
-        data['kharej_server_ip'], data['kharej_username'], data['kharej_password'],
-        data['iran_ip'], data['kharej_ip'], data['iran_ipv6'], data['kharej_ipv6'],
-        data['psk'], data['mtu_6to4'], data['mtu_gre'], data.get('crontab_hour', '')
-    ))
-    conn.commit()
-    conn.close()
+@dp.callback_query_handler(lambda c: c.data.startswith("chart:") or c.data.startswith("chartw:"), state='*')
+async def send_tunnel_chart(callback_query: types.CallbackQuery, state: FSMContext):
+    await callback_query.answer()
+    message = callback_query.message
+    user_id = callback_query.from_user.id
+    role = check_user_access(user_id)
+    if not role:
+        return
+    action, tunnel_id, *window = callback_query.data.split(":")
+    tunnel = get_tunnel(tunnel_id, role, user_id)
+    if not tunnel:
+        await bot.send_message(
+            chat_id=message.chat.id,
+            text=escape_md("⚠️ تونل یافت نشد یا متعلق به شما نیست!"),
+            parse_mode="MarkdownV2"
+        )
+        return
+    if Figure is None:
+        await bot.send_message(
+            chat_id=message.chat.id,
+            text=escape_md("⚠️ برای رسم نمودار باید matplotlib روی سرور ربات نصب باشد (pip3 install matplotlib)."),
+            parse_mode="MarkdownV2"
+        )
+        return
+    if action == "chart" or window[0] not in CHART_WINDOWS:
+        await bot.send_message(
+            chat_id=message.chat.id,
+            text=escape_md(f"📈 بازه زمانی نمودار تونل '{tunnel['tunnel_name']}' را انتخاب کنید:"),
+            reply_markup=get_chart_windows_keyboard(tunnel['tunnel_id']),
+            parse_mode="MarkdownV2"
+        )
+        return
+    await release_conversation_lock()
+    image = await get_tunnel_chart(tunnel, window[0])
+    if image is None:
+        await bot.send_message(
+            chat_id=message.chat.id,
+            text=escape_md("ℹ️ برای این تونل هنوز داده‌ای جمع‌آوری نشده است."),
+            parse_mode="MarkdownV2"
+        )
+        return
+    photo = io.BytesIO(image)
+    photo.name = f"chart-{tunnel['tunnel_id']}-{window[0]}.png"
+    await bot.send_photo(chat_id=message.chat.id, photo=photo, caption=f"{tunnel['tunnel_name']} - {CHART_WINDOWS[window[0]][0]}")
+
+@dp.callback_query_handler(lambda c: c.data.startswith("delete:"), state='*')
+async def delete_tunnel(callback_query: types.CallbackQuery, state: FSMContext):
+    await callback_query.answer()
+    message = callback_query.message
+    user_id = callback_query.from_user.id
+    role = check_user_access(user_id)
+    if not role:
+        await bot.send_message(
+            chat_id=message.chat.id,
+            text=escape_md("❌ دسترسی غیرمجاز!"),
+            parse_mode="MarkdownV2"
+        )
+        await state.finish()
+        return
+
+    tunnel = get_tunnel(callback_query.data.split(":", 1)[1], role, user_id)
+    if not tunnel:
+        await bot.send_message(
+            chat_id=message.chat.id,
+            text=escape_md("⚠️ تونل یافت نشد یا متعلق به شما نیست!"),
+            reply_markup=get_main_menu_keyboard(),
+            parse_mode="MarkdownV2"
+        )
+        await ServerConfig.MainMenu.set()
+        return
+    
+    await submit_job(message.chat.id, user_id, "delete", tunnel['tunnel_id'], {}, tunnel['tunnel_name'])
+    await ServerConfig.MainMenu.set()
+
+@dp.message_handler(state=ServerConfig.TunnelName)
+async def process_tunnel_name(message: types.Message, state: FSMContext):
+    if message.text == "🏠 بازگشت به منوی اصلی":
+        await back_to_main_menu(message, state)
+        return
+    if message.text == "⬅️ بازگشت به مرحله قبل":
+        await bot.send_message(
+            chat_id=message.chat.id,
+            text=escape_md("🏠 به منوی اصلی بازگشتید! لطفاً یک گزینه را انتخاب کنید:"),
+            reply_markup=get_main_menu_keyboard(),
+            parse_mode="MarkdownV2"
+        )
+        await ServerConfig.MainMenu.set()
+        return
+    tunnel_name = message.text.strip()
+    if not tunnel_name:
+        await bot.send_message(
+            chat_id=message.chat.id,
+            text=escape_md("❌ لطفاً یک نام معتبر برای تونل وارد کنید:"),
+            reply_markup=get_back_buttons(),
+            parse_mode="MarkdownV2"
+        )
+        return
+    await state.update_data(tunnel_name=tunnel_name)
+    await bot.send_message(
+        chat_id=message.chat.id,
+        text=escape_md("🔗 لطفاً نوع تونل را انتخاب کنید:"),
+        reply_markup=get_tunnel_menu_keyboard(),
+        parse_mode="MarkdownV2"
+    )
+    await ServerConfig.TunnelMenu.set()
+
+@dp.message_handler(state=ServerConfig.TunnelMenu)
+async def tunnel_menu(message: types.Message, state: FSMContext):
+    if message.text in ("🔗 تونل 1 ایران به 1 خارج", "🛡 تونل WireGuard ایران به خارج"):
+        await state.update_data(tunnel_mode="wireguard" if message.text == "🛡 تونل WireGuard ایران به خارج" else "gre")
+        await ask_server_ip(message, state, "iran")
+    elif message.text == "⬅️ بازگشت به منوی اصلی":
+        await back_to_main_menu(message, state)
+    else:
+        await bot.send_message(
+            chat_id=message.chat.id,
+            text=escape_md("❌ لطفاً گزینه‌ای معتبر انتخاب کنید:"),
+            reply_markup=get_tunnel_menu_keyboard(),
+            parse_mode="MarkdownV2"
+        )
+
+SERVER_PROMPTS = {
+    "iran": "🌍 لطفاً IP سرور ایران را برای اتصال SSH وارد کنید:",
+    "kharej": "🌎 لطفاً IP سرور خارج را برای اتصال SSH وارد کنید:"
+}
+
+async def reject_host_in_use(message: types.Message, state: FSMContext, host):
+    data = await state.get_data()
+    if not host_in_use(host, [data['tunnel_id']]):
+        return False
+    await bot.send_message(
+        chat_id=message.chat.id,
+        text=escape_md(HOST_IN_USE_MESSAGE.format(host=host) + "\nلطفاً IP سرور دیگری وارد کنید:"),
+        parse_mode="MarkdownV2"
+    )
+    return True
+
+async def ask_server_ip(message: types.Message, state: FSMContext, side):
+    data = await state.get_data()
+    servers = [server for server in list_servers(message.from_user.id, data.get('iran_server_ip') if side == "kharej" else None) if not host_in_use(server['host'], [data['tunnel_id']])]
+    text = SERVER_PROMPTS[side]
+    if servers:
+        text += "\n🖥 یا یکی از سرورهای ذخیره‌شده را از دکمه‌های پایین انتخاب کنید؛ نام کاربری، رمز و تست اتصال دوباره پرسیده نمی‌شود."
+    await bot.send_message(
+        chat_id=message.chat.id,
+        text=escape_md(text),
+        reply_markup=get_server_keyboard(servers),
+        parse_mode="MarkdownV2"
+    )
+    await (ServerConfig.IranServerIP if side == "iran" else ServerConfig.KharejServerIP).set()
+
+async def offer_credential_sync(message, server_id, host):
+    stale = count_stale_tunnels(server_id)
+    if not stale:
+        return
+    keyboard = InlineKeyboardMarkup(row_width=2)
+    keyboard.row(
+        InlineKeyboardButton("✅ به‌روزرسانی", callback_data=f"credsync:{server_id}"),
+        InlineKeyboardButton("❌ نه", callback_data=f"credkeep:{server_id}")
+    )
+    await bot.send_message(
+        chat_id=message.chat.id,
+        text=escape_md(f"🔑 نام کاربری یا رمز ذخیره‌شده در {stale} تونل موجود روی سرور {host} با اطلاعات جدید فرق دارد. در آن تونل‌ها هم به‌روز شود؟"),
+        reply_markup=keyboard,
+        parse_mode="MarkdownV2"
+    )
+
+@dp.callback_query_handler(lambda c: c.data.startswith("credsync:") or c.data.startswith("credkeep:"), state='*')
+async def process_credential_sync(callback_query: types.CallbackQuery, state: FSMContext):
+    action, server_id = callback_query.data.split(":", 1)
+    try:
+        await callback_query.message.edit_reply_markup(reply_markup=None)
+    except:
+        pass
+    if action == "credkeep":
+        await callback_query.answer()
+        return
+    if not server_id.isdigit() or not sync_tunnel_credentials(callback_query.from_user.id, int(server_id)):
+        await callback_query.answer("⚠️ سرور یافت نشد!")
+        return
+    await callback_query.answer("✅ اطلاعات ورود تونل‌ها به‌روز شد.")
+
+async def use_saved_server(message: types.Message, state: FSMContext, side):
+    label = "ایران" if side == "iran" else "خارج"
+    host = message.text[len(SERVER_BUTTON_PREFIX):].split(" (")[0]
+    server = get_server(message.from_user.id, host)
+    if not server:
+        await bot.send_message(
+            chat_id=message.chat.id,
+            text=escape_md("❌ این سرور در فهرست سرورهای ذخیره‌شده شما نیست؛ لطفاً IP را وارد کنید:"),
+            parse_mode="MarkdownV2"
+        )
+        return False
+    if await reject_host_in_use(message, state, host):
+        return False
+    age = time.time() - (server['verified_at'] or 0)
+    if age > SERVER_VERIFY_TTL:
+        # reachability is only trusted for a while; after that the saved credentials are tested once more
+        await bot.send_message(
+            chat_id=message.chat.id,
+            text=escape_md(f"⏳ لطفاً منتظر بمانید، در حال تست دوباره اتصال به سرور {label} ({host}) هستیم..."),
+            parse_mode="MarkdownV2"
+        )
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, test_ssh_connection, host, server['username'], server['password'])
+        except Exception as e:
+            await bot.send_message(
+                chat_id=message.chat.id,
+                text=escape_md(f"❌ اتصال به سرور ذخیره‌شده {host} ناموفق بود: {str(e)}\nلطفاً IP را وارد کنید تا نام کاربری و رمز دوباره پرسیده شود:"),
+                parse_mode="MarkdownV2"
+            )
+            return False
+        remember_server(message.from_user.id, host, server['username'], server['password'])
+        text = f"✅ با موفقیت به سرور {label} متصل شد!"
+    else:
+        text = f"✅ سرور ذخیره‌شده {host} برای سرور {label} انتخاب شد (اتصال {format_duration(age)} پیش تأیید شده است)."
+    await bot.send_message(
+        chat_id=message.chat.id,
+        text=escape_md(text),
+        parse_mode="MarkdownV2"
+    )
+    await state.update_data(**{f"{side}_server_ip": host, f"{side}_username": server['username'], f"{side}_password": server['password'], f"{side}_saved": True})
+    return True
+
+async def back_to_main_menu(message: types.Message, state: FSMContext):
+    await state.finish()
+    await bot.send_message(
+        chat_id=message.chat.id,
+        text=escape_md("🏠 به منوی اصلی بازگشتید! لطفاً یک گزینه را انتخاب کنید:"),
+        reply_markup=get_main_menu_keyboard(),
+        parse_mode="MarkdownV2"
+    )
+    await ServerConfig.MainMenu.set()
+
+@dp.message_handler(state=ServerConfig.IranServerIP)
+async def process_iran_server_ip(message: types.Message, state: FSMContext):
+    if message.text == "🏠 بازگشت به منوی اصلی":
+        await back_to_main_menu(message, state)
+        return
+    if message.text == "⬅️ بازگشت به مرحله قبل":
+        await bot.send_message(
+            chat_id=message.chat.id,
+            text=escape_md("✨ لطفاً یک نام برای تونل وارد کنید:"),
+            reply_markup=get_back_buttons(),
+            parse_mode="MarkdownV2"
+        )
+        await ServerConfig.TunnelName.set()
+        return
+    if message.text.startswith(SERVER_BUTTON_PREFIX):
+        if await use_saved_server(message, state, "iran"):
+            await ask_server_ip(message, state, "kharej")
+        return
+    if not is_valid_ip(message.text.strip()):
+        await bot.send_message(
+            chat_id=message.chat.id,
+            text=escape_md("❌ لطفاً یک IP معتبر وارد کنید (مثلاً 192.168.1.1):"),
+            reply_markup=get_back_buttons(),
+            parse_mode="MarkdownV2"
+        )
+        return
+    if await reject_host_in_use(message, state, message.text.strip()):
+        return
+    await state.update_data(iran_server_ip=message.text, iran_saved=False)
+    await bot.send_message(
+        chat_id=message.chat.id,
+        text=escape_md("👤 لطفاً نام کاربری سرور ایران را وارد کنید:"),
+        reply_markup=get_back_buttons(),
+        parse_mode="MarkdownV2"
+    )
+    await ServerConfig.IranUsername.set()
+
+@dp.message_handler(state=ServerConfig.IranUsername)
+async def process_iran_username(message: types.Message, state: FSMContext):
+    if message.text == "🏠 بازگشت به منوی اصلی":
+        await back_to_main_menu(message, state)
+        return
+    if message.text == "⬅️ بازگشت به مرحله قبل":
+        await ask_server_ip(message, state, "iran")
+        return
+    await state.update_data(iran_username=message.text)
+    await bot.send_message(
+        chat_id=message.chat.id,
+        text=escape_md("🔒 لطفاً رمز عبور سرور ایران را وارد کنید:"),
+        reply_markup=get_back_buttons(),
+        parse_mode="MarkdownV2"
+    )
+    await ServerConfig.IranPassword.set()
 
-async def process_config_files(message: types.Message, state: FSMContext):
+@dp.message_handler(state=ServerConfig.IranPassword)
+async def process_iran_password(message: types.Message, state: FSMContext):
+    if message.text == "🏠 بازگشت به منوی اصلی":
+        await back_to_main_menu(message, state)
+        return
+    if message.text == "⬅️ بازگشت به مرحله قبل":
+        await bot.send_message(
+            chat_id=message.chat.id,
+            text=escape_md("👤 لطفاً نام کاربری سرور ایران را وارد کنید:"),
+            reply_markup=get_back_buttons(),
+            parse_mode="MarkdownV2"
+        )
+        await ServerConfig.IranUsername.set()
+        return
+    await state.update_data(iran_password=message.text)
     data = await state.get_data()
     iran_server_ip = data['iran_server_ip']
     iran_username = data['iran_username']
     iran_password = data['iran_password']
-    kharej_server_ip = data['kharej_server_ip']
-    kharej_username = data['kharej_username']
-    kharej_password = data['kharej_password']
-    iran_ip = data['iran_ip']
-    kharej_ip = data['kharej_ip']
-    psk = data['psk']
-    mtu_6to4 = data['mtu_6to4']
-    mtu_gre = data['mtu_gre']
-    
-    iran_ipv6 = "2002:504b:d769::2"
-    kharej_ipv6 = "2002:504b:d769::1"
-    await state.update_data(iran_ipv6=iran_ipv6, kharej_ipv6=kharej_ipv6)
 
     await bot.send_message(
         chat_id=message.chat.id,
-        text=escape_md("⏳ لطفاً منتظر بمانید، در حال نصب تونل روی سرورها هستیم..."),
+        text=escape_md("⏳ لطفاً منتظر بمانید، در حال تست اتصال به سرور ایران هستیم..."),
         parse_mode="MarkdownV2"
     )
     
-    iran_rc_local_content = f"""#!/bin/bash
-ip tunnel add 6to4_To_IR mode sit remote {kharej_ip} local {iran_ip}
-ip -6 addr add {iran_ipv6}/64 dev 6to4_To_IR
-ip link set 6to4_To_IR mtu {mtu_6to4}
-ip link set 6to4_To_IR up
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, test_ssh_connection, iran_server_ip, iran_username, iran_password)
+        server_id = remember_server(message.from_user.id, iran_server_ip, iran_username, iran_password)
+        await bot.send_message(
+            chat_id=message.chat.id,
+            text=escape_md("✅ با موفقیت به سرور ایران متصل شد!"),
+            parse_mode="MarkdownV2"
+        )
+        await offer_credential_sync(message, server_id, iran_server_ip)
+    except Exception as e:
+        await bot.send_message(
+            chat_id=message.chat.id,
+            text=escape_md(f"❌ اتصال به سرور ایران ناموفق بود: {str(e)}\nلطفاً دوباره اطلاعات را وارد کنید."),
+            parse_mode="MarkdownV2"
+        )
+        await back_to_main_menu(message, state)
+        return
 
-# GRE over IPv6
+    await ask_server_ip(message, state, "kharej")
+
+@dp.message_handler(state=ServerConfig.KharejServerIP)
+async def process_kharej_server_ip(message: types.Message, state: FSMContext):
+    if message.text == "🏠 بازگشت به منوی اصلی":
+        await back_to_main_menu(message, state)
+        return
+    if message.text == "⬅️ بازگشت به مرحله قبل":
+        if (await state.get_data()).get('iran_saved'):
+            await ask_server_ip(message, state, "iran")
+            return
+        await bot.send_message(
+            chat_id=message.chat.id,
+            text=escape_md("🔒 لطفاً رمز عبور سرور ایران را وارد کنید:"),
+            reply_markup=get_back_buttons(),
+            parse_mode="MarkdownV2"
+        )
+        await ServerConfig.IranPassword.set()
+        return
+    if message.text.startswith(SERVER_BUTTON_PREFIX):
+        if await use_saved_server(message, state, "kharej"):
+            await bot.send_message(
+                chat_id=message.chat.id,
+                text=escape_md("🌍 لطفاً IP سرور ایران را وارد کنید:"),
+                reply_markup=get_back_buttons(),
+                parse_mode="MarkdownV2"
+            )
+            await ServerConfig.IranIP.set()
+        return
+    if not is_valid_ip(message.text.strip()):
+        await bot.send_message(
+            chat_id=message.chat.id,
+            text=escape_md("❌ لطفاً یک IP معتبر وارد کنید (مثلاً 192.168.1.2):"),
+            reply_markup=get_back_buttons(),
+            parse_mode="MarkdownV2"
+        )
+        return
+    if await reject_host_in_use(message, state, message.text.strip()):
+        return
+    await state.update_data(kharej_server_ip=message.text, kharej_saved=False)
+    await bot.send_message(
+        chat_id=message.chat.id,
+        text=escape_md("👤 لطفاً نام کاربری سرور خارج را وارد کنید:"),
+        reply_markup=get_back_buttons(),
+        parse_mode="MarkdownV2"
+    )
+    await ServerConfig.KharejUsername.set()
+
+@dp.message_handler(state=ServerConfig.KharejUsername)
+async def process_kharej_username(message: types.Message, state: FSMContext):
+    if message.text == "🏠 بازگشت به منوی اصلی":
+        await back_to_main_menu(message, state)
+        return
+    if message.text == "⬅️ بازگشت به مرحله قبل":
+        await ask_server_ip(message, state, "kharej")
+        return
+    await state.update_data(kharej_username=message.text)
+    await bot.send_message(
+        chat_id=message.chat.id,
+        text=escape_md("🔒 لطفاً رمز عبور سرور خارج را وارد کنید:"),
+        reply_markup=get_back_buttons(),
+        parse_mode="MarkdownV2"
+    )
+    await ServerConfig.KharejPassword.set()
+
+@dp.message_handler(state=ServerConfig.KharejPassword)
+async def process_kharej_password(message: types.Message, state: FSMContext):
+    if message.text == "🏠 بازگشت به منوی اصلی":
+        await back_to_main_menu(message, state)
+        return
+    if message.text == "⬅️ بازگشت به مرحله قبل":
+        await bot.send_message(
+            chat_id=message.chat.id,
+            text=escape_md("👤 لطفاً نام کاربری سرور خارج را وارد کنید:"),
+            reply_markup=get_back_buttons(),
+            parse_mode="MarkdownV2"
+        )
+        await ServerConfig.KharejUsername.set()
+        return
+    await state.update_data(kharej_password=message.text)
+    data = await state.get_data()
+    kharej_server_ip = data['kharej_server_ip']
+    kharej_username = data['kharej_username']
+    kharej_password = data['kharej_password']
+
+    await bot.send_message(
+        chat_id=message.chat.id,
+        text=escape_md("⏳ لطفاً منتظر بمانید، در حال تست اتصال به سرور خارج هستیم..."),
+        parse_mode="MarkdownV2"
+    )
+    
+    try:
+        await asyncio.get_running_loop().run_in_executor(None, test_ssh_connection, kharej_server_ip, kharej_username, kharej_password)
+        server_id = remember_server(message.from_user.id, kharej_server_ip, kharej_username, kharej_password)
+        await bot.send_message(
+            chat_id=message.chat.id,
+            text=escape_md("✅ با موفقیت به سرور خارج متصل شد!"),
+            parse_mode="MarkdownV2"
+        )
+        await offer_credential_sync(message, server_id, kharej_server_ip)
+    except Exception as e:
+        await bot.send_message(
+            chat_id=message.chat.id,
+            text=escape_md(f"❌ اتصال به سرور خارج ناموفق بود: {str(e)}\nلطفاً دوباره اطلاعات را وارد کنید."),
+            parse_mode="MarkdownV2"
+        )
+        await back_to_main_menu(message, state)
+        return
+
+    await bot.send_message(
+        chat_id=message.chat.id,
+        text=escape_md("🌍 لطفاً IP سرور ایران را وارد کنید:"),
+        reply_markup=get_back_buttons(),
+        parse_mode="MarkdownV2"
+    )
+    await ServerConfig.IranIP.set()
+
+@dp.message_handler(state=ServerConfig.IranIP)
+async def process_iran_ip(message: types.Message, state: FSMContext):
+    if message.text == "🏠 بازگشت به منوی اصلی":
+        await back_to_main_menu(message, state)
+        return
+    if message.text == "⬅️ بازگشت به مرحله قبل":
+        if (await state.get_data()).get('kharej_saved'):
+            await ask_server_ip(message, state, "kharej")
+            return
+        await bot.send_message(
+            chat_id=message.chat.id,
+            text=escape_md("🔒 لطفاً رمز عبور سرور خارج را وارد کنید:"),
+            reply_markup=get_back_buttons(),
+            parse_mode="MarkdownV2"
+        )
+        await ServerConfig.KharejPassword.set()
+        return
+    if not is_valid_ip(message.text.strip()):
+        await bot.send_message(
+            chat_id=message.chat.id,
+            text=escape_md("❌ لطفاً یک IP معتبر برای سرور ایران وارد کنید (مثلاً 192.168.1.1):"),
+            reply_markup=get_back_buttons(),
+            parse_mode="MarkdownV2"
+        )
+        return
+    await state.update_data(iran_ip=message.text)
+    await bot.send_message(
+        chat_id=message.chat.id,
+        text=escape_md("🌎 لطفاً IP سرور خارج را وارد کنید:"),
+        reply_markup=get_back_buttons(),
+        parse_mode="MarkdownV2"
+    )
+    await ServerConfig.KharejIP.set()
+
+@dp.message_handler(state=ServerConfig.KharejIP)
+async def process_kharej_ip(message: types.Message, state: FSMContext):
+    if message.text == "🏠 بازگشت به منوی اصلی":
+        await back_to_main_menu(message, state)
+        return
+    if message.text == "⬅️ بازگشت به مرحله قبل":
+        await bot.send_message(
+            chat_id=message.chat.id,
+            text=escape_md("🌍 لطفاً IP سرور ایران را وارد کنید:"),
+            reply_markup=get_back_buttons(),
+            parse_mode="MarkdownV2"
+        )
+        await ServerConfig.IranIP.set()
+        return
+    if not is_valid_ip(message.text.strip()):
+        await bot.send_message(
+            chat_id=message.chat.id,
+            text=escape_md("❌ لطفاً یک IP معتبر برای سرور خارج وارد کنید (مثلاً 192.168.1.2):"),
+            reply_markup=get_back_buttons(),
+            parse_mode="MarkdownV2"
+        )
+        return
+    await state.update_data(kharej_ip=message.text)
+    data = await state.get_data()
+    if data.get('tunnel_mode') == "wireguard":
+        # WireGuard brings its own keys and needs no 6to4 hop, so the PSK and 6to4 MTU steps are skipped
+        await state.update_data(psk="", mtu_6to4="")
+        await bot.send_message(
+            chat_id=message.chat.id,
+            text=escape_md("📏 لطفاً MTU برای تونل WireGuard را انتخاب کنید:"),
+            reply_markup=get_mtu_gre_selection_keyboard("wireguard"),
+            parse_mode="MarkdownV2"
+        )
+        await ServerConfig.MTU_GRE.set()
+        return
+    await bot.send_message(
+        chat_id=message.chat.id,
+        text=escape_md("🔑 لطفاً یک رمز سخت برای تونل وارد کنید:"),
+        reply_markup=get_back_buttons(),
+        parse_mode="MarkdownV2"
+    )
+    await ServerConfig.PSK.set()
+
+@dp.message_handler(state=ServerConfig.PSK)
+async def process_psk(message: types.Message, state: FSMContext):
+    if message.text == "🏠 بازگشت به منوی اصلی":
+        await back_to_main_menu(message, state)
+        return
+    if message.text == "⬅️ بازگشت به مرحله قبل":
+        await bot.send_message(
+            chat_id=message.chat.id,
+            text=escape_md("🌎 لطفاً IP سرور خارج را وارد کنید:"),
+            reply_markup=get_back_buttons(),
+            parse_mode="MarkdownV2"
+        )
+        await ServerConfig.KharejIP.set()
+        return
+    psk = message.text.strip()
+    if not psk:
+        await bot.send_message(
+            chat_id=message.chat.id,
+            text=escape_md("❌ لطفاً یک رمز سخت برای تونل وارد کنید:"),
+            reply_markup=get_back_buttons(),
+            parse_mode="MarkdownV2"
+        )
+        return
+    await state.update_data(psk=psk)
+    await bot.send_message(
+        chat_id=message.chat.id,
+        text=escape_md("📏 لطفاً MTU برای تونل 6to4 را انتخاب کنید:"),
+        reply_markup=get_mtu_6to4_selection_keyboard(),
+        parse_mode="MarkdownV2"
+    )
+    await ServerConfig.MTU_6to4.set()
+
+@dp.callback_query_handler(lambda c: c.data in ["mtu_6to4_default", "mtu_6to4_manual", "back_to_psk", "back_to_main"], state=ServerConfig.MTU_6to4)
+async def process_mtu_6to4_selection(callback_query: types.CallbackQuery, state: FSMContext):
+    await callback_query.answer()
+    if callback_query.data == "back_to_main":
+        try:
+            await callback_query.message.edit_text(
+                text=escape_md("🏠 به منوی اصلی بازگشتید! لطفاً یک گزینه را انتخاب کنید:"),
+                reply_markup=get_main_menu_keyboard(),
+                parse_mode="MarkdownV2"
+            )
+        except:
+            await bot.send_message(
+                chat_id=callback_query.message.chat.id,
+                text=escape_md("🏠 به منوی اصلی بازگشتید! لطفاً یک گزینه را انتخاب کنید:"),
+                reply_markup=get_main_menu_keyboard(),
+                parse_mode="MarkdownV2"
+            )
+        await state.finish()
+        await ServerConfig.MainMenu.set()
+        return
+    if callback_query.data == "back_to_psk":
+        try:
+            await callback_query.message.edit_text(
+                text=escape_md("🔑 لطفاً یک رمز سخت برای تونل وارد کنید:"),
+                reply_markup=get_back_buttons(),
+                parse_mode="MarkdownV2"
+            )
+        except:
+            await bot.send_message(
+                chat_id=callback_query.message.chat.id,
+                text=escape_md("🔑 لطفاً یک رمز سخت برای تونل وارد کنید:"),
+                reply_markup=get_back_buttons(),
+                parse_mode="MarkdownV2"
+            )
+        await ServerConfig.PSK.set()
+        return
+    if callback_query.data == "mtu_6to4_default":
+        await state.update_data(mtu_6to4="1480")
+        try:
+            await callback_query.message.edit_text(
+                text=escape_md("✅ MTU برای تونل 6to4 به‌صورت پیش‌فرض (1480) تنظیم شد.\n📏 لطفاً MTU برای تونل GRE را انتخاب کنید:"),
+                reply_markup=get_mtu_gre_selection_keyboard(),
+                parse_mode="MarkdownV2"
+            )
+        except:
+            await bot.send_message(
+                chat_id=callback_query.message.chat.id,
+                text=escape_md("✅ MTU برای تونل 6to4 به‌صورت پیش‌فرض (1480) تنظیم شد.\n📏 لطفاً MTU برای تونل GRE را انتخاب کنید:"),
+                reply_markup=get_mtu_gre_selection_keyboard(),
+                parse_mode="MarkdownV2"
+            )
+        await ServerConfig.MTU_GRE.set()
+    else:
+        try:
+            await callback_query.message.edit_text(
+                text=escape_md("✍️ لطفاً مقدار MTU برای تونل 6to4 را به‌صورت دستی وارد کنید (بین 1280 و 1500):"),
+                reply_markup=get_back_buttons(),
+                parse_mode="MarkdownV2"
+            )
+        except:
+            await bot.send_message(
+                chat_id=callback_query.message.chat.id,
+                text=escape_md("✍️ لطفاً مقدار MTU برای تونل 6to4 را به‌صورت دستی وارد کنید (بین 1280 و 1500):"),
+                reply_markup=get_back_buttons(),
+                parse_mode="MarkdownV2"
+            )
+        await ServerConfig.MTU_6to4.set()
+
+@dp.message_handler(state=ServerConfig.MTU_6to4)
+async def process_manual_mtu_6to4(message: types.Message, state: FSMContext):
+    if message.text == "🏠 بازگشت به منوی اصلی":
+        await back_to_main_menu(message, state)
+        return
+    if message.text == "⬅️ بازگشت به مرحله قبل":
+        await bot.send_message(
+            chat_id=message.chat.id,
+            text=escape_md("📏 لطفاً MTU برای تونل 6to4 را انتخاب کنید:"),
+            reply_markup=get_mtu_6to4_selection_keyboard(),
+            parse_mode="MarkdownV2"
+        )
+        await ServerConfig.MTU_6to4.set()
+        return
+    try:
+        mtu = int(message.text)
+        if 1280 <= mtu <= 1500:
+            await state.update_data(mtu_6to4=message.text)
+            await bot.send_message(
+                chat_id=message.chat.id,
+                text=escape_md(f"✅ MTU برای تونل 6to4 روی {mtu} تنظیم شد."),
+                parse_mode="MarkdownV2"
+            )
+            await bot.send_message(
+                chat_id=message.chat.id,
+                text=escape_md("📏 لطفاً MTU برای تونل GRE را انتخاب کنید:"),
+                reply_markup=get_mtu_gre_selection_keyboard(),
+                parse_mode="MarkdownV2"
+            )
+            await ServerConfig.MTU_GRE.set()
+        else:
+            await bot.send_message(
+                chat_id=message.chat.id,
+                text=escape_md("❌ لطفاً مقدار MTU بین 1280 و 1500 وارد کنید:"),
+                reply_markup=get_back_buttons(),
+                parse_mode="MarkdownV2"
+            )
+    except ValueError:
+        await bot.send_message(
+            chat_id=message.chat.id,
+            text=escape_md("❌ لطفاً یک عدد معتبر برای MTU وارد کنید:"),
+            reply_markup=get_back_buttons(),
+            parse_mode="MarkdownV2"
+        )
+
+@dp.callback_query_handler(lambda c: c.data in ["mtu_gre_default", "mtu_gre_manual", "back_to_mtu_6to4", "back_to_kharej_ip", "back_to_main"], state=ServerConfig.MTU_GRE)
+async def process_mtu_gre_selection(callback_query: types.CallbackQuery, state: FSMContext):
+    await callback_query.answer()
+    mode = (await state.get_data()).get('tunnel_mode', "gre")
+    link = "WireGuard" if mode == "wireguard" else "GRE"
+    if callback_query.data == "back_to_main":
+        try:
+            await callback_query.message.edit_text(
+                text=escape_md("🏠 به منوی اصلی بازگشتید! لطفاً یک گزینه را انتخاب کنید:"),
+                reply_markup=get_main_menu_keyboard(),
+                parse_mode="MarkdownV2"
+            )
+        except:
+            await bot.send_message(
+                chat_id=callback_query.message.chat.id,
+                text=escape_md("🏠 به منوی اصلی بازگشتید! لطفاً یک گزینه را انتخاب کنید:"),
+                reply_markup=get_main_menu_keyboard(),
+                parse_mode="MarkdownV2"
+            )
+        await state.finish()
+        await ServerConfig.MainMenu.set()
+        return
+    if callback_query.data == "back_to_mtu_6to4":
+        try:
+            await callback_query.message.edit_text(
+                text=escape_md("📏 لطفاً MTU برای تونل 6to4 را انتخاب کنید:"),
+                reply_markup=get_mtu_6to4_selection_keyboard(),
+                parse_mode="MarkdownV2"
+            )
+        except:
+            await bot.send_message(
+                chat_id=callback_query.message.chat.id,
+                text=escape_md("📏 لطفاً MTU برای تونل 6to4 را انتخاب کنید:"),
+                reply_markup=get_mtu_6to4_selection_keyboard(),
+                parse_mode="MarkdownV2"
+            )
+        await ServerConfig.MTU_6to4.set()
+        return
+    if callback_query.data == "back_to_kharej_ip":
+        await bot.send_message(
+            chat_id=callback_query.message.chat.id,
+            text=escape_md("🌎 لطفاً IP سرور خارج را وارد کنید:"),
+            reply_markup=get_back_buttons(),
+            parse_mode="MarkdownV2"
+        )
+        await ServerConfig.KharejIP.set()
+        return
+    if callback_query.data == "mtu_gre_default":
+        default = WG_DEFAULT_MTU if mode == "wireguard" else "1424"
+        await state.update_data(mtu_gre=default)
+        try:
+            await callback_query.message.edit_text(
+                text=escape_md(f"✅ MTU برای تونل {link} به‌صورت پیش‌فرض ({default}) تنظیم شد."),
+                parse_mode="MarkdownV2"
+            )
+        except:
+            await bot.send_message(
+                chat_id=callback_query.message.chat.id,
+                text=escape_md(f"✅ MTU برای تونل {link} به‌صورت پیش‌فرض ({default}) تنظیم شد."),
+                parse_mode="MarkdownV2"
+            )
+        await ask_qos(callback_query.message.chat.id)
+    else:
+        try:
+            await callback_query.message.edit_text(
+                text=escape_md(f"✍️ لطفاً مقدار MTU برای تونل {link} را به‌صورت دستی وارد کنید (بین 1280 و 1500):"),
+                reply_markup=get_back_buttons(),
+                parse_mode="MarkdownV2"
+            )
+        except:
+            await bot.send_message(
+                chat_id=callback_query.message.chat.id,
+                text=escape_md(f"✍️ لطفاً مقدار MTU برای تونل {link} را به‌صورت دستی وارد کنید (بین 1280 و 1500):"),
+                reply_markup=get_back_buttons(),
+                parse_mode="MarkdownV2"
+            )
+        await ServerConfig.MTU_GRE.set()
+
+@dp.message_handler(state=ServerConfig.MTU_GRE)
+async def process_manual_mtu_gre(message: types.Message, state: FSMContext):
+    if message.text == "🏠 بازگشت به منوی اصلی":
+        await back_to_main_menu(message, state)
+        return
+    mode = (await state.get_data()).get('tunnel_mode', "gre")
+    link = "WireGuard" if mode == "wireguard" else "GRE"
+    if message.text == "⬅️ بازگشت به مرحله قبل":
+        await bot.send_message(
+            chat_id=message.chat.id,
+            text=escape_md(f"📏 لطفاً MTU برای تونل {link} را انتخاب کنید:"),
+            reply_markup=get_mtu_gre_selection_keyboard(mode),
+            parse_mode="MarkdownV2"
+        )
+        await ServerConfig.MTU_GRE.set()
+        return
+    try:
+        mtu = int(message.text)
+        if 1280 <= mtu <= 1500:
+            await state.update_data(mtu_gre=message.text)
+            await bot.send_message(
+                chat_id=message.chat.id,
+                text=escape_md(f"✅ MTU برای تونل {link} روی {mtu} تنظیم شد."),
+                parse_mode="MarkdownV2"
+            )
+            await ask_qos(message.chat.id)
+        else:
+            await bot.send_message(
+                chat_id=message.chat.id,
+                text=escape_md("❌ لطفاً مقدار MTU بین 1280 و 1500 وارد کنید:"),
+                reply_markup=get_back_buttons(),
+                parse_mode="MarkdownV2"
+            )
+    except ValueError:
+        await bot.send_message(
+            chat_id=message.chat.id,
+            text=escape_md("❌ لطفاً یک عدد معتبر برای MTU وارد کنید:"),
+            reply_markup=get_back_buttons(),
+            parse_mode="MarkdownV2"
+        )
+
+async def save_to_db(data):
+    conn = db_connect()
+    c = conn.cursor()
+    iran_server_id = register_server(c, data['user_id'], data['iran_server_ip'], data['iran_username'], data['iran_password'])
+    kharej_server_id = register_server(c, data['user_id'], data['kharej_server_ip'], data['kharej_username'], data['kharej_password'])
+    c.execute('''
+        INSERT INTO tunnels (
+            tunnel_id, tunnel_name, user_id, iran_server_ip, iran_username, iran_password, 
+            kharej_server_ip, kharej_username, kharej_password, 
+            iran_ip, kharej_ip, iran_ipv6, kharej_ipv6, psk, mtu_6to4, mtu_gre, crontab_hour, tunnel_mode, qdisc, qos_bandwidth,
+            iran_server_id, kharej_server_id
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (
+        data['tunnel_id'], data['tunnel_name'], data['user_id'],
+        data['iran_server_ip'], data['iran_username'], data['iran_password'],
+        data['kharej_server_ip'], data['kharej_username'], data['kharej_password'],
+        data['iran_ip'], data['kharej_ip'], data['iran_ipv6'], data['kharej_ipv6'],
+        data['psk'], data['mtu_6to4'], data['mtu_gre'], data.get('crontab_hour', ''), data.get('tunnel_mode', 'gre'),
+        data.get('qdisc', ''), data.get('qos_bandwidth', 0),
+        iran_server_id, kharej_server_id
+    ))
+    conn.commit()
+    conn.close()
+
+async def process_config_files(job, data):
+    with trace_span(job, "configure", mode=data.get('tunnel_mode', 'gre')):
+        if data.get('tunnel_mode') == "wireguard":
+            await render_wireguard_files(job, data)
+        else:
+            await render_config_files(job, data)
+
+async def render_config_files(job, data):
+    iran_server_ip = data['iran_server_ip']
+    iran_username = data['iran_username']
+    iran_password = data['iran_password']
+    kharej_server_ip = data['kharej_server_ip']
+    kharej_username = data['kharej_username']
+    kharej_password = data['kharej_password']
+    iran_ip = data['iran_ip']
+    kharej_ip = data['kharej_ip']
+    psk = data['psk']
+    mtu_6to4 = data['mtu_6to4']
+    mtu_gre = data['mtu_gre']
+    
+    iran_ipv6 = "2002:504b:d769::2"
+    kharej_ipv6 = "2002:504b:d769::1"
+    data.update(iran_ipv6=iran_ipv6, kharej_ipv6=kharej_ipv6)
+
+    await notify_job(job, "⏳ لطفاً منتظر بمانید، در حال نصب تونل روی سرورها هستیم...")
+
+    iran_parallel = kharej_parallel = ""
+    if IPSEC_MULTICORE:
+        iran_parallel = await parallel_crypto_lines(job, iran_server_ip, iran_username, iran_password, "ایران")
+        kharej_parallel = await parallel_crypto_lines(job, kharej_server_ip, kharej_username, kharej_password, "خارج")
+    
+    iran_rc_local_content = f"""#!/bin/bash
+{iran_parallel}ip tunnel add 6to4_To_IR mode sit remote {kharej_ip} local {iran_ip}
+ip -6 addr add {iran_ipv6}/64 dev 6to4_To_IR
+ip link set 6to4_To_IR mtu {mtu_6to4}
+ip link set 6to4_To_IR up
+
+# GRE over IPv6
 ip -6 tunnel add GRE6Tun_To_IR mode ip6gre remote {kharej_ipv6} local {iran_ipv6}
 ip addr add 172.20.40.1/30 dev GRE6Tun_To_IR
 ip link set GRE6Tun_To_IR mtu {mtu_gre}
 ip link set GRE6Tun_To_IR up
 
-exit 0
-"""
-    iran_ipsec_conf_content = f"""config setup
-    charondebug="none"
+exit 0
+"""
+    iran_ipsec_conf_content = f"""config setup
+    charondebug="none"
+
+conn gre6tunnel
+    left={iran_ipv6}
+    leftid=@iran
+    leftsubnet={iran_ipv6}/128
+    right={kharej_ipv6}
+    rightid=@kharej
+    rightsubnet={kharej_ipv6}/128
+    authby=secret
+    auto=start
+    keyexchange=ikev2
+    ike=aes256-sha2_256-modp2048!
+    esp=aes256-sha2_256!
+"""
+    iran_ipsec_secrets_content = f'@iran @kharej : PSK "{psk}"'
+
+    kharej_rc_local_content = f"""#!/bin/bash
+{kharej_parallel}ip tunnel add 6to4_To_KH mode sit remote {iran_ip} local {kharej_ip}
+ip -6 addr add {kharej_ipv6}/64 dev 6to4_To_KH
+ip link set 6to4_To_KH mtu {mtu_6to4}
+ip link set 6to4_To_KH up
+
+# GRE over IPv6
+ip -6 tunnel add GRE6Tun_To_KH mode ip6gre remote {iran_ipv6} local {kharej_ipv6}
+ip addr add 172.20.40.2/30 dev GRE6Tun_To_KH
+ip link set GRE6Tun_To_KH mtu {mtu_gre}
+ip link set GRE6Tun_To_KH up
+
+exit 0
+"""
+    kharej_ipsec_conf_content = f"""config setup
+    charondebug="none"
+
+conn gre6tunnel
+    left={kharej_ipv6}
+    leftid=@kharej
+    leftsubnet={kharej_ipv6}/128
+    right={iran_ipv6}
+    rightid=@iran
+    rightsubnet={iran_ipv6}/128
+    authby=secret
+    auto=start
+    keyexchange=ikev2
+    ike=aes256-sha2_256-modp2048!
+    esp=aes256-sha2_256!
+"""
+    kharej_ipsec_secrets_content = f'@iran @kharej : PSK "{psk}"'
+
+    iran_recycle_script_content = f"""#!/bin/bash
+ipsec restart
+ip link set GRE6Tun_To_IR down
+ip link set 6to4_To_IR down
+sleep 1
+ip link set 6to4_To_IR up
+ip link set GRE6Tun_To_IR up
+"""
+
+    kharej_recycle_script_content = f"""#!/bin/bash
+ipsec restart
+ip link set GRE6Tun_To_KH down
+ip link set 6to4_To_KH down
+sleep 1
+ip link set 6to4_To_KH up
+ip link set GRE6Tun_To_KH up
+"""
+
+    iran_commands = [
+        f"echo '{iran_rc_local_content}' | sudo tee /etc/rc.local",
+        "sudo chmod +x /etc/rc.local",
+        "sudo bash /etc/rc.local",
+        f"echo '{iran_ipsec_conf_content}' | sudo tee /etc/ipsec.conf",
+        f"echo '{iran_ipsec_secrets_content}' | sudo tee /etc/ipsec.secrets",
+        "sudo systemctl enable strongswan-starter",
+        "sudo systemctl start strongswan-starter",
+        f"echo '{iran_recycle_script_content}' | sudo tee /usr/local/bin/recycle-gre-ipsec.sh",
+        "sudo chmod +x /usr/local/bin/recycle-gre-ipsec.sh"
+    ]
+
+    await run_job_commands(job, iran_server_ip, iran_username, iran_password, iran_commands, "پیکربندی سرور ایران", "❌ خطا در پیکربندی سرور ایران")
+
+    kharej_commands = [
+        f"echo '{kharej_rc_local_content}' | sudo tee /etc/rc.local",
+        "sudo chmod +x /etc/rc.local",
+        "sudo bash /etc/rc.local",
+        f"echo '{kharej_ipsec_conf_content}' | sudo tee /etc/ipsec.conf",
+        f"echo '{kharej_ipsec_secrets_content}' | sudo tee /etc/ipsec.secrets",
+        "sudo systemctl enable strongswan-starter",
+        "sudo systemctl start strongswan-starter",
+        f"echo '{kharej_recycle_script_content}' | sudo tee /usr/local/bin/recycle-gre-ipsec.sh",
+        "sudo chmod +x /usr/local/bin/recycle-gre-ipsec.sh"
+    ]
+
+    await run_job_commands(job, kharej_server_ip, kharej_username, kharej_password, kharej_commands, "پیکربندی سرور خارج", "❌ خطا در پیکربندی سرور خارج")
+
+    await notify_job(job, "✅ تونل با موفقیت نصب شد!")
+    await notify_job(job, f"🔗 تونل را برای سرور ایران با آی‌پی زیر پینگ کنید: {kharej_ipv6}")
+
+IPSEC_MULTICORE = getattr(config, 'IPSEC_MULTICORE', True)
+# kernel name of the esp=aes256-sha2_256 transform in ipsec.conf
+IPSEC_KERNEL_AEAD = "authenc(hmac(sha256),cbc(aes))"
+IPSEC_FACTS_COMMAND = (
+    'echo "ipsecfacts $(nproc) $(uname -r) $(ipsec --version 2>/dev/null | grep -o "U[0-9][0-9.]*" | head -n 1 | tr -d U | grep . || echo -) '
+    '$( (modinfo pcrypt >/dev/null 2>&1 || grep -q /pcrypt.ko /lib/modules/$(uname -r)/modules.builtin 2>/dev/null) && echo 1 || echo 0)"'
+)
+IPSEC_CPU_COMMAND = (
+    "nproc; grep -c '^name *: pcrypt(' /proc/crypto; "
+    "sudo ip xfrm state 2>/dev/null | grep -o 'pcpu-num [0-9]*' | sort | uniq -c | sed 's/^/pcpu /'; "
+    "grep '^ *NET_RX:' /proc/softirqs; true"
+)
+
+def version_tuple(version):
+    return tuple(int(part) for part in re.findall(r'\d+', version)[:2])
+
+async def fetch_ipsec_facts(job, host, username, password):
+    result = await stream_ssh_command(host, username, password, IPSEC_FACTS_COMMAND, timeout=COMMAND_TIMEOUTS["short"], deadline=job.get('deadline'), tunnel_id=job['tunnel_id'], step="facts")
+    for line in result["stdout"].splitlines():
+        fields = line.split()
+        if len(fields) == 5 and fields[0] == "ipsecfacts" and fields[1].isdigit():
+            return {"cpus": int(fields[1]), "kernel": fields[2], "strongswan": fields[3].strip("-"), "pcrypt": fields[4] == "1"}
+    log_event(logging.WARNING, "ipsec facts unavailable", host=host, tunnel_id=job['tunnel_id'], error=result["error"] or tail_lines(result["stderr"], 3))
+    return None
+
+async def parallel_crypto_lines(job, host, username, password, side_label):
+    with trace_span(job, "facts", host=host):
+        facts = await fetch_ipsec_facts(job, host, username, password)
+    if not facts:
+        await notify_job(job, f"⚠️ مشخصات پردازنده و کرنل سرور {side_label} خوانده نشد؛ IPsec مثل قبل روی یک هسته می‌ماند.")
+        return ""
+    # per-CPU SAs (RFC 9611) need kernel 6.13+ and strongSwan 6.0+, and are only configurable through swanctl, not ipsec.conf
+    per_cpu = version_tuple(facts['kernel']) >= (6, 13) and version_tuple(facts['strongswan'] or "0") >= (6, 0)
+    summary = f"🧮 سرور {side_label}: {facts['cpus']} هسته، کرنل {facts['kernel']}، strongSwan {facts['strongswan'] or 'نامشخص'}"
+    summary += "\n• SA جداگانه برای هر هسته: " + ("کرنل و strongSwan پشتیبانی می‌کنند، ولی فقط با swanctl قابل فعال‌سازی است و این تونل با ipsec.conf ساخته می‌شود" if per_cpu else "پشتیبانی نمی‌شود (کرنل 6.13+ و strongSwan 6.0+ لازم است)")
+    if facts['cpus'] < 2 or not facts['pcrypt']:
+        await notify_job(job, summary + "\n• رمزنگاری موازی (pcrypt): " + ("سرور فقط یک هسته دارد" if facts['cpus'] < 2 else "ماژول pcrypt در این کرنل نیست"))
+        return ""
+    await notify_job(job, summary + "\n• رمزنگاری موازی (pcrypt): فعال می‌شود و پردازش ESP بین همه هسته‌ها پخش می‌شود")
+    # instantiating the template through tcrypt is the standard way to register pcrypt without crconf; the load itself always "fails"
+    return f"""# parallel ESP crypto across all CPUs
+modprobe pcrypt
+modprobe tcrypt alg="pcrypt({IPSEC_KERNEL_AEAD})" type=3 2>/dev/null
+
+"""
+
+def parse_ipsec_cpu(output):
+    lines = output.strip().splitlines()
+    if len(lines) < 2 or not lines[0].strip().isdigit():
+        return None
+    summary = {"cpus": int(lines[0]), "pcrypt": lines[1].strip() not in ("", "0"), "pcpu_sas": {}, "net_rx": []}
+    for line in lines[2:]:
+        fields = line.split()
+        if len(fields) == 4 and fields[0] == "pcpu":
+            summary["pcpu_sas"][int(fields[3])] = int(fields[1])
+        elif fields and fields[0] == "NET_RX:":
+            summary["net_rx"] = [int(value) for value in fields[1:]]
+    return summary
+
+def agent_ipsec_cpu_summary(status):
+    cpu = status.get('cpu')
+    if not cpu or agent_age(status, cpu['at']) > 3 * AGENT_INTERVAL:
+        return None
+    return parse_ipsec_cpu(cpu['output'])
+
+async def fetch_ipsec_cpu_summary(host, username, password):
+    result = await stream_ssh_command(host, username, password, IPSEC_CPU_COMMAND, timeout=COMMAND_TIMEOUTS["short"], step="ipsec_cpu")
+    if result["error"]:
+        log_event(logging.INFO, "ipsec cpu status failed", host=host, error=result["error"])
+        return None
+    return parse_ipsec_cpu(result["stdout"])
+
+def format_ipsec_cpu_status(summary):
+    text = f"IPsec چندهسته‌ای: {summary['cpus']} هسته، pcrypt {'فعال' if summary['pcrypt'] else 'غیرفعال'}، "
+    if summary["pcpu_sas"]:
+        text += "SA هر هسته: " + "، ".join(f"cpu{cpu}: {count}" for cpu, count in sorted(summary["pcpu_sas"].items()))
+    else:
+        text += "همه SAها روی یک هسته"
+    response = f"   🧮 {escape_md(text)}\n"
+    total = sum(summary["net_rx"])
+    if total and len(summary["net_rx"]) > 1:
+        shares = sorted(enumerate(summary["net_rx"]), key=lambda item: item[1], reverse=True)[:8]
+        text = "سهم هسته‌ها از دریافت بسته‌ها (از زمان بوت): " + " · ".join(f"cpu{cpu} {count * 100 / total:.0f}%" for cpu, count in shares)
+        response += f"   📊 {escape_md(text)}\n"
+    return response
+
+WG_PORT = getattr(config, 'WG_PORT', 51820)
+WG_DEFAULT_MTU = "1420"
+WG_KEEPALIVE = 25
+# WireGuard re-handshakes every 2 minutes while packets flow; the keepalive guarantees they do
+WG_HANDSHAKE_STALE = 180
+WG_STATUS_COMMAND = "date +%s; sudo wg show all dump 2>/dev/null | awk 'NF == 9 {print $1, $4, $6, $7, $8}'"
+WG_APT_COMMANDS = [
+    "sudo apt update",
+    "sudo apt install wireguard-tools -y",
+    "sudo modprobe wireguard"
+]
+
+def wireguard_keypair():
+    key = X25519PrivateKey.generate()
+    private_key = key.private_bytes(serialization.Encoding.Raw, serialization.PrivateFormat.Raw, serialization.NoEncryption())
+    public_key = key.public_key().public_bytes(serialization.Encoding.Raw, serialization.PublicFormat.Raw)
+    return base64.b64encode(private_key).decode(), base64.b64encode(public_key).decode()
+
+def wireguard_config(address, private_key, peer_public_key, psk, endpoint, mtu, keepalive):
+    content = f"""[Interface]
+Address = {address}/30
+ListenPort = {WG_PORT}
+PrivateKey = {private_key}
+MTU = {mtu}
+
+[Peer]
+PublicKey = {peer_public_key}
+PresharedKey = {psk}
+Endpoint = {endpoint}:{WG_PORT}
+AllowedIPs = 172.20.40.0/30
+"""
+    if keepalive:
+        content += f"PersistentKeepalive = {WG_KEEPALIVE}\n"
+    return content
+
+def wireguard_commands(interface, content):
+    recycle_script_content = f"""#!/bin/bash
+systemctl restart wg-quick@{interface}
+"""
+    return [
+        "sudo mkdir -p -m 700 /etc/wireguard",
+        encode_remote_file(content, f"/etc/wireguard/{interface}.conf", "600"),
+        f"sudo ufw allow {WG_PORT}/udp >/dev/null 2>&1 || true",
+        f"sudo systemctl enable wg-quick@{interface}",
+        f"sudo systemctl restart wg-quick@{interface}",
+        encode_remote_file(recycle_script_content, "/usr/local/bin/recycle-gre-ipsec.sh", "755")
+    ]
+
+async def render_wireguard_files(job, data):
+    # keys are generated here and only the configs leave the bot; the preshared key is kept like the IPsec PSK
+    iran_private_key, iran_public_key = wireguard_keypair()
+    kharej_private_key, kharej_public_key = wireguard_keypair()
+    psk = base64.b64encode(os.urandom(32)).decode()
+    for secret in (iran_private_key, kharej_private_key, psk):
+        register_secret(secret)
+    data.update(psk=psk, iran_ipv6="", kharej_ipv6="")
+
+    await notify_job(job, "⏳ لطفاً منتظر بمانید، در حال نصب تونل WireGuard روی سرورها هستیم...")
+
+    kharej_config = wireguard_config("172.20.40.2", kharej_private_key, iran_public_key, psk, data['iran_ip'], data['mtu_gre'], False)
+    await run_job_commands(job, data['kharej_server_ip'], data['kharej_username'], data['kharej_password'], wireguard_commands(TUNNEL_INTERFACES["wireguard"]["kharej"][0], kharej_config), "پیکربندی سرور خارج", "❌ خطا در پیکربندی سرور خارج")
+
+    # the Iran side initiates and keeps the NAT/firewall state open with keepalives
+    iran_config = wireguard_config("172.20.40.1", iran_private_key, kharej_public_key, psk, data['kharej_ip'], data['mtu_gre'], True)
+    await run_job_commands(job, data['iran_server_ip'], data['iran_username'], data['iran_password'], wireguard_commands(TUNNEL_INTERFACES["wireguard"]["iran"][0], iran_config), "پیکربندی سرور ایران", "❌ خطا در پیکربندی سرور ایران")
+
+    await notify_job(job, "✅ تونل WireGuard با موفقیت نصب شد!")
+    await notify_job(job, f"🔗 تونل را برای سرور ایران با آی‌پی زیر پینگ کنید: {GRE_PEERS['iran']}")
+
+QOS_QDISCS = {"cake": "CAKE", "fq_codel": "fq_codel"}
+QOS_NONE = "⏭ بدون QoS"
+QOS_MAX_MBIT = 100000
+
+def parse_qos(text):
+    if text == QOS_NONE:
+        return "", 0
+    words = [word for word in text.lower().split() if word.isascii()]
+    if words == ["off"]:
+        return "", 0
+    bandwidth = re.fullmatch(r"(\d+)(?:mbit)?", words[1]) if len(words) == 2 else None
+    if not words or words[0] not in QOS_QDISCS or len(words) > 2 or (len(words) == 2 and not bandwidth):
+        raise ValueError(text)
+    bandwidth = int(bandwidth.group(1)) if bandwidth else None
+    # no cap is written by leaving the number out; an explicit 0 is out of range like any other bad value
+    if bandwidth is not None and not 1 <= bandwidth <= QOS_MAX_MBIT:
+        raise ValueError(text)
+    return words[0], bandwidth or 0
+
+def format_qos(qdisc, bandwidth):
+    if not qdisc:
+        return "بدون QoS (صف پیش‌فرض کرنل)"
+    return f"{QOS_QDISCS[qdisc]} با سقف {bandwidth} Mbit/s" if bandwidth else f"{QOS_QDISCS[qdisc]} بدون سقف پهنای باند"
+
+def qos_script(interface):
+    return f"/etc/evara-qos-{interface}.sh"
+
+def qos_tc_lines(interface, qdisc, bandwidth):
+    if qdisc == "cake":
+        return [f"tc qdisc replace dev {interface} root cake {f'bandwidth {bandwidth}mbit' if bandwidth else 'unlimited'}"]
+    if not bandwidth:
+        return [f"tc qdisc replace dev {interface} root fq_codel"]
+    # fq_codel has no shaper of its own, so the cap comes from a single HTB class in front of it
+    return [
+        f"tc qdisc replace dev {interface} root handle 1: htb default 10",
+        f"tc class replace dev {interface} parent 1: classid 1:10 htb rate {bandwidth}mbit ceil {bandwidth}mbit",
+        f"tc qdisc replace dev {interface} parent 1:10 handle 10: fq_codel"
+    ]
+
+def qos_commands(mode, side, qdisc, bandwidth):
+    interface = TUNNEL_INTERFACES[mode][side][0]
+    script = qos_script(interface)
+    # rc.local recreates GRE links at boot and wg-quick recreates WireGuard links on every restart,
+    # so the qdisc is re-attached from the same hook that brings the link up
+    hook_file = f"/etc/wireguard/{interface}.conf" if mode == "wireguard" else "/etc/rc.local"
+    hook_line = f"PostUp = bash {script}" if mode == "wireguard" else f"bash {script}"
+    hook_anchor = "/^\\[Interface\\]/a" if mode == "wireguard" else "/^exit 0/i"
+    if not qdisc:
+        return [
+            f"sudo tc qdisc del dev {interface} root 2>/dev/null || true",
+            f"[ ! -f {hook_file} ] || sudo sed -i '\\#{script}#d' {hook_file}",
+            f"sudo rm -f {script}"
+        ]
+    content = "#!/bin/bash\n" + "\n".join(qos_tc_lines(interface, qdisc, bandwidth)) + "\n"
+    return [
+        f"sudo modprobe sch_{qdisc} 2>/dev/null || true",
+        encode_remote_file(content, script, "755"),
+        f"sudo bash {script}",
+        f"sudo grep -q {script} {hook_file} || sudo sed -i '{hook_anchor} {hook_line}' {hook_file}"
+    ]
+
+async def apply_qos(job, tunnel, qdisc, bandwidth):
+    mode = tunnel.get('tunnel_mode') or "gre"
+    with trace_span(job, "qos", qdisc=qdisc or "none", bandwidth=bandwidth):
+        for side, label in (("iran", "ایران"), ("kharej", "خارج")):
+            await run_job_commands(job, tunnel[f'{side}_server_ip'], tunnel[f'{side}_username'], tunnel[f'{side}_password'], qos_commands(mode, side, qdisc, bandwidth), f"تنظیم QoS سرور {label}", f"❌ خطا در تنظیم QoS سرور {label}")
+
+async def setup_qos(job, data):
+    if not data.get('qdisc'):
+        return
+    await notify_job(job, f"⏳ در حال تنظیم صف {format_qos(data['qdisc'], data['qos_bandwidth'])} روی اینترفیس تونل هر دو سرور...")
+    await apply_qos(job, data, data['qdisc'], data['qos_bandwidth'])
+
+async def run_qos_job(job):
+    data = job['payload']
+    tunnel = get_tunnel(job['tunnel_id'], 'admin', job['user_id'])
+    if not tunnel:
+        raise JobFailed("⚠️ تونل یافت نشد یا قبلاً حذف شده است!")
+    set_job_progress(job, "تنظیم QoS روی سرورها")
+    async with host_locks(tunnel['iran_server_ip'], tunnel['kharej_server_ip']):
+        await apply_qos(job, tunnel, data['qdisc'], data['qos_bandwidth'])
+    with trace_span(job, "db"):
+        conn = db_connect()
+        c = conn.cursor()
+        c.execute('UPDATE tunnels SET qdisc = ?, qos_bandwidth = ? WHERE tunnel_id = ?', (data['qdisc'], data['qos_bandwidth'], tunnel['tunnel_id']))
+        conn.commit()
+        conn.close()
+    await notify_job(job, f"✅ QoS تونل '{tunnel['tunnel_name']}' روی هر دو سرور تنظیم شد: {format_qos(data['qdisc'], data['qos_bandwidth'])}")
+
+def parse_tc_size(value):
+    number, unit = re.match(r"(\d+)(\w*)", value).groups()
+    return int(number) * {"b": 1, "Kb": 1024, "Mb": 1024 ** 2, "Gb": 1024 ** 3}.get(unit, 1)
+
+def parse_tc_delay(value):
+    number, unit = re.match(r"([\d.]+)(\w*)", value).groups()
+    return float(number) * {"us": 0.001, "ms": 1, "s": 1000}.get(unit, 1)
+
+def parse_qdisc_stats(output):
+    blocks = re.split(r"^(?=qdisc )", output, flags=re.M)
+    # with an HTB cap the interesting queue is the fq_codel leaf, not the shaper at the root
+    block = next((block for block in reversed(blocks) if block.split()[1:2] and block.split()[1] in QOS_QDISCS), None)
+    if not block:
+        return None
+    sent = re.search(r"Sent (\d+) bytes (\d+) pkt \(dropped (\d+), overlimits (\d+)", block)
+    backlog = re.search(r"backlog (\S+) (\d+)p", block)
+    delays = re.search(r"^\s*av_delay\s+(.+)$", block, re.M)
+    marks = re.search(r"^\s*marks\s+(.+)$", block, re.M) or re.search(r"ecn_mark (\d+)", block)
+    return {
+        "qdisc": block.split()[1],
+        "sent_bytes": int(sent.group(1)) if sent else 0,
+        "dropped": int(sent.group(3)) if sent else 0,
+        "overlimits": int(sent.group(4)) if sent else 0,
+        "backlog_bytes": parse_tc_size(backlog.group(1)) if backlog else 0,
+        "backlog_packets": int(backlog.group(2)) if backlog else 0,
+        "ecn_marks": sum(int(value) for value in marks.group(1).split()) if marks else 0,
+        "delay_ms": max(parse_tc_delay(value) for value in delays.group(1).split()) if delays else None
+    }
+
+async def fetch_qdisc_stats(host, username, password, interface):
+    result = await stream_ssh_command(host, username, password, f"tc -s qdisc show dev {interface}", timeout=COMMAND_TIMEOUTS["short"], step="qos")
+    if result["error"]:
+        log_event(logging.INFO, "qdisc stats failed", host=host, error=result["error"])
+        return None
+    return parse_qdisc_stats(result["stdout"])
+
+def format_qdisc_status(stats):
+    if not stats:
+        return f"   ⚠️ {escape_md('QoS: صف تنظیم‌شده روی اینترفیس تونل پیدا نشد')}\n"
+    text = f"QoS {QOS_QDISCS[stats['qdisc']]}: {stats['dropped']} drop، backlog {stats['backlog_bytes'] / 1024:.1f} KB ({stats['backlog_packets']} بسته)، {stats['ecn_marks']} ECN"
+    if stats['delay_ms'] is not None:
+        text += f"، تأخیر صف {stats['delay_ms']:g} ms"
+    return f"   🚦 {escape_md(text)}\n"
+
+def get_qos_keyboard():
+    keyboard = ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
+    keyboard.add(KeyboardButton("🍰 CAKE"), KeyboardButton("🌊 fq_codel"))
+    keyboard.add(KeyboardButton(QOS_NONE))
+    keyboard.add(KeyboardButton("⬅️ بازگشت به مرحله قبل"), KeyboardButton("🏠 بازگشت به منوی اصلی"))
+    return keyboard
+
+async def ask_qos(chat_id):
+    await bot.send_message(
+        chat_id=chat_id,
+        text=escape_md("🚦 لطفاً صف ترافیک (QoS) اینترفیس تونل را انتخاب کنید.\nبرای سقف پهنای باند، عدد مگابیت را بعد از نام بنویسید؛ مثلاً: cake 100\nسقف را کمی کمتر از سرعت واقعی لینک بگذارید تا صف روی تونل شکل بگیرد و تأخیر زیر بار بالا نرود."),
+        reply_markup=get_qos_keyboard(),
+        parse_mode="MarkdownV2"
+    )
+    await ServerConfig.QoS.set()
+
+@dp.message_handler(state=ServerConfig.QoS)
+async def process_qos(message: types.Message, state: FSMContext):
+    if message.text == "🏠 بازگشت به منوی اصلی":
+        await back_to_main_menu(message, state)
+        return
+    if message.text == "⬅️ بازگشت به مرحله قبل":
+        mode = (await state.get_data()).get('tunnel_mode', "gre")
+        await bot.send_message(
+            chat_id=message.chat.id,
+            text=escape_md(f"📏 لطفاً MTU برای تونل {'WireGuard' if mode == 'wireguard' else 'GRE'} را انتخاب کنید:"),
+            reply_markup=get_mtu_gre_selection_keyboard(mode),
+            parse_mode="MarkdownV2"
+        )
+        await ServerConfig.MTU_GRE.set()
+        return
+    try:
+        qdisc, bandwidth = parse_qos(message.text.strip())
+    except ValueError:
+        await bot.send_message(
+            chat_id=message.chat.id,
+            text=escape_md(f"❌ مقدار نامعتبر! یکی از گزینه‌ها را انتخاب کنید یا مثلاً cake 100 بنویسید (سقف بین 1 و {QOS_MAX_MBIT} مگابیت):"),
+            reply_markup=get_qos_keyboard(),
+            parse_mode="MarkdownV2"
+        )
+        return
+    await state.update_data(qdisc=qdisc, qos_bandwidth=bandwidth)
+    await bot.send_message(
+        chat_id=message.chat.id,
+        text=escape_md(f"✅ QoS: {format_qos(qdisc, bandwidth)}"),
+        parse_mode="MarkdownV2"
+    )
+    await ask_crontab_hour(message.chat.id)
+
+async def ask_crontab_hour(chat_id):
+    await bot.send_message(
+        chat_id=chat_id,
+        text=escape_md("⏰ لطفاً ساعت را برای ریست تونل وارد کنید (0-23):"),
+        reply_markup=get_back_buttons(),
+        parse_mode="MarkdownV2"
+    )
+    await ServerConfig.CrontabHour.set()
+
+@dp.message_handler(state=ServerConfig.CrontabHour)
+async def process_crontab_hour(message: types.Message, state: FSMContext):
+    if message.text == "🏠 بازگشت به منوی اصلی":
+        await back_to_main_menu(message, state)
+        return
+    if message.text == "⬅️ بازگشت به مرحله قبل":
+        await ask_qos(message.chat.id)
+        return
+    crontab_hour = message.text.strip()
+    if not is_valid_crontab_hour(crontab_hour):
+        await bot.send_message(
+            chat_id=message.chat.id,
+            text=escape_md("❌ لطفاً یک ساعت معتبر بین 0 تا 23 وارد کنید:"),
+            reply_markup=get_back_buttons(),
+            parse_mode="MarkdownV2"
+        )
+        return
+
+    await state.update_data(crontab_hour=crontab_hour)
+    data = await state.get_data()
+    await state.finish()
+    await submit_job(message.chat.id, data['user_id'], "create", data['tunnel_id'], data, data['tunnel_name'])
+    await ServerConfig.MainMenu.set()
+
+PACKAGE_CACHE_DIR = getattr(config, 'PACKAGE_CACHE_DIR', 'packages')
+BUNDLE_PACKAGES = ["strongswan", "strongswan-starter"]
+
+HOST_FACTS_COMMAND = '. /etc/os-release && echo "facts $ID $VERSION_CODENAME $(dpkg --print-architecture)"'
+
+BUNDLE_BUILD_COMMAND = (
+    "d=$(mktemp -d) && cd $d && apt-get download $("
+    "apt-cache depends --recurse --no-recommends --no-suggests --no-conflicts --no-breaks --no-replaces --no-enhances " + " ".join(BUNDLE_PACKAGES) +
+    " | grep '^[a-z0-9]' | sort -u | xargs dpkg-query -W -f='${db:Status-Abbrev} ${binary:Package}=${Version}\\n' 2>/dev/null"
+    " | awk '$1 == \"ii\" {print $2}') >/dev/null && echo $d"
+)
+
+# a failed dpkg -i leaves packages unpacked but unconfigured, and apt then refuses every install until that is repaired
+DPKG_REPAIR_COMMANDS = [
+    "sudo dpkg --configure -a; sudo apt-get -f install -y"
+]
+
+MODULE_COMMANDS = [
+    "sudo modprobe ip_gre",
+    "sudo modprobe ip6gre",
+    "lsmod | grep gre"
+]
+
+async def fetch_host_facts(job, host, username, password):
+    facts = get_cached_facts(job['user_id'], host)
+    if facts:
+        return facts
+    result = await stream_ssh_command(host, username, password, HOST_FACTS_COMMAND, timeout=COMMAND_TIMEOUTS["short"], deadline=job.get('deadline'), tunnel_id=job['tunnel_id'], step="facts")
+    for line in result["stdout"].splitlines():
+        fields = line.split()
+        if len(fields) == 4 and fields[0] == "facts":
+            facts = {"distro": fields[1], "release": fields[2], "arch": fields[3]}
+            save_facts(job['user_id'], host, facts)
+            return facts
+    log_event(logging.WARNING, "host facts unavailable", host=host, tunnel_id=job['tunnel_id'], error=result["error"] or tail_lines(result["stderr"], 3))
+    return None
+
+def bundle_dir(facts):
+    return os.path.join(PACKAGE_CACHE_DIR, f"{facts['distro']}-{facts['release']}-{facts['arch']}")
+
+def bundle_files(facts):
+    if not facts or not os.path.isdir(bundle_dir(facts)):
+        return []
+    # dpkg-query is asked about each package by name, so a file named any other way cannot be checked and is left out
+    return sorted(os.path.join(bundle_dir(facts), name) for name in os.listdir(bundle_dir(facts)) if deb_package(name))
+
+def deb_package(path):
+    match = re.fullmatch(r"([a-z0-9][a-z0-9.+-]*)_([^_]+)_([a-z0-9-]+)\.deb", os.path.basename(path))
+    return (match.group(1), unquote(match.group(2))) if match else None
+
+async def build_package_bundle(job, host, username, password, facts):
+    set_job_progress(job, f"ساخت بسته‌های محلی از {host}")
+    result = await stream_ssh_command(host, username, password, BUNDLE_BUILD_COMMAND, deadline=job.get('deadline'), tunnel_id=job['tunnel_id'], step="bundle")
+    remote_dir = result["stdout"].strip().splitlines()[-1] if result["stdout"].strip() else ""
+    if result["error"] or result["exit_status"] != 0 or not remote_dir.startswith("/tmp/"):
+        log_event(logging.WARNING, "package bundle build failed", host=host, tunnel_id=job['tunnel_id'], error=result["error"] or tail_lines(result["stderr"], 5))
+        return []
+    partial = bundle_dir(facts) + ".partial"
+    os.makedirs(partial, exist_ok=True)
+    try:
+        with trace_span(job, "sftp.get", host=host):
+            names = await asyncio.get_running_loop().run_in_executor(ssh_executor, sftp_get_files, host, username, password, remote_dir, partial, ".deb")
+    except (OSError, paramiko.SSHException) as e:
+        log_event(logging.WARNING, "package bundle download failed", host=host, tunnel_id=job['tunnel_id'], error=str(e))
+        return []
+    finally:
+        await stream_ssh_command(host, username, password, f"rm -rf {remote_dir}", timeout=COMMAND_TIMEOUTS["short"], tunnel_id=job['tunnel_id'], step="bundle")
+    if names and not os.path.isdir(bundle_dir(facts)):
+        os.rename(partial, bundle_dir(facts))
+    else:
+        shutil.rmtree(partial, ignore_errors=True)
+    log_event(logging.INFO, "package bundle cached", host=host, bundle=bundle_dir(facts), packages=len(names))
+    return bundle_files(facts)
+
+async def missing_bundle_files(job, host, username, password, files):
+    names = " ".join(deb_package(path)[0] for path in files)
+    result = await stream_ssh_command(host, username, password, f"dpkg-query -W -f='${{db:Status-Abbrev}} ${{Package}} ${{Version}}\\n' {names} 2>/dev/null; true", timeout=COMMAND_TIMEOUTS["short"], deadline=job.get('deadline'), tunnel_id=job['tunnel_id'], step="bundle")
+    if result["error"]:
+        raise JobFailed(result["error"])
+    installed = {}
+    for line in result["stdout"].splitlines():
+        fields = line.split()
+        if len(fields) == 3 and fields[0] == "ii":
+            installed[fields[1]] = fields[2]
+    return [path for path in files if installed.get(deb_package(path)[0]) != deb_package(path)[1]]
+
+async def install_package_bundle(job, host, username, password, files, label, error_prefix):
+    needed = await missing_bundle_files(job, host, username, password, files)
+    if not needed:
+        return
+    await notify_job(job, f"📦 نصب {len(needed)} بسته از کش محلی روی {host} (بدون نیاز به مخزن اوبونتو)...")
+    remote_dir = f"/tmp/evara-bundle-{job['job_id'][:8]}"
+    set_job_progress(job, f"{label}: ارسال {len(needed)} بسته")
+    with trace_span(job, "sftp.put", host=host, packages=len(needed)):
+        await asyncio.get_running_loop().run_in_executor(ssh_executor, sftp_put_files, host, username, password, needed, remote_dir)
+    await run_job_commands(job, host, username, password, [f"sudo dpkg -i {remote_dir}/*.deb; status=$?; rm -rf {remote_dir}; exit $status"], label, error_prefix)
+
+async def install_server_packages(job, host, username, password, facts, apt_commands, label, error_prefix):
+    await run_job_commands(job, host, username, password, MODULE_COMMANDS, label, error_prefix)
+    files = bundle_files(facts)
+    if files:
+        try:
+            await install_package_bundle(job, host, username, password, files, label, error_prefix)
+            return
+        except (JobFailed, OSError, paramiko.SSHException) as e:
+            log_event(logging.WARNING, "package bundle install failed", host=host, tunnel_id=job['tunnel_id'], error=str(e))
+            await notify_job(job, f"⚠️ نصب از کش محلی روی {host} ناموفق بود، نصب از مخزن اوبونتو ادامه پیدا می‌کند...")
+            await run_job_commands(job, host, username, password, DPKG_REPAIR_COMMANDS, label, error_prefix)
+    await run_job_commands(job, host, username, password, apt_commands, label, error_prefix)
+
+async def install_prerequisites(job, data):
+    with trace_span(job, "prerequisites"):
+        await install_prerequisite_packages(job, data)
+
+async def install_prerequisite_packages(job, data):
+    await notify_job(job, "⏳ لطفاً منتظر بمانید، در حال نصب پیش‌نیازها روی سرورها هستیم...")
+    if data.get('tunnel_mode') == "wireguard":
+        await run_job_commands(job, data['kharej_server_ip'], data['kharej_username'], data['kharej_password'], WG_APT_COMMANDS, "نصب پیش‌نیازها روی سرور خارج", "❌ خطا در نصب پیش‌نیازها روی سرور خارج")
+        await run_job_commands(job, data['iran_server_ip'], data['iran_username'], data['iran_password'], WG_APT_COMMANDS, "نصب پیش‌نیازها روی سرور ایران", "❌ خطا در نصب پیش‌نیازها روی سرور ایران")
+        await notify_job(job, "✅ پیش‌نیازها با موفقیت روی هر دو سرور نصب شدند!")
+        return
+
+    iran_apt_commands = [
+        "sudo apt update",
+        "sudo apt install strongswan strongswan-starter -y"
+    ]
+
+    kharej_apt_commands = [
+        "sudo apt update && sudo apt upgrade -y",
+        "sudo apt update",
+        "sudo apt install strongswan strongswan-starter -y"
+    ]
+
+    set_job_progress(job, "بررسی مشخصات سرورها")
+    with trace_span(job, "facts"):
+        iran_facts = await fetch_host_facts(job, data['iran_server_ip'], data['iran_username'], data['iran_password'])
+        kharej_facts = await fetch_host_facts(job, data['kharej_server_ip'], data['kharej_username'], data['kharej_password'])
+
+    await install_server_packages(job, data['kharej_server_ip'], data['kharej_username'], data['kharej_password'], kharej_facts, kharej_apt_commands, "نصب پیش‌نیازها روی سرور خارج", "❌ خطا در نصب پیش‌نیازها روی سرور خارج")
+    if iran_facts and kharej_facts and not bundle_files(iran_facts) and bundle_dir(iran_facts) == bundle_dir(kharej_facts):
+        with trace_span(job, "bundle", host=data['kharej_server_ip']):
+            await build_package_bundle(job, data['kharej_server_ip'], data['kharej_username'], data['kharej_password'], kharej_facts)
+    await install_server_packages(job, data['iran_server_ip'], data['iran_username'], data['iran_password'], iran_facts, iran_apt_commands, "نصب پیش‌نیازها روی سرور ایران", "❌ خطا در نصب پیش‌نیازها روی سرور ایران")
+    await notify_job(job, "✅ پیش‌نیازها با موفقیت روی هر دو سرور نصب شدند!")
+
+async def setup_crontab(job, data):
+    with trace_span(job, "crontab"):
+        await install_crontab_entries(job, data)
+
+async def install_crontab_entries(job, data):
+    await notify_job(job, "⏳ لطفاً منتظر بمانید، در حال تنظیم زمان‌بندی ریست تونل هستیم...")
+
+    crontab_time = f"0 {data['crontab_hour']} * * *"
+    crontab_cmd = f"(crontab -l 2>/dev/null; echo '{crontab_time} /usr/local/bin/recycle-gre-ipsec.sh >/dev/null 2>&1') | crontab -"
+
+    await run_job_commands(job, data['iran_server_ip'], data['iran_username'], data['iran_password'], [crontab_cmd], "تنظیم کرون‌تب سرور ایران", "❌ خطا در تنظیم کرون‌تب برای سرور ایران")
+    await run_job_commands(job, data['kharej_server_ip'], data['kharej_username'], data['kharej_password'], [crontab_cmd], "تنظیم کرون‌تب سرور خارج", "❌ خطا در تنظیم کرون‌تب سرور خارج")
+    await notify_job(job, "✅ تنظیم ریست تونل برای هر دو سرور با موفقیت انجام شد!")
+
+async def run_create_job(job):
+    data = job['payload']
+    register_secret(data.get('psk'))
+    async with host_locks(data['iran_server_ip'], data['kharej_server_ip']):
+        # checked again under the host locks, since two wizards may have picked the same server at once
+        for host in (data['iran_server_ip'], data['kharej_server_ip']):
+            if host_in_use(host, [data['tunnel_id']]):
+                raise JobFailed(HOST_IN_USE_MESSAGE.format(host=host))
+        await install_prerequisites(job, data)
+        await process_config_files(job, data)
+        await setup_qos(job, data)
+        set_job_progress(job, "ذخیره در دیتابیس")
+        with trace_span(job, "db"):
+            await save_to_db(data)
+        await setup_crontab(job, data)
+        if AGENT_ENABLED:
+            await install_agents(job, [
+                (data['iran_server_ip'], data['iran_username'], data['iran_password'], "نصب ایجنت روی سرور ایران"),
+                (data['kharej_server_ip'], data['kharej_username'], data['kharej_password'], "نصب ایجنت روی سرور خارج")
+            ])
+    await notify_job(job, "🎉 نصب تونل با موفقیت به پایان رسید!")
+    await notify_job(job, format_trace_summary(job))
+    await notify_job(job, f"‼️ نکته: برای دایرکت تونل باید داخل سرور ایران آی‌پی 172.20.40.2 را استفاده کنید.\n🔀 برای فوروارد پورت‌های سرور ایران به سرور خارج نیازی به ابزار جانبی نیست:\n/forward {data['tunnel_name']} add 443 8080 2000-2100")
+    await notify_job(job, "🌟 حالا می‌توانید وضعیت تونل را از منوی اصلی بررسی کنید یا تونل جدیدی ایجاد کنید!")
+
+LEASE_TTL = getattr(config, 'LEASE_TTL', 30)
+LEASE_POLL_INTERVAL = 0.5
+LEASE_POLL_MAX_INTERVAL = 2
+LEASE_BUSY_TIMEOUT = 1
+CONVERSATION_LOCK_POLL_INTERVAL = 0.05
+INSTANCE_ID = f"{os.uname().nodename}:{os.getpid()}:{secrets.token_hex(3)}"
+LOCAL_LOCKS = {}
+LOCAL_LOCK_USERS = Counter()
+HELD_LEASES = set()
+
+def try_acquire_lease(name):
+    # a short busy timeout: a contended database counts as "not acquired" and the caller backs off
+    conn = db_connect(LEASE_BUSY_TIMEOUT)
+    c = conn.cursor()
+    try:
+        c.execute('BEGIN IMMEDIATE')
+        c.execute('DELETE FROM leases WHERE name = ? AND expires_at < ?', (name, time.time()))
+        c.execute('INSERT OR IGNORE INTO leases (name, owner, expires_at) VALUES (?, ?, ?)', (name, INSTANCE_ID, time.time() + LEASE_TTL))
+        acquired = c.rowcount > 0
+        conn.commit()
+    except sqlite3.OperationalError:
+        acquired = False
+    finally:
+        conn.close()
+    return acquired
+
+def release_lease(name):
+    conn = db_connect()
+    c = conn.cursor()
+    c.execute('DELETE FROM leases WHERE name = ? AND owner = ?', (name, INSTANCE_ID))
+    conn.commit()
+    conn.close()
+
+class DistributedLock:
+    # the local lock queues this instance's own jobs; the lease in the shared database keeps other instances out
+    def __init__(self, name, poll_interval=LEASE_POLL_INTERVAL):
+        self.name = name
+        self.poll_interval = poll_interval
+        self.held = False
+
+    async def __aenter__(self):
+        # local locks are reference counted, so one per user or tunnel doesn't outlive its last holder or waiter
+        self.local = LOCAL_LOCKS.setdefault(self.name, asyncio.Lock())
+        LOCAL_LOCK_USERS[self.name] += 1
+        try:
+            await self.local.acquire()
+        except BaseException:
+            self.forget_local()
+            raise
+        if CLUSTER_MODE:
+            loop = asyncio.get_running_loop()
+            delay = self.poll_interval
+            try:
+                while not await loop.run_in_executor(None, try_acquire_lease, self.name):
+                    await asyncio.sleep(delay * random.uniform(0.5, 1.5))
+                    delay = min(delay * 2, LEASE_POLL_MAX_INTERVAL)
+            except BaseException:
+                self.local.release()
+                self.forget_local()
+                raise
+            HELD_LEASES.add(self.name)
+        self.held = True
+        return self
+
+    async def __aexit__(self, *exc):
+        if not self.held:
+            return
+        self.held = False
+        try:
+            if CLUSTER_MODE:
+                HELD_LEASES.discard(self.name)
+                await asyncio.get_running_loop().run_in_executor(None, release_lease, self.name)
+        finally:
+            self.local.release()
+            self.forget_local()
+
+    def forget_local(self):
+        LOCAL_LOCK_USERS[self.name] -= 1
+        if LOCAL_LOCK_USERS[self.name] <= 0:
+            del LOCAL_LOCK_USERS[self.name]
+            LOCAL_LOCKS.pop(self.name, None)
+
+def host_lock(host):
+    # serialises edits of the shared files (rc.local, ipsec.conf, crontab) on one server
+    return DistributedLock(f"host:{host}")
+
+def tunnel_lock(tunnel_id):
+    return DistributedLock(f"tunnel:{tunnel_id}")
+
+@contextlib.asynccontextmanager
+async def host_locks(*hosts):
+    # always taken in sorted order, so two jobs touching the same pair of servers cannot deadlock
+    async with contextlib.AsyncExitStack() as stack:
+        for host in sorted(set(hosts)):
+            await stack.enter_async_context(host_lock(host))
+        yield
+
+# interface names, the ipsec conn/secret ids and the 172.20.40.0/30 addresses are the same for every tunnel,
+# and rc.local/ipsec.conf are written whole, so a server can belong to one tunnel (or be one tunnel's standby)
+HOST_IN_USE_MESSAGE = "❌ سرور {host} از قبل در تونل دیگری (یا به‌عنوان سرور پشتیبان) استفاده شده است. هر سرور فقط می‌تواند در یک تونل باشد؛ ابتدا آن تونل را حذف کنید."
+
+def host_in_use(host, excluded_tunnel_ids):
+    placeholders = ", ".join("?" * len(excluded_tunnel_ids))
+    conn = db_connect()
+    c = conn.cursor()
+    c.execute(f'''
+        SELECT 1 FROM tunnels WHERE (iran_server_ip = ? OR kharej_server_ip = ?) AND tunnel_id NOT IN ({placeholders})
+        UNION SELECT 1 FROM standby_servers WHERE server_ip = ? AND tunnel_id NOT IN ({placeholders})
+    ''', [host, host, *excluded_tunnel_ids, host, *excluded_tunnel_ids])
+    in_use = c.fetchone() is not None
+    conn.close()
+    return in_use
+
+def teardown_commands(interfaces, conns, secret_ids, scripts=(), extra=()):
+    names = " ".join(conns)
+    secret_patterns = " ".join(f"-e '/^@iran @{secret_id} :/d'" for secret_id in secret_ids)
+    line_patterns = " ".join(f"-e '\\#{pattern}#d'" for pattern in [*interfaces, *scripts])
+    commands = [f"sudo ipsec down {conn} >/dev/null 2>&1 || true" for conn in conns]
+    commands += [
+        f"if [ -f /etc/ipsec.conf ]; then sudo awk -v names='{names}' '/^(conn|config) /{{skip = ($1 == \"conn\" && index(\" \" names \" \", \" \" $2 \" \"))}} !skip' /etc/ipsec.conf | sudo tee /etc/ipsec.conf.evara >/dev/null && sudo mv /etc/ipsec.conf.evara /etc/ipsec.conf; fi",
+        f"[ ! -f /etc/ipsec.secrets ] || sudo sed -i {secret_patterns} /etc/ipsec.secrets",
+        "sudo ipsec update >/dev/null 2>&1 || true"
+    ]
+    commands += list(extra)
+    commands += [f"sudo ip tun del {interface} || true" for interface in interfaces]
+    commands += [f"sudo rm -f {script}" for script in scripts]
+    commands += [
+        f"[ ! -f /etc/rc.local ] || sudo sed -i {line_patterns} /etc/rc.local",
+        "if [ -f /etc/rc.local ] && ! grep -qvE '^(#|exit 0$|[[:space:]]*$)' /etc/rc.local; then sudo rm -f /etc/rc.local; fi"
+    ]
+    return commands + host_cleanup_commands()
+
+def wireguard_teardown_commands(interface):
+    return [
+        f"sudo systemctl disable --now wg-quick@{interface} >/dev/null 2>&1 || true",
+        f"sudo ip link del {interface} 2>/dev/null || true",
+        f"sudo rm -f /etc/wireguard/{interface}.conf {qos_script(interface)}"
+    ] + host_cleanup_commands()
+
+def host_cleanup_commands():
+    return [
+        "sudo rm -f /usr/local/bin/recycle-gre-ipsec.sh",
+        "crontab -l 2>/dev/null | grep -v recycle-gre-ipsec.sh | crontab - || true"
+    ] + AGENT_CLEANUP_COMMANDS
+
+def delete_tunnel_rows(tunnel_id):
+    conn = db_connect()
+    c = conn.cursor()
+    for table in ("tunnels", "traffic_counters", "traffic_samples", "latency_samples", "alert_thresholds", "alert_state", "standby_servers", "failover_events", "port_forwards"):
+        c.execute(f'DELETE FROM {table} WHERE tunnel_id = ?', (tunnel_id,))
+    conn.commit()
+    conn.close()
+
+async def teardown_side(job, host, username, password, commands, label, error_prefix):
+    async with host_lock(host):
+        await run_job_commands(job, host, username, password, commands, label, error_prefix)
+
+def gre_teardown_sides(tunnel, deleting):
+    standbys = list_standbys(tunnel['tunnel_id'])
+    iran_interfaces = list(TUNNEL_INTERFACES["gre"]["iran"])
+    iran_scripts = [qos_script(TUNNEL_INTERFACES["gre"]["iran"][0])]
+    iran_extra = []
+    for standby in standbys:
+        addresses = standby_addresses(standby['slot'])
+        iran_interfaces += [addresses['gre_interface'], addresses['sit_interface']]
+        iran_scripts.append(addresses['script'])
+    if standbys:
+        iran_extra.append(f"sudo ip route del {FAILOVER_SERVICE_IP}/32 2>/dev/null || true")
+    iran_forward = forward_teardown_commands(tunnel['iran_server_ip'], deleting)
+    # a server still shared with another tunnel predates the one-tunnel-per-server rule; its interfaces and
+    # config files carry the same names for both tunnels, so only this tunnel's forwarding rules are removed there
+    iran_commands = iran_forward if host_in_use(tunnel['iran_server_ip'], deleting) else teardown_commands(
+        iran_interfaces,
+        ["gre6tunnel"] + [f"gre6{standby_addresses(standby['slot'])['ipsec_id']}" for standby in standbys],
+        ["kharej"] + [standby_addresses(standby['slot'])['ipsec_id'] for standby in standbys],
+        iran_scripts,
+        iran_extra + iran_forward
+    )
+    sides = [
+        (tunnel['iran_server_ip'], tunnel['iran_username'], tunnel['iran_password'], iran_commands, "حذف تنظیمات سرور ایران", "❌ خطا در حذف تنظیمات سرور ایران"),
+        (tunnel['kharej_server_ip'], tunnel['kharej_username'], tunnel['kharej_password'],
+         [] if host_in_use(tunnel['kharej_server_ip'], deleting) else teardown_commands(TUNNEL_INTERFACES["gre"]["kharej"], ["gre6tunnel"], ["kharej"], [qos_script(TUNNEL_INTERFACES["gre"]["kharej"][0])]),
+         "حذف تنظیمات سرور خارج", "❌ خطا در حذف تنظیمات سرور خارج")
+    ]
+    for standby in standbys:
+        sides.append((
+            standby['server_ip'], standby['username'], standby['password'],
+            [] if host_in_use(standby['server_ip'], deleting) else teardown_commands(TUNNEL_INTERFACES["gre"]["kharej"], ["gre6tunnel"], [standby_addresses(standby['slot'])['ipsec_id']]),
+            f"حذف تنظیمات سرور پشتیبان {standby['slot']}", f"❌ خطا در حذف تنظیمات سرور پشتیبان {standby['slot']}"
+        ))
+    return sides
+
+async def teardown_tunnel(job, tunnel, deleting):
+    if tunnel['tunnel_mode'] == "wireguard":
+        sides = [
+            (tunnel['iran_server_ip'], tunnel['iran_username'], tunnel['iran_password'],
+             forward_teardown_commands(tunnel['iran_server_ip'], deleting) + ([] if host_in_use(tunnel['iran_server_ip'], deleting) else wireguard_teardown_commands(TUNNEL_INTERFACES["wireguard"]["iran"][0])),
+             "حذف تنظیمات سرور ایران", "❌ خطا در حذف تنظیمات سرور ایران"),
+            (tunnel['kharej_server_ip'], tunnel['kharej_username'], tunnel['kharej_password'],
+             [] if host_in_use(tunnel['kharej_server_ip'], deleting) else wireguard_teardown_commands(TUNNEL_INTERFACES["wireguard"]["kharej"][0]),
+             "حذف تنظیمات سرور خارج", "❌ خطا در حذف تنظیمات سرور خارج")
+        ]
+    else:
+        sides = gre_teardown_sides(tunnel, deleting)
+
+    with trace_span(job, "teardown"):
+        results = await asyncio.gather(*[teardown_side(job, *side) for side in sides], return_exceptions=True)
+    errors = [str(result) for result in results if isinstance(result, Exception)]
+    if errors:
+        # the row stays so the user can retry; every cleanup command is safe to run twice
+        raise JobFailed(f"❌ حذف تونل '{tunnel['tunnel_name']}' کامل نشد و تونل در دیتابیس باقی ماند تا دوباره تلاش کنید:\n" + "\n".join(errors))
+
+    shared = [side[0] for side in sides if host_in_use(side[0], deleting)]
+    with trace_span(job, "db"):
+        delete_tunnel_rows(tunnel['tunnel_id'])
+        delete_agents([side[0] for side in sides if side[0] not in shared])
+    await notify_job(job, f"✅ تونل '{tunnel['tunnel_name']}' با موفقیت از هر دو سرور و دیتابیس حذف شد!")
+    if shared:
+        await notify_job(job, f"⚠️ سرور {'، '.join(shared)} در تونل دیگری هم استفاده شده بود؛ اینترفیس‌ها و تنظیمات آن دست نخورد تا آن تونل قطع نشود.")
+
+async def run_delete_job(job):
+    tunnel_ids = job['payload'].get('tunnel_ids') or [job['tunnel_id']]
+    tunnels = [tunnel for tunnel in (get_tunnel(tunnel_id, 'admin', job['user_id']) for tunnel_id in tunnel_ids) if tunnel]
+    if not tunnels:
+        raise JobFailed("⚠️ تونل یافت نشد یا قبلاً حذف شده است!")
+
+    names = "، ".join(f"'{tunnel['tunnel_name']}'" for tunnel in tunnels)
+    await notify_job(job, f"⏳ لطفاً منتظر بمانید، در حال حذف تونل {names} هستیم...")
+
+    set_job_progress(job, "حذف تنظیمات سرورها")
+    job.setdefault('spans', [])
+    deleting = [tunnel['tunnel_id'] for tunnel in tunnels]
+    results = await asyncio.gather(*[teardown_tunnel(dict(job, tunnel_id=tunnel['tunnel_id']), tunnel, deleting) for tunnel in tunnels], return_exceptions=True)
+    failures = [result for result in results if isinstance(result, Exception)]
+    if len(failures) == len(tunnels):
+        raise failures[0] if len(failures) == 1 else JobFailed("\n\n".join(str(failure) for failure in failures))
+    for failure in failures:
+        await notify_job(job, str(failure))
+    if len(tunnels) > 1:
+        await notify_job(job, f"🗑 {len(tunnels) - len(failures)} از {len(tunnels)} تونل حذف شد.")
+
+STANDBY_LIMIT = getattr(config, 'STANDBY_LIMIT', 3)
+FAILOVER_INTERVAL = getattr(config, 'FAILOVER_INTERVAL', 5)
+# without the agent every probe is a fresh SSH login to the Iran server, so those tunnels are probed far less often
+FAILOVER_SSH_INTERVAL = getattr(config, 'FAILOVER_SSH_INTERVAL', 60)
+FAILOVER_DOWN_PROBES = getattr(config, 'FAILOVER_DOWN_PROBES', 2)
+FAILOVER_UP_PROBES = getattr(config, 'FAILOVER_UP_PROBES', 6)
+FAILOVER_CONCURRENCY = getattr(config, 'FAILOVER_CONCURRENCY', 20)
+FAILOVER_SERVICE_IP = "172.20.40.2"
+FAILOVER_IRAN_IP = "172.20.40.1"
+FAILOVER_STATE = {}
+FAILOVER_SSH_PROBED = {}
+
+def standby_addresses(slot):
+    return {
+        "iran_gre": f"172.20.{40 + slot}.1",
+        "standby_gre": f"172.20.{40 + slot}.2",
+        "iran_ipv6": f"2002:504b:{0xd769 + slot:x}::2",
+        "standby_ipv6": f"2002:504b:{0xd769 + slot:x}::1",
+        "sit_interface": f"6to4_To_SB{slot}",
+        "gre_interface": f"GRE6Tun_To_SB{slot}",
+        "script": f"/etc/evara-standby-{slot}.sh",
+        "ipsec_id": f"standby{slot}"
+    }
+
+def list_standbys(tunnel_id):
+    conn = db_connect()
+    conn.row_factory = sqlite3.Row
+    c = conn.cursor()
+    c.execute('SELECT * FROM standby_servers WHERE tunnel_id = ? ORDER BY slot', (tunnel_id,))
+    standbys = [dict(row) for row in c.fetchall()]
+    conn.close()
+    return standbys
+
+def save_standby(tunnel_id, slot, server_ip, username, password):
+    conn = db_connect()
+    c = conn.cursor()
+    c.execute('INSERT OR REPLACE INTO standby_servers (tunnel_id, slot, server_ip, username, password) VALUES (?, ?, ?, ?, ?)', (tunnel_id, slot, server_ip, username, password))
+    conn.commit()
+    conn.close()
+
+def record_failover(tunnel_id, from_slot, to_slot, reason):
+    conn = db_connect()
+    c = conn.cursor()
+    c.execute('UPDATE standby_servers SET active = (slot = ?) WHERE tunnel_id = ?', (to_slot, tunnel_id))
+    c.execute('INSERT INTO failover_events (tunnel_id, happened_at, from_slot, to_slot, reason) VALUES (?, ?, ?, ?, ?)', (tunnel_id, time.time(), from_slot, to_slot, reason))
+    conn.commit()
+    conn.close()
+
+def get_failover_events(tunnel_id, limit=5):
+    conn = db_connect()
+    c = conn.cursor()
+    c.execute('SELECT happened_at, from_slot, to_slot, reason FROM failover_events WHERE tunnel_id = ? ORDER BY happened_at DESC LIMIT ?', (tunnel_id, limit))
+    events = c.fetchall()
+    conn.close()
+    return events
+
+def endpoint_label(slot):
+    return "سرور خارج اصلی" if slot == 0 else f"سرور پشتیبان {slot}"
+
+async def run_standby_job(job):
+    data = job['payload']
+    register_secret(data['password'])
+    tunnel = get_tunnel(job['tunnel_id'], 'admin', job['user_id'])
+    if not tunnel:
+        raise JobFailed("⚠️ تونل یافت نشد یا قبلاً حذف شده است!")
+    register_secret(tunnel['psk'])
+    slots = [standby['slot'] for standby in list_standbys(tunnel['tunnel_id'])]
+    slot = next((slot for slot in range(1, STANDBY_LIMIT + 1) if slot not in slots), None)
+    if slot is None:
+        raise JobFailed(f"⚠️ این تونل از قبل {STANDBY_LIMIT} سرور پشتیبان دارد.")
+    addresses = standby_addresses(slot)
+    standby_ip = data['server_ip']
+
+    with trace_span(job, "prerequisites"):
+        await notify_job(job, f"⏳ در حال نصب پیش‌نیازها روی سرور پشتیبان {standby_ip}...")
+        with trace_span(job, "facts"):
+            facts = await fetch_host_facts(job, standby_ip, data['username'], data['password'])
+        await install_server_packages(job, standby_ip, data['username'], data['password'], facts, ["sudo apt update", "sudo apt install strongswan strongswan-starter -y"], "نصب پیش‌نیازها روی سرور پشتیبان", "❌ خطا در نصب پیش‌نیازها روی سرور پشتیبان")
+
+    # the standby also answers on the service address, so the Iran side only has to move a /32 route to fail over
+    standby_rc_local_content = f"""#!/bin/bash
+ip tunnel add 6to4_To_KH mode sit remote {tunnel['iran_ip']} local {standby_ip}
+ip -6 addr add {addresses['standby_ipv6']}/64 dev 6to4_To_KH
+ip link set 6to4_To_KH mtu {tunnel['mtu_6to4']}
+ip link set 6to4_To_KH up
+
+# GRE over IPv6
+ip -6 tunnel add GRE6Tun_To_KH mode ip6gre remote {addresses['iran_ipv6']} local {addresses['standby_ipv6']}
+ip addr add {addresses['standby_gre']}/30 dev GRE6Tun_To_KH
+ip addr add {FAILOVER_SERVICE_IP}/32 dev GRE6Tun_To_KH
+ip link set GRE6Tun_To_KH mtu {tunnel['mtu_gre']}
+ip link set GRE6Tun_To_KH up
+ip route add {FAILOVER_IRAN_IP}/32 dev GRE6Tun_To_KH
+
+exit 0
+"""
+    standby_ipsec_conf_content = f"""config setup
+    charondebug="none"
+
+conn gre6tunnel
+    left={addresses['standby_ipv6']}
+    leftid=@{addresses['ipsec_id']}
+    leftsubnet={addresses['standby_ipv6']}/128
+    right={addresses['iran_ipv6']}
+    rightid=@iran
+    rightsubnet={addresses['iran_ipv6']}/128
+    authby=secret
+    auto=start
+    keyexchange=ikev2
+    ike=aes256-sha2_256-modp2048!
+    esp=aes256-sha2_256!
+"""
+    ipsec_secrets_content = f'@iran @{addresses["ipsec_id"]} : PSK "{tunnel["psk"]}"'
+    standby_recycle_script_content = f"""#!/bin/bash
+ipsec restart
+ip link set GRE6Tun_To_KH down
+ip link set 6to4_To_KH down
+sleep 1
+ip link set 6to4_To_KH up
+ip link set GRE6Tun_To_KH up
+ip route replace {FAILOVER_IRAN_IP}/32 dev GRE6Tun_To_KH
+"""
+    iran_standby_script_content = f"""#!/bin/bash
+ip tunnel add {addresses['sit_interface']} mode sit remote {standby_ip} local {tunnel['iran_ip']}
+ip -6 addr add {addresses['iran_ipv6']}/64 dev {addresses['sit_interface']}
+ip link set {addresses['sit_interface']} mtu {tunnel['mtu_6to4']}
+ip link set {addresses['sit_interface']} up
+
+# GRE over IPv6
+ip -6 tunnel add {addresses['gre_interface']} mode ip6gre remote {addresses['standby_ipv6']} local {addresses['iran_ipv6']}
+ip addr add {addresses['iran_gre']}/30 dev {addresses['gre_interface']}
+ip link set {addresses['gre_interface']} mtu {tunnel['mtu_gre']}
+ip link set {addresses['gre_interface']} up
+"""
+    iran_ipsec_conn_content = f"""
+conn gre6{addresses['ipsec_id']}
+    left={addresses['iran_ipv6']}
+    leftid=@iran
+    leftsubnet={addresses['iran_ipv6']}/128
+    right={addresses['standby_ipv6']}
+    rightid=@{addresses['ipsec_id']}
+    rightsubnet={addresses['standby_ipv6']}/128
+    authby=secret
+    auto=start
+    keyexchange=ikev2
+    ike=aes256-sha2_256-modp2048!
+    esp=aes256-sha2_256!
+"""
+
+    standby_commands = [
+        f"echo '{standby_rc_local_content}' | sudo tee /etc/rc.local",
+        "sudo chmod +x /etc/rc.local",
+        "sudo bash /etc/rc.local",
+        f"echo '{standby_ipsec_conf_content}' | sudo tee /etc/ipsec.conf",
+        f"echo '{ipsec_secrets_content}' | sudo tee /etc/ipsec.secrets",
+        "sudo systemctl enable strongswan-starter",
+        "sudo systemctl restart strongswan-starter",
+        f"echo '{standby_recycle_script_content}' | sudo tee /usr/local/bin/recycle-gre-ipsec.sh",
+        "sudo chmod +x /usr/local/bin/recycle-gre-ipsec.sh"
+    ]
+    if tunnel['crontab_hour']:
+        standby_commands.append(f"(crontab -l 2>/dev/null; echo '0 {tunnel['crontab_hour']} * * * /usr/local/bin/recycle-gre-ipsec.sh >/dev/null 2>&1') | crontab -")
+
+    iran_commands = [
+        f"echo '{iran_standby_script_content}' | sudo tee {addresses['script']}",
+        f"sudo chmod +x {addresses['script']}",
+        f"sudo bash {addresses['script']}",
+        f"grep -q {addresses['script']} /etc/rc.local || sudo sed -i '/^exit 0/i bash {addresses['script']}' /etc/rc.local",
+        f"echo '{iran_ipsec_conn_content}' | sudo tee -a /etc/ipsec.conf",
+        f"echo '{ipsec_secrets_content}' | sudo tee -a /etc/ipsec.secrets",
+        "sudo ipsec rereadsecrets",
+        "sudo ipsec update"
+    ]
+
+    async with host_locks(standby_ip, tunnel['iran_server_ip']):
+        if host_in_use(standby_ip, []):
+            raise JobFailed(HOST_IN_USE_MESSAGE.format(host=standby_ip))
+        with trace_span(job, "configure"):
+            await notify_job(job, "⏳ در حال پیکربندی سرور پشتیبان و مسیر دوم روی سرور ایران...")
+            await run_job_commands(job, standby_ip, data['username'], data['password'], standby_commands, "پیکربندی سرور پشتیبان", "❌ خطا در پیکربندی سرور پشتیبان")
+            await run_job_commands(job, tunnel['iran_server_ip'], tunnel['iran_username'], tunnel['iran_password'], iran_commands, "پیکربندی مسیر پشتیبان روی سرور ایران", "❌ خطا در پیکربندی مسیر پشتیبان روی سرور ایران")
+
+    set_job_progress(job, "ذخیره در دیتابیس")
+    with trace_span(job, "db"):
+        save_standby(tunnel['tunnel_id'], slot, standby_ip, data['username'], data['password'])
+    if AGENT_ENABLED or get_agent(tunnel['iran_server_ip']):
+        await install_agents(job, [
+            (standby_ip, data['username'], data['password'], "نصب ایجنت روی سرور پشتیبان"),
+            (tunnel['iran_server_ip'], tunnel['iran_username'], tunnel['iran_password'], "به‌روزرسانی ایجنت سرور ایران")
+        ])
+    await notify_job(job, f"✅ سرور پشتیبان {slot} ({standby_ip}) برای تونل '{tunnel['tunnel_name']}' آماده شد.\nاگر سرور خارج اصلی قطع شود، مسیر {FAILOVER_SERVICE_IP} روی سرور ایران خودکار به این سرور منتقل می‌شود. سرویس‌هایی که روی سرور خارج اصلی اجرا می‌کنید باید روی سرور پشتیبان هم باشند.")
+
+def list_failover_targets():
+    conn = db_connect()
+    conn.row_factory = sqlite3.Row
+    c = conn.cursor()
+    c.execute('SELECT DISTINCT tunnels.* FROM tunnels JOIN standby_servers USING (tunnel_id)')
+    tunnels = [dict(row) for row in c.fetchall()]
+    conn.close()
+    for tunnel in tunnels:
+        tunnel['standbys'] = list_standbys(tunnel['tunnel_id'])
+    return tunnels
+
+def failover_probe_command(tunnel):
+    command = f"echo {PING_MARKER} 0; ping -c 2 -i 0.2 -W 1 -q -I GRE6Tun_To_IR {FAILOVER_SERVICE_IP}"
+    for standby in tunnel['standbys']:
+        addresses = standby_addresses(standby['slot'])
+        command += f"; echo {PING_MARKER} {standby['slot']}; ping -c 2 -i 0.2 -W 1 -q -I {addresses['gre_interface']} {addresses['standby_gre']}"
+    return command + "; true"
+
+async def switch_failover_route(tunnel, slot):
+    if slot == 0:
+        command = f"sudo ip route del {FAILOVER_SERVICE_IP}/32 || true"
+    else:
+        command = f"sudo ip route replace {FAILOVER_SERVICE_IP}/32 dev {standby_addresses(slot)['gre_interface']} src {FAILOVER_IRAN_IP}"
+    result = await stream_ssh_command(tunnel['iran_server_ip'], tunnel['iran_username'], tunnel['iran_password'], command, timeout=COMMAND_TIMEOUTS["short"], tunnel_id=tunnel['tunnel_id'], step="failover")
+    return not result["error"] and result["exit_status"] == 0
+
+async def probe_failover_endpoints(tunnel, semaphore):
+    interfaces = {0: "GRE6Tun_To_IR"}
+    interfaces.update({standby['slot']: standby_addresses(standby['slot'])['gre_interface'] for standby in tunnel['standbys']})
+    async with semaphore:
+        status = await fetch_agent_status(tunnel['iran_server_ip'])
+        pings = {slot: agent_ping(status, interface) for slot, interface in interfaces.items()} if status else {}
+        if pings and None not in pings.values():
+            return {slot: loss < 100 for slot, (_, loss) in pings.items()}
+        if time.monotonic() - FAILOVER_SSH_PROBED.get(tunnel['tunnel_id'], 0) < FAILOVER_SSH_INTERVAL:
+            return None
+        FAILOVER_SSH_PROBED[tunnel['tunnel_id']] = time.monotonic()
+        result = await stream_ssh_command(tunnel['iran_server_ip'], tunnel['iran_username'], tunnel['iran_password'], failover_probe_command(tunnel), timeout=COMMAND_TIMEOUTS["short"], tunnel_id=tunnel['tunnel_id'], step="failover")
+    if result["error"] or result["exit_status"] != 0:
+        return None
+    healthy = {}
+    for section in result["stdout"].split(PING_MARKER)[1:]:
+        slot, _, output = section.strip().partition("\n")
+        _, loss = parse_ping(output)
+        healthy[int(slot)] = loss is not None and loss < 100
+    return healthy
+
+async def probe_failover(tunnel, semaphore):
+    healthy = await probe_failover_endpoints(tunnel, semaphore)
+    if healthy is None:
+        # without the Iran server there is no route to move
+        return
+    state = FAILOVER_STATE.setdefault(tunnel['tunnel_id'], {"down": 0, "up": 0})
+    active = next((standby['slot'] for standby in tunnel['standbys'] if standby['active']), 0)
+    state["down"] = 0 if healthy.get(0) else state["down"] + 1
+    state["up"] = state["up"] + 1 if healthy.get(0) else 0
+    standby = next((slot for slot in sorted(healthy) if slot and healthy[slot]), None)
+    target, reason = None, None
+    if active == 0:
+        if state["down"] >= FAILOVER_DOWN_PROBES:
+            target, reason = standby, "primary down"
+    elif healthy.get(0) and (state["up"] >= FAILOVER_UP_PROBES or not healthy.get(active)):
+        target, reason = 0, "primary recovered"
+    elif not healthy.get(active):
+        target, reason = standby, f"standby {active} down"
+    if target is None or target == active:
+        return
+    started = time.monotonic()
+    if not await switch_failover_route(tunnel, target):
+        log_event(logging.WARNING, "failover switch failed", tunnel_id=tunnel['tunnel_id'], from_slot=active, to_slot=target)
+        return
+    record_failover(tunnel['tunnel_id'], active, target, reason)
+    state["down"] = state["up"] = 0
+    inc("evara_failovers", reason=reason.split()[0])
+    log_event(logging.WARNING, "tunnel failover", tunnel_id=tunnel['tunnel_id'], from_slot=active, to_slot=target, reason=reason, duration=time.monotonic() - started)
+    await send_alert(tunnel, [f"🔀 مسیر {FAILOVER_SERVICE_IP} از {endpoint_label(active)} به {endpoint_label(target)} منتقل شد."])
+
+async def failover_monitor():
+    semaphore = asyncio.Semaphore(FAILOVER_CONCURRENCY)
+    while True:
+        started = time.monotonic()
+        if not IS_LEADER:
+            await asyncio.sleep(FAILOVER_INTERVAL)
+            continue
+        try:
+            tunnels = list_failover_targets()
+            # tunnels deleted or left without a standby since the last round take their counters with them
+            current = {tunnel['tunnel_id'] for tunnel in tunnels}
+            for probed in (FAILOVER_STATE, FAILOVER_SSH_PROBED):
+                for tunnel_id in probed.keys() - current:
+                    del probed[tunnel_id]
+            await asyncio.gather(*[probe_failover(tunnel, semaphore) for tunnel in tunnels])
+        except Exception as e:
+            log_event(logging.WARNING, "failover monitor failed", error=str(e))
+        await asyncio.sleep(max(FAILOVER_INTERVAL - (time.monotonic() - started), 0.5))
+
+FORWARD_TABLE = "evara_forward"
+FORWARD_FILE = "/etc/evara-forward.nft"
+FORWARD_UPDATE_FILE = "/etc/evara-forward.update.nft"
+FORWARD_PROTOCOLS = ("tcp", "udp")
+FORWARD_RULE_LIMIT = getattr(config, 'FORWARD_RULE_LIMIT', 100)
+FORWARD_COUNTERS_COMMAND = f"sudo nft list counters table ip {FORWARD_TABLE} 2>/dev/null || true"
+FORWARD_UNIT = f"""[Unit]
+Description=Evara port forwarding
+After=network-pre.target
+Wants=network-pre.target
+
+[Service]
+Type=oneshot
+ExecStart=/usr/sbin/nft -f {FORWARD_FILE}
+RemainAfterExit=yes
+
+[Install]
+WantedBy=multi-user.target
+"""
+
+FORWARD_CLEANUP_COMMANDS = [
+    f"sudo nft delete table ip {FORWARD_TABLE} 2>/dev/null || true",
+    "sudo systemctl disable evara-forward >/dev/null 2>&1 || true",
+    f"sudo rm -f {FORWARD_FILE} /etc/systemd/system/evara-forward.service /etc/sysctl.d/99-evara-forward.conf",
+    f"sudo ufw route delete allow to {FAILOVER_SERVICE_IP} >/dev/null 2>&1 || true"
+]
+
+def parse_port_range(spec):
+    start, _, end = spec.partition("-")
+    start, end = int(start), int(end or start)
+    if not 0 < start <= end <= 65535:
+        raise ValueError(spec)
+    return start, end
+
+def format_port_range(rule):
+    return str(rule['port_start']) if rule['port_start'] == rule['port_end'] else f"{rule['port_start']}-{rule['port_end']}"
+
+def forward_key(rule):
+    return rule['tunnel_id'], rule['protocol'], rule['port_start'], rule['port_end']
+
+def forward_counter_name(rule):
+    return f"fwd_{rule['protocol']}_{format_port_range(rule).replace('-', '_')}"
+
+def list_port_forwards(host):
+    # every tunnel on an Iran server forwards to the same peer address, so the rules live in one table per server
+    conn = db_connect()
+    conn.row_factory = sqlite3.Row
+    c = conn.cursor()
+    c.execute('''
+        SELECT port_forwards.* FROM port_forwards JOIN tunnels USING (tunnel_id)
+        WHERE tunnels.iran_server_ip = ? ORDER BY port_forwards.port_start, port_forwards.protocol
+    ''', (host,))
+    rules = [dict(row) for row in c.fetchall()]
+    conn.close()
+    return rules
+
+def save_port_forwards(added, removed):
+    conn = db_connect()
+    c = conn.cursor()
+    c.executemany('DELETE FROM port_forwards WHERE tunnel_id = ? AND protocol = ? AND port_start = ?', [(rule['tunnel_id'], rule['protocol'], rule['port_start']) for rule in removed])
+    c.executemany('INSERT INTO port_forwards (tunnel_id, protocol, port_start, port_end) VALUES (?, ?, ?, ?)', [(rule['tunnel_id'], rule['protocol'], rule['port_start'], rule['port_end']) for rule in added])
+    conn.commit()
+    conn.close()
+
+def forward_conflict(rules, rule):
+    reserved = {"tcp": [SSH_PORT, AGENT_PORT], "udp": [WG_PORT]}[rule['protocol']]
+    port = next((port for port in reserved if rule['port_start'] <= port <= rule['port_end']), None)
+    if port:
+        return f"⚠️ پورت {rule['protocol']}/{port} توسط خود ربات و تونل استفاده می‌شود و قابل فوروارد نیست."
+    for other in rules:
+        if other['protocol'] == rule['protocol'] and other['port_start'] <= rule['port_end'] and rule['port_start'] <= other['port_end']:
+            return f"⚠️ {rule['protocol']}/{format_port_range(rule)} با {rule['protocol']}/{format_port_range(other)} که قبلاً روی این سرور فوروارد شده تداخل دارد."
+    return None
+
+def forward_ruleset(rules, removed=()):
+    # one nft transaction: existing counters are kept, the chains are flushed and refilled, and
+    # established flows keep their conntrack NAT binding while the rules around them change
+    lines = [f"table ip {FORWARD_TABLE} {{"]
+    lines += [f"\tcounter {forward_counter_name(rule)} {{\n\t}}" for rule in [*rules, *removed]]
+    lines += [
+        "\tchain prerouting {\n\t\ttype nat hook prerouting priority -100; policy accept;\n\t}",
+        "\tchain postrouting {\n\t\ttype nat hook postrouting priority 100; policy accept;\n\t}",
+        "}",
+        f"flush chain ip {FORWARD_TABLE} prerouting",
+        f"flush chain ip {FORWARD_TABLE} postrouting"
+    ]
+    lines += [
+        f"add rule ip {FORWARD_TABLE} prerouting fib daddr type local {rule['protocol']} dport {format_port_range(rule)} counter name {forward_counter_name(rule)} dnat to {FAILOVER_SERVICE_IP}"
+        for rule in rules
+    ]
+    lines.append(f"add rule ip {FORWARD_TABLE} postrouting ip daddr {FAILOVER_SERVICE_IP} ct status dnat masquerade")
+    lines += [f"delete counter ip {FORWARD_TABLE} {forward_counter_name(rule)}" for rule in removed]
+    return "\n".join(lines) + "\n"
+
+def forward_commands(rules, removed=()):
+    if not rules:
+        return list(FORWARD_CLEANUP_COMMANDS)
+    return [
+        "command -v nft >/dev/null || sudo DEBIAN_FRONTEND=noninteractive apt-get install -y nftables",
+        "echo 'net.ipv4.ip_forward = 1' | sudo tee /etc/sysctl.d/99-evara-forward.conf >/dev/null && sudo sysctl -q -w net.ipv4.ip_forward=1",
+        f"if sudo ufw status 2>/dev/null | grep -q 'Status: active'; then sudo ufw route allow to {FAILOVER_SERVICE_IP} >/dev/null; fi",
+        encode_remote_file(forward_ruleset(rules, removed), FORWARD_UPDATE_FILE, "600"),
+        f"sudo nft -f {FORWARD_UPDATE_FILE} && sudo rm -f {FORWARD_UPDATE_FILE}",
+        encode_remote_file(forward_ruleset(rules), FORWARD_FILE, "600"),
+        encode_remote_file(FORWARD_UNIT, "/etc/systemd/system/evara-forward.service", "644"),
+        "sudo systemctl daemon-reload && sudo systemctl enable evara-forward >/dev/null 2>&1"
+    ]
+
+def forward_teardown_commands(host, deleting):
+    rules = list_port_forwards(host)
+    removed = [rule for rule in rules if rule['tunnel_id'] in deleting]
+    if not removed:
+        return []
+    return forward_commands([rule for rule in rules if rule['tunnel_id'] not in deleting], removed)
+
+def parse_forward_counters(output):
+    return {
+        name: (int(packets), int(byte_count))
+        for name, packets, byte_count in re.findall(r"counter (\w+) \{\s*packets (\d+) bytes (\d+)", output)
+    }
+
+async def fetch_forward_counters(host, username, password):
+    result = await stream_ssh_command(host, username, password, FORWARD_COUNTERS_COMMAND, timeout=COMMAND_TIMEOUTS["short"], step="forward")
+    if result["error"]:
+        log_event(logging.INFO, "forward counters failed", host=host, error=result["error"])
+        return None
+    return parse_forward_counters(result["stdout"])
+
+def format_port_forwards(tunnel, rules, counters):
+    own = [rule for rule in rules if rule['tunnel_id'] == tunnel['tunnel_id']]
+    response = f"🔀 فوروارد پورت‌های تونل '{tunnel['tunnel_name']}' ({tunnel['iran_server_ip']} ← {FAILOVER_SERVICE_IP}):\n"
+    if not own:
+        return response + "هیچ پورتی فوروارد نشده است."
+    for rule in own:
+        line = f"• {rule['protocol']}/{format_port_range(rule)}"
+        hits = counters.get(forward_counter_name(rule)) if counters is not None else None
+        if hits:
+            line += f" — {hits[0]} بسته، {hits[1] / 1e6:.1f} MB"
+        elif counters is not None:
+            line += " — ⚠️ روی سرور بارگذاری نشده"
+        response += line + "\n"
+    if counters is None:
+        response += "⚠️ شمارنده‌ها از سرور ایران خوانده نشد."
+    return response.rstrip("\n")
+
+async def run_forward_job(job):
+    data = job['payload']
+    tunnel = get_tunnel(job['tunnel_id'], 'admin', job['user_id'])
+    if not tunnel:
+        raise JobFailed("⚠️ تونل یافت نشد یا قبلاً حذف شده است!")
+    host = tunnel['iran_server_ip']
+    requested = [{"tunnel_id": tunnel['tunnel_id'], "protocol": protocol, "port_start": start, "port_end": end} for protocol, start, end in data['rules']]
+    async with host_lock(host):
+        rules = list_port_forwards(host)
+        if data['action'] == "add":
+            for rule in requested:
+                conflict = forward_conflict(rules, rule)
+                if conflict:
+                    raise JobFailed(conflict)
+                rules.append(rule)
+            added, removed = requested, []
+        else:
+            keys = [forward_key(rule) for rule in requested]
+            removed = [rule for rule in rules if forward_key(rule) in keys]
+            if not removed:
+                raise JobFailed("⚠️ هیچ‌کدام از این پورت‌ها برای این تونل فوروارد نشده است.")
+            rules = [rule for rule in rules if forward_key(rule) not in keys]
+            added = []
+        set_job_progress(job, "اعمال قوانین nftables")
+        with trace_span(job, "forward", rules=len(rules)):
+            await run_job_commands(job, host, tunnel['iran_username'], tunnel['iran_password'], forward_commands(rules, removed), "اعمال فوروارد پورت روی سرور ایران", "❌ خطا در اعمال فوروارد پورت روی سرور ایران")
+        with trace_span(job, "db"):
+            save_port_forwards(added, removed)
+    counters = await fetch_forward_counters(host, tunnel['iran_username'], tunnel['iran_password'])
+    await notify_job(job, "✅ قوانین فوروارد یکجا روی سرور ایران بارگذاری شد؛ اتصال‌های برقرار قطع نشدند.\n\n" + format_port_forwards(tunnel, list_port_forwards(host), counters))
+
+AGENT_ENABLED = getattr(config, 'AGENT_ENABLED', False)
+AGENT_PORT = getattr(config, 'AGENT_PORT', 9477)
+AGENT_INTERVAL = getattr(config, 'AGENT_INTERVAL', 5)
+AGENT_TIMEOUT = getattr(config, 'AGENT_TIMEOUT', 3)
+AGENT_RETRY_AFTER = getattr(config, 'AGENT_RETRY_AFTER', 60)
+AGENT_ALLOWED_SOURCES = getattr(config, 'AGENT_ALLOWED_SOURCES', [])
+AGENT_FIREWALL_FILE = "/etc/evara-agent.nft"
+AGENT_FIREWALL_TABLE = "evara_agent"
+AGENT_CLIENT_COMMAND = 'echo "evara-client ${SSH_CLIENT%% *}"'
+AGENT_BACKOFF = {}
+AGENT_SESSION = None
+# the agent only accepts request stamps within a minute of its own clock; the offset learned from its Date header
+# is added to every stamp, so a server whose clock is off still answers
+AGENT_CLOCK_OFFSETS = {}
+AGENT_CLOCK_TOLERANCE = 30
+
+AGENT_SCRIPT = r"""#!/usr/bin/env python3
+import hashlib, hmac, http.server, json, subprocess, sys, threading, time
+
+CONFIG = json.load(open(sys.argv[1]))
+STATE = {"net_dev": "", "net_dev_at": 0, "pings": {}, "ipsec": {"output": "", "at": 0}, "wireguard": {"output": "", "at": 0}, "cpu": {"output": "", "at": 0}}
+LOCK = threading.Lock()
+
+def run(command, timeout):
+    try:
+        return subprocess.run(command, capture_output=True, text=True, timeout=timeout).stdout
+    except (OSError, subprocess.SubprocessError) as e:
+        return str(e)
+
+def ping(interface, target):
+    output = run(["ping", "-c", "3", "-i", "0.2", "-W", "1", "-q", "-I", interface, target], 5)
+    with LOCK:
+        STATE["pings"][interface] = {"target": target, "output": output, "at": time.time()}
+
+def collect():
+    while True:
+        started = time.time()
+        with open("/proc/net/dev") as f:
+            net_dev = f.read()
+        with LOCK:
+            STATE["net_dev"], STATE["net_dev_at"] = net_dev, time.time()
+        threads = [threading.Thread(target=ping, args=item) for item in CONFIG["pings"].items()]
+        for thread in threads:
+            thread.start()
+        ipsec = run(["ipsec", "status"], 5)
+        wireguard = run(["sh", "-c", "date +%s; wg show all dump 2>/dev/null | awk 'NF == 9 {print $1, $4, $6, $7, $8}'"], 5)
+        cpu = run(["sh", "-c", "nproc; grep -c '^name *: pcrypt(' /proc/crypto; ip xfrm state | grep -o 'pcpu-num [0-9]*' | sort | uniq -c | sed 's/^/pcpu /'; grep '^ *NET_RX:' /proc/softirqs"], 5)
+        with LOCK:
+            STATE["ipsec"] = {"output": ipsec, "at": time.time()}
+            STATE["wireguard"] = {"output": wireguard, "at": time.time()}
+            STATE["cpu"] = {"output": cpu, "at": time.time()}
+        for thread in threads:
+            thread.join()
+        time.sleep(max(CONFIG["interval"] - (time.time() - started), 0.5))
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.client_address[0] not in CONFIG["allow"] and not self.client_address[0].startswith("127."):
+            self.send_error(403)
+            return
+        stamp = self.headers.get("X-Evara-Time", "")
+        expected = hmac.new(CONFIG["token"].encode(), f"{stamp}:{self.path}".encode(), hashlib.sha256).hexdigest()
+        try:
+            fresh = abs(time.time() - float(stamp)) < 60
+        except ValueError:
+            fresh = False
+        if self.path != "/v1/status" or not fresh or not hmac.compare_digest(expected, self.headers.get("X-Evara-Signature", "")):
+            self.send_error(403)
+            return
+        with LOCK:
+            body = json.dumps(dict(STATE, time=time.time())).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+threading.Thread(target=collect, daemon=True).start()
+http.server.ThreadingHTTPServer(("", CONFIG["port"]), Handler).serve_forever()
+"""
+
+AGENT_UNIT = """[Unit]
+Description=Evara tunnel agent
+After=network-online.target
+
+[Service]
+ExecStartPre=-/usr/sbin/nft -f {firewall}
+ExecStart=/usr/bin/python3 /usr/local/bin/evara-agent /etc/evara-agent.json
+ExecStopPost=-/usr/sbin/nft delete table inet {table}
+Restart=always
+RestartSec=5
+
+[Install]
+WantedBy=multi-user.target
+""".replace("{firewall}", AGENT_FIREWALL_FILE).replace("{table}", AGENT_FIREWALL_TABLE)
+
+AGENT_CLEANUP_COMMANDS = [
+    "sudo systemctl disable --now evara-agent || true",
+    f"sudo nft delete table inet {AGENT_FIREWALL_TABLE} 2>/dev/null || true",
+    f"sudo rm -f /etc/systemd/system/evara-agent.service /usr/local/bin/evara-agent /etc/evara-agent.json {AGENT_FIREWALL_FILE}"
+]
+
+def agent_firewall(port, sources):
+    # the bot runs outside both servers and cannot reach the 172.20.40.0/30 tunnel addresses, so the agent
+    # listens on the public address and only the bot's own address may connect to its port
+    lines = [
+        f"table inet {AGENT_FIREWALL_TABLE}",
+        f"delete table inet {AGENT_FIREWALL_TABLE}",
+        f"table inet {AGENT_FIREWALL_TABLE} {{",
+        "    chain input {",
+        "        type filter hook input priority -10; policy accept;",
+        f'        iif "lo" tcp dport {port} accept'
+    ]
+    for family, addresses in (("ip", [source for source in sources if ":" not in source]), ("ip6", [source for source in sources if ":" in source])):
+        if addresses:
+            lines.append(f"        {family} saddr {{ {', '.join(addresses)} }} tcp dport {port} accept")
+    lines += [f"        tcp dport {port} drop", "    }", "}"]
+    return "\n".join(lines) + "\n"
+
+async def agent_allowed_sources(job, host, username, password):
+    if AGENT_ALLOWED_SOURCES:
+        return list(AGENT_ALLOWED_SOURCES)
+    # sshd reports the address our connection arrives from, which is also where the status requests will come from
+    result = await stream_ssh_command(host, username, password, AGENT_CLIENT_COMMAND, timeout=COMMAND_TIMEOUTS["short"], deadline=job.get('deadline'), tunnel_id=job['tunnel_id'], step="agent")
+    return [line.split()[1] for line in result["stdout"].splitlines() if line.startswith("evara-client ") and len(line.split()) == 2]
+
+def get_agent(host):
+    conn = db_connect()
+    c = conn.cursor()
+    c.execute('SELECT port, token FROM agents WHERE host = ?', (host,))
+    row = c.fetchone()
+    conn.close()
+    return {"host": host, "port": row[0], "token": row[1]} if row else None
+
+def save_agent(host, port, token):
+    conn = db_connect()
+    c = conn.cursor()
+    c.execute('INSERT OR REPLACE INTO agents (host, port, token) VALUES (?, ?, ?)', (host, port, token))
+    conn.commit()
+    conn.close()
+
+def delete_agents(hosts):
+    conn = db_connect()
+    c = conn.cursor()
+    c.executemany('DELETE FROM agents WHERE host = ?', [(host,) for host in hosts])
+    conn.commit()
+    conn.close()
+
+def agent_ping_targets(host):
+    conn = db_connect()
+    c = conn.cursor()
+    c.execute('SELECT tunnel_id, tunnel_mode FROM tunnels WHERE iran_server_ip = ?', (host,))
+    iran_tunnels = c.fetchall()
+    c.execute("SELECT tunnel_mode FROM tunnels WHERE kharej_server_ip = ? UNION SELECT 'gre' FROM standby_servers WHERE server_ip = ?", (host, host))
+    kharej_modes = [row[0] for row in c.fetchall()]
+    conn.close()
+    targets = {}
+    for mode in kharej_modes:
+        targets[TUNNEL_INTERFACES[mode]["kharej"][0]] = GRE_PEERS["kharej"]
+    for tunnel_id, mode in iran_tunnels:
+        targets[TUNNEL_INTERFACES[mode]["iran"][0]] = GRE_PEERS["iran"]
+        for standby in list_standbys(tunnel_id):
+            addresses = standby_addresses(standby['slot'])
+            targets[addresses['gre_interface']] = addresses['standby_gre']
+    return targets
+
+def encode_remote_file(content, path, mode):
+    encoded = base64.b64encode(content.encode()).decode()
+    return f"echo {encoded} | base64 -d | sudo tee {path} >/dev/null && sudo chmod {mode} {path}"
+
+async def install_agent(job, host, username, password, label):
+    # reuses the existing token so a reinstall (e.g. after adding a standby) only refreshes the ping targets
+    agent = get_agent(host) or {"port": AGENT_PORT, "token": secrets.token_hex(16)}
+    register_secret(agent['token'])
+    sources = await agent_allowed_sources(job, host, username, password)
+    if not sources:
+        await notify_job(job, f"⚠️ نصب ایجنت روی {host} انجام نشد چون آدرس ربات از دید سرور مشخص نشد؛ AGENT_ALLOWED_SOURCES را در config.py تنظیم کنید. وضعیت این سرور مثل قبل از طریق SSH بررسی می‌شود.")
+        return False
+    agent_config = json.dumps({"port": agent['port'], "token": agent['token'], "interval": AGENT_INTERVAL, "pings": agent_ping_targets(host), "allow": sources})
+    commands = [
+        "command -v nft >/dev/null || sudo DEBIAN_FRONTEND=noninteractive apt-get install -y nftables",
+        encode_remote_file(agent_firewall(agent['port'], sources), AGENT_FIREWALL_FILE, "600"),
+        f"sudo nft -f {AGENT_FIREWALL_FILE}",
+        encode_remote_file(AGENT_SCRIPT, "/usr/local/bin/evara-agent", "755"),
+        encode_remote_file(agent_config, "/etc/evara-agent.json", "600"),
+        encode_remote_file(AGENT_UNIT, "/etc/systemd/system/evara-agent.service", "644"),
+        "sudo systemctl daemon-reload",
+        "sudo systemctl enable evara-agent",
+        "sudo systemctl restart evara-agent"
+    ]
+    try:
+        await run_job_commands(job, host, username, password, commands, label, f"⚠️ نصب ایجنت روی {host} ناموفق بود؛ وضعیت این سرور مثل قبل از طریق SSH بررسی می‌شود.")
+    except JobFailed as e:
+        await notify_job(job, str(e))
+        return False
+    save_agent(host, agent['port'], agent['token'])
+    AGENT_BACKOFF.pop(host, None)
+    return True
+
+async def install_agents(job, servers):
+    with trace_span(job, "agent"):
+        for host, username, password, label in servers:
+            await install_agent(job, host, username, password, label)
+
+async def fetch_agent_status(host):
+    global AGENT_SESSION
+    if time.monotonic() < AGENT_BACKOFF.get(host, 0):
+        return None
+    agent = get_agent(host)
+    if not agent:
+        return None
+    if AGENT_SESSION is None:
+        AGENT_SESSION = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=AGENT_TIMEOUT))
+    path = "/v1/status"
+    started = time.monotonic()
+    try:
+        for attempt in range(2):
+            stamp = f"{time.time() + AGENT_CLOCK_OFFSETS.get(host, 0):.3f}"
+            signature = hmac.new(agent['token'].encode(), f"{stamp}:{path}".encode(), hashlib.sha256).hexdigest()
+            async with AGENT_SESSION.get(f"http://{host}:{agent['port']}{path}", headers={"X-Evara-Time": stamp, "X-Evara-Signature": signature}) as response:
+                if response.status == 403 and not attempt and response.headers.get("Date"):
+                    offset = parsedate_to_datetime(response.headers["Date"]).timestamp() - time.time()
+                    if abs(offset - AGENT_CLOCK_OFFSETS.get(host, 0)) >= AGENT_CLOCK_TOLERANCE:
+                        AGENT_CLOCK_OFFSETS[host] = offset
+                        log_event(logging.WARNING, "agent clock differs from the bot's, signing with its offset", host=host, offset=round(offset))
+                        continue
+                response.raise_for_status()
+                status = await response.json()
+                break
+    except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, TypeError) as e:
+        AGENT_BACKOFF[host] = time.monotonic() + AGENT_RETRY_AFTER
+        inc("evara_agent_requests", result="error")
+        if isinstance(e, aiohttp.ClientResponseError) and e.status == 403:
+            # not the clock: the token or the source allowlist no longer matches, and only a reinstall fixes that
+            log_event(logging.WARNING, "agent rejected the request, falling back to ssh", host=host)
+        else:
+            log_event(logging.INFO, "agent unavailable, falling back to ssh", host=host, error=str(e) or type(e).__name__)
+        return None
+    inc("evara_agent_requests", result="ok")
+    observe("evara_agent_request_seconds", time.monotonic() - started)
+    # ages are measured on the agent's clock and request stamps carry the learned offset, so the two clocks need not agree
+    status['received_at'] = time.time()
+    return status
+
+def agent_age(status, sampled_at):
+    return status['time'] - sampled_at
+
+def agent_ping(status, interface):
+    ping = status['pings'].get(interface)
+    if not ping or agent_age(status, ping['at']) > 3 * AGENT_INTERVAL:
+        return None
+    rtt_ms, loss = parse_ping(ping['output'])
+    return (rtt_ms, 100.0 if loss is None else loss)
+
+def agent_ipsec_summary(status):
+    if agent_age(status, status['ipsec']['at']) > 3 * AGENT_INTERVAL:
+        return None
+    output = status['ipsec']['output']
+    return len(re.findall(r'ESTABLISHED', output)), len(re.findall(r'INSTALLED', output))
+
+def record_agent_traffic(server, status):
+    sampled_at = status['received_at'] - agent_age(status, status['net_dev_at'])
+    counters = parse_net_dev(status['net_dev'])
+    for tunnel_id, side, mode in server["tunnels"]:
+        for interface in TUNNEL_INTERFACES[mode][side]:
+            if interface in counters:
+                record_traffic(tunnel_id, side, interface, sampled_at, counters[interface])
+        interface = TUNNEL_INTERFACES[mode][side][0]
+        ping = agent_ping(status, interface)
+        if ping:
+            record_latency(tunnel_id, side, status['received_at'] - agent_age(status, status['pings'][interface]['at']), *ping)
+
+def parse_wireguard_status(output, interface):
+    lines = output.strip().splitlines()
+    if not lines or not lines[0].strip().isdigit():
+        return None
+    now = int(lines[0])
+    for line in lines[1:]:
+        fields = line.split()
+        if len(fields) == 5 and fields[0] == interface:
+            handshake = int(fields[2])
+            return {"endpoint": fields[1], "handshake_age": now - handshake if handshake else None, "rx": int(fields[3]), "tx": int(fields[4])}
+    return {"endpoint": None, "handshake_age": None, "rx": 0, "tx": 0}
+
+def agent_wireguard_summary(status, interface):
+    wireguard = status.get('wireguard')
+    if not wireguard or agent_age(status, wireguard['at']) > 3 * AGENT_INTERVAL:
+        return None
+    return parse_wireguard_status(wireguard['output'], interface)
+
+async def fetch_wireguard_summary(host, username, password, interface):
+    result = await stream_ssh_command(host, username, password, WG_STATUS_COMMAND, timeout=COMMAND_TIMEOUTS["short"], step="wireguard")
+    if result["error"]:
+        log_event(logging.INFO, "wireguard status failed", host=host, error=result["error"])
+        return None
+    return parse_wireguard_status(result["stdout"], interface)
+
+SSH_RATE_BURST = getattr(config, 'SSH_RATE_BURST', 4)
+SSH_RATE_PER_MINUTE = getattr(config, 'SSH_RATE_PER_MINUTE', 6)
+PROBES = {}
+
+def single_flight(key, factory):
+    # identical probes already in flight are awaited instead of opening another round of SSH sessions
+    if key in PROBES:
+        inc("evara_probes", kind=key[0], result="shared")
+    else:
+        inc("evara_probes", kind=key[0], result="run")
+        task = PROBES[key] = asyncio.ensure_future(factory())
+        task.add_done_callback(lambda _: PROBES.pop(key, None))
+    return asyncio.shield(PROBES[key])
+
+def take_ssh_token(user_id):
+    # token bucket in the shared database, spent in one write transaction so concurrent taps on any instance can't spend a token twice
+    if user_id == ADMIN_ID or not SSH_RATE_PER_MINUTE:
+        return 0
+    now = time.time()
+    conn = db_connect()
+    c = conn.cursor()
+    c.execute('BEGIN IMMEDIATE')
+    c.execute('SELECT tokens, updated_at FROM ssh_rate WHERE user_id = ?', (user_id,))
+    row = c.fetchone()
+    tokens = min(SSH_RATE_BURST, row[0] + (now - row[1]) * SSH_RATE_PER_MINUTE / 60) if row else SSH_RATE_BURST
+    if tokens >= 1:
+        c.execute('INSERT OR REPLACE INTO ssh_rate (user_id, tokens, updated_at) VALUES (?, ?, ?)', (user_id, tokens - 1, now))
+    conn.commit()
+    conn.close()
+    return 0 if tokens >= 1 else int((1 - tokens) * 60 / SSH_RATE_PER_MINUTE) + 1
+
+async def admit_probe(message, user_id, key, factory):
+    # probes don't move the conversation state, so the user's next update need not wait for the SSH round
+    await release_conversation_lock()
+    if key not in PROBES:
+        wait = await asyncio.get_running_loop().run_in_executor(None, take_ssh_token, user_id)
+        if wait and key not in PROBES:
+            inc("evara_probes", kind=key[0], result="limited")
+            await bot.send_message(
+                chat_id=message.chat.id,
+                text=escape_md(f"🕒 چند بررسی پشت سر هم درخواست کردید؛ برای جلوگیری از اتصال‌های پیاپی به سرورها، نتیجه بعدی را {wait} ثانیه دیگر می‌توانید بگیرید."),
+                parse_mode="MarkdownV2"
+            )
+            return None
+    # join or start with no await after the check: joining a running probe costs no SSH connection, so it is not charged,
+    # and a probe that ended while the token was being spent is started again under that token
+    joined = key in PROBES
+    probe = single_flight(key, factory)
+    if joined:
+        await bot.send_message(
+            chat_id=message.chat.id,
+            text=escape_md("⏳ همین بررسی هم‌اکنون در جریان است؛ نتیجه همان بررسی برای شما هم ارسال می‌شود."),
+            parse_mode="MarkdownV2"
+        )
+    return probe
+
+async def probe_tunnel_status(tunnel, message):
+    mode = tunnel['tunnel_mode']
+    status = {}
+    for side, target_ip, operation in (("iran", "172.20.40.2", "بررسی وضعیت تونل ایران"), ("kharej", "172.20.40.1", "بررسی وضعیت تونل خارج")):
+        status[side] = await tunnel_side_status(tunnel[f'{side}_server_ip'], tunnel[f'{side}_username'], tunnel[f'{side}_password'], mode, side, target_ip, message, operation)
+    if tunnel['qdisc']:
+        status['qos'] = await fetch_tunnel_qdisc_stats(tunnel)
+    return status
+
+async def fetch_tunnel_qdisc_stats(tunnel):
+    mode = tunnel['tunnel_mode']
+    return await asyncio.gather(*[
+        fetch_qdisc_stats(tunnel[f'{side}_server_ip'], tunnel[f'{side}_username'], tunnel[f'{side}_password'], TUNNEL_INTERFACES[mode][side][0])
+        for side in ("iran", "kharej")
+    ])
+
+async def tunnel_side_status(host, username, password, mode, side, target_ip, message, operation):
+    status = await fetch_agent_status(host)
+    interface = TUNNEL_INTERFACES[mode][side][0]
+    ping = agent_ping(status, interface) if status else None
+    if ping:
+        rtt_ms, loss = ping
+        result = {"status": "connected", "rtt": f"{rtt_ms:g}"} if loss < 100 else {"status": "disconnected", "rtt": "N/A"}
+    else:
+        result = await ping_ssh(host, username, password, target_ip, message, operation)
+    if mode == "wireguard":
+        summary = (agent_wireguard_summary(status, interface) if status else None) or await fetch_wireguard_summary(host, username, password, interface)
+    else:
+        summary = {
+            "sas": agent_ipsec_summary(status) if ping else None,
+            "cpu": (agent_ipsec_cpu_summary(status) if status else None) or await fetch_ipsec_cpu_summary(host, username, password)
+        }
+    return result, summary
+
+def format_ipsec_status(summary):
+    response = ""
+    if summary["sas"]:
+        established, installed = summary["sas"]
+        response += f"   🔐 {escape_md(f'IPsec: {established} IKE SA، {installed} CHILD SA فعال (از ایجنت)')}\n"
+    if summary["cpu"]:
+        response += format_ipsec_cpu_status(summary["cpu"])
+    return response
+
+def format_wireguard_status(summary):
+    if not summary:
+        return ""
+    if summary["endpoint"] is None:
+        return f"   ❌ {escape_md('WireGuard: اینترفیس یا peer روی سرور پیدا نشد')}\n"
+    if summary["handshake_age"] is None:
+        return f"   ❌ {escape_md('WireGuard: هنوز هیچ handshake انجام نشده است')}\n"
+    icon = "🔐" if summary["handshake_age"] <= WG_HANDSHAKE_STALE else "⚠️"
+    text = f"WireGuard: آخرین handshake {summary['handshake_age']} ثانیه پیش با {summary['endpoint']} (⬇️ {summary['rx'] / 1e6:.1f} / ⬆️ {summary['tx'] / 1e6:.1f} MB)"
+    return f"   {icon} {escape_md(text)}\n"
+
+FLEET_OPERATIONS = {
+    "status": ("وضعیت IPsec", "sudo ipsec statusall"),
+    "tunnels": ("وضعیت اینترفیس‌های تونل", "ip -brief link show type ip6gre; ip -brief link show type sit; ip -brief link show type wireguard"),
+    "restart": ("ری‌استارت strongswan", "sudo systemctl restart strongswan-starter && systemctl is-active strongswan-starter"),
+    "recycle": ("اجرای اسکریپت ریست تونل", "sudo /usr/local/bin/recycle-gre-ipsec.sh"),
+    "uptime": ("آپتایم و بار سرور", "uptime")
+}
+FLEET_OPERATIONS.update(getattr(config, 'FLEET_SCRIPTS', {}))
+FLEET_FILTERS = ("user", "name", "ip", "side")
+FLEET_CONCURRENCY = getattr(config, 'FLEET_CONCURRENCY', 10)
+FLEET_HOST_TIMEOUT = getattr(config, 'FLEET_HOST_TIMEOUT', 60)
+FLEET_REPORT_LIMIT = 3500
+
+def select_fleet_servers(filters):
+    query = 'SELECT iran_server_ip, iran_username, iran_password, kharej_server_ip, kharej_username, kharej_password FROM tunnels WHERE 1 = 1'
+    params = []
+    if 'user' in filters:
+        query += ' AND user_id = ?'
+        params.append(int(filters['user']))
+    if 'name' in filters:
+        query += ' AND tunnel_name COLLATE NOCASE >= ? AND tunnel_name COLLATE NOCASE < ?'
+        params += [filters['name'], filters['name'] + '\U0010ffff']
+    conn = db_connect()
+    c = conn.cursor()
+    c.execute(query + ' ORDER BY created_at', params)
+    rows = c.fetchall()
+    conn.close()
+    servers = {}
+    for row in rows:
+        sides = []
+        if filters.get('side') in (None, 'iran'):
+            sides.append(row[0:3])
+        if filters.get('side') in (None, 'kharej'):
+            sides.append(row[3:6])
+        for host, username, password in sides:
+            if host.startswith(filters.get('ip', '')) and host not in servers:
+                servers[host] = {"host": host, "username": username, "password": password}
+    return list(servers.values())
+
+def format_fleet_report(title, groups, total):
+    succeeded = sum(len(hosts) for (ok, _), hosts in groups if ok)
+    lines = [f"📋 نتیجه «{title}» روی {total} سرور: ✅ {succeeded} موفق، ❌ {total - succeeded} ناموفق، {len(groups)} خروجی متفاوت"]
+    for index, ((ok, output), hosts) in enumerate(groups, 1):
+        lines.append("")
+        lines.append(f"{'✅' if ok else '❌'} گروه {index} ({len(hosts)} سرور): {', '.join(hosts)}")
+        lines.append(output or "(بدون خروجی)")
+    return "\n".join(lines)
+
+async def run_fleet_job(job):
+    operation = job['payload']['operation']
+    title, command = FLEET_OPERATIONS[operation]
+    servers = select_fleet_servers(job['payload']['filters'])
+    semaphore = asyncio.Semaphore(FLEET_CONCURRENCY)
+    results = {}
+
+    async def run_host(server):
+        async with semaphore:
+            with trace_span(job, f"fleet {server['host']}", operation=operation):
+                result = await stream_ssh_command(server['host'], server['username'], server['password'], command, timeout=FLEET_HOST_TIMEOUT, deadline=job.get('deadline'), step=f"fleet {operation}")
+        output = "\n".join(line.rstrip() for line in (result["stdout"] + result["stderr"]).strip().splitlines())
+        if result["error"]:
+            results[server['host']] = (False, result["error"].split(" - ")[0].replace(server['host'], "<host>"))
+        else:
+            results[server['host']] = (result["exit_status"] == 0, output if result["exit_status"] == 0 else f"exit {result['exit_status']}\n{output}")
+        set_job_progress(job, f"{len(results)}/{len(servers)} سرور")
+
+    await notify_job(job, f"🛰 اجرای «{title}» روی {len(servers)} سرور با حداکثر {FLEET_CONCURRENCY} اتصال هم‌زمان...")
+    await asyncio.gather(*[run_host(server) for server in servers])
+
+    grouped = {}
+    for server in servers:
+        grouped.setdefault(results[server['host']], []).append(server['host'])
+    groups = sorted(grouped.items(), key=lambda item: -len(item[1]))
+    report = format_fleet_report(title, groups, len(servers))
+    if len(report) <= FLEET_REPORT_LIMIT:
+        await notify_job(job, report)
+        return
+    await notify_job(job, report.split("\n", 1)[0] + "\n📎 گزارش کامل در فایل پیوست است.")
+    document = io.BytesIO(report.encode('utf-8'))
+    document.name = f"fleet-{operation}-{job['job_id'][:8]}.txt"
+    try:
+        with trace_span(job, "telegram.send"):
+            await bot.send_document(chat_id=job['chat_id'], document=document)
+    except Exception as e:
+        log_event(logging.WARNING, "job notification failed", job_id=job['job_id'], error=str(e))
+
+JOB_KINDS = {
+    "create": "ساخت تونل",
+    "delete": "حذف تونل",
+    "standby": "افزودن سرور پشتیبان",
+    "fleet": "عملیات گروهی",
+    "forward": "فوروارد پورت",
+    "qos": "تنظیم QoS"
+}
+
+JOB_HANDLERS = {
+    "create": run_create_job,
+    "delete": run_delete_job,
+    "standby": run_standby_job,
+    "fleet": run_fleet_job,
+    "forward": run_forward_job,
+    "qos": run_qos_job
+}
+
+JOB_DEADLINES = {
+    "create": 2400,
+    "delete": 300,
+    "standby": 2400,
+    "fleet": 1800,
+    "forward": 600,
+    "qos": 300
+}
+
+JOB_STATUS_LABELS = {
+    "queued": "⏳ در صف",
+    "running": "▶️ در حال اجرا",
+    "done": "✅ انجام شد",
+    "failed": "❌ ناموفق",
+    "cancelled": "🚫 لغو شد"
+}
+
+JOB_WORKERS = getattr(config, 'JOB_WORKERS', 4)
+JOB_USER_LIMIT = getattr(config, 'JOB_USER_LIMIT', 3)
+JOB_USER_CONCURRENCY = getattr(config, 'JOB_USER_CONCURRENCY', 1)
+JOB_POLL_INTERVAL = 5
+
+JOB_WAKEUP = None
+RUNNING_JOBS = {}
+
+class JobFailed(Exception):
+    pass
+
+CURRENT_SPAN = contextvars.ContextVar('current_span', default=None)
+
+SPAN_LABELS = {
+    "facts": "بررسی مشخصات سرورها",
+    "prerequisites": "نصب پیش‌نیازها",
+    "configure": "پیکربندی و راه‌اندازی سرویس‌ها",
+    "db": "دیتابیس",
+    "crontab": "کرون‌تب",
+    "agent": "نصب ایجنت",
+    "teardown": "حذف تنظیمات سرورها",
+    "forward": "اعمال قوانین فوروارد پورت",
+    "qos": "تنظیم صف ترافیک (QoS)",
+    "telegram.send": "ارسال پیام‌های تلگرام"
+}
+
+def describe_command(command):
+    match = re.search(r'\btee(?:\s+-a)?\s+(\S+)', command)
+    if match:
+        return f"write {match.group(1)}"
+    return redact(' '.join(command.split()))[:60]
+
+def save_span(span):
+    conn = db_connect()
+    c = conn.cursor()
+    c.execute(
+        'INSERT INTO spans (span_id, parent_id, job_id, tunnel_id, name, started_at, duration, status, attributes) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+        (span['span_id'], span['parent_id'], span['job_id'], span['tunnel_id'], span['name'], span['started_at'], span['duration'], span['status'], json.dumps(span['attributes']))
+    )
+    conn.commit()
+    conn.close()
+
+@contextlib.contextmanager
+def trace_span(job, name, **attributes):
+    parent = CURRENT_SPAN.get()
+    span = {
+        'span_id': uuid.uuid4().hex[:16],
+        'parent_id': parent['span_id'] if parent else None,
+        'job_id': job['job_id'],
+        'tunnel_id': job['tunnel_id'],
+        'name': name,
+        'started_at': time.time(),
+        'duration': None,
+        'status': 'ok',
+        'attributes': attributes
+    }
+    started = time.monotonic()
+    token = CURRENT_SPAN.set(span)
+    try:
+        yield span
+    except asyncio.CancelledError:
+        span['status'] = 'cancelled'
+        raise
+    except Exception as e:
+        span['status'] = 'error'
+        span['attributes']['error'] = redact(str(e))[:200]
+        raise
+    finally:
+        CURRENT_SPAN.reset(token)
+        span['duration'] = time.monotonic() - started
+        job.setdefault('spans', []).append(span)
+        try:
+            save_span(span)
+        except sqlite3.Error as e:
+            log_event(logging.WARNING, "span not saved", job_id=job['job_id'], span=name, error=str(e))
+
+def get_tunnel_spans(tunnel_id):
+    conn = db_connect()
+    conn.row_factory = sqlite3.Row
+    c = conn.cursor()
+    c.execute('SELECT * FROM spans WHERE tunnel_id = ? ORDER BY started_at', (tunnel_id,))
+    spans = [dict(span) for span in c.fetchall()]
+    conn.close()
+    for span in spans:
+        span['attributes'] = json.loads(span['attributes'] or '{}')
+    return spans
+
+def format_duration(seconds):
+    if seconds < 1:
+        return f"{seconds * 1000:.0f}ms"
+    if seconds < 60:
+        return f"{seconds:.1f}s"
+    return f"{int(seconds // 60)}m{int(seconds % 60):02d}s"
+
+def format_trace_summary(job):
+    spans = job.get('spans', [])
+    lines = ["⏱ زمان صرف‌شده در هر مرحله:"]
+    for name, title in SPAN_LABELS.items():
+        matching = [span for span in spans if span['name'] == name]
+        if matching:
+            total = sum(span['duration'] for span in matching)
+            count = f" ({len(matching)} پیام)" if name == "telegram.send" else ""
+            lines.append(f"• {title}: {format_duration(total)}{count}")
+    commands = [span for span in spans if 'host' in span['attributes']]
+    if commands:
+        slowest = max(commands, key=lambda span: span['duration'])
+        lines.append(f"🐢 کندترین دستور: {slowest['name']} روی {slowest['attributes']['host']} ({format_duration(slowest['duration'])})")
+    return "\n".join(lines)
+
+async def run_traced_job(job):
+    tunnel_ids = job['payload'].get('tunnel_ids') or ([job['tunnel_id']] if job['tunnel_id'] else [])
+    # tunnel locks before host locks everywhere, so a job on one instance never waits in the opposite order of another
+    async with contextlib.AsyncExitStack() as stack:
+        for tunnel_id in sorted(tunnel_ids):
+            await stack.enter_async_context(tunnel_lock(tunnel_id))
+        with trace_span(job, job['kind']):
+            await JOB_HANDLERS[job['kind']](job)
+
+def create_job(kind, user_id, chat_id, tunnel_id, payload, title):
+    conn = db_connect()
+    c = conn.cursor()
+    if user_id != ADMIN_ID:
+        c.execute("SELECT COUNT(*) FROM jobs WHERE user_id = ? AND status IN ('queued', 'running')", (user_id,))
+        if c.fetchone()[0] >= JOB_USER_LIMIT:
+            conn.close()
+            return None
+    job_id = str(uuid.uuid4())
+    c.execute(
+        'INSERT INTO jobs (job_id, kind, user_id, chat_id, tunnel_id, title, status, progress, payload) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+        (job_id, kind, user_id, chat_id, tunnel_id, title, 'queued', '', json.dumps(payload))
+    )
+    conn.commit()
+    conn.close()
+    return job_id
 
-conn gre6tunnel
-    left={iran_ipv6}
-    leftid=@iran
-    leftsubnet={iran_ipv6}/128
-    right={kharej_ipv6}
-    rightid=@kharej
-    rightsubnet={kharej_ipv6}/128
-    authby=secret
-    auto=start
-    keyexchange=ikev2
-    ike=aes256-sha2_256-modp2048!
-    esp=aes256-sha2_256!
-"""
-    iran_ipsec_secrets_content = f'@iran @kharej : PSK "{psk}"'
+def claim_next_job():
+    conn = db_connect()
+    conn.row_factory = sqlite3.Row
+    c = conn.cursor()
+    # the per-user concurrency check and the claim must be atomic across instances sharing the queue
+    c.execute('BEGIN IMMEDIATE')
+    c.execute('''
+        SELECT * FROM jobs WHERE status = 'queued' AND user_id NOT IN (
+            SELECT user_id FROM jobs WHERE status = 'running' GROUP BY user_id HAVING COUNT(*) >= ?
+        ) ORDER BY created_at, rowid LIMIT 1
+    ''', (JOB_USER_CONCURRENCY,))
+    job = c.fetchone()
+    if job:
+        c.execute("UPDATE jobs SET status = 'running', started_at = CURRENT_TIMESTAMP, instance_id = ? WHERE job_id = ? AND status = 'queued'", (INSTANCE_ID, job['job_id']))
+        if c.rowcount == 0:
+            job = None
+    conn.commit()
+    conn.close()
+    if not job:
+        return None
+    job = dict(job)
+    job['payload'] = json.loads(job['payload'] or '{}')
+    return job
 
-    kharej_rc_local_content = f"""#!/bin/bash
-ip tunnel add 6to4_To_KH mode sit remote {iran_ip} local {kharej_ip}
-ip -6 addr add {kharej_ipv6}/64 dev 6to4_To_KH
-ip link set 6to4_To_KH mtu {mtu_6to4}
-ip link set 6to4_To_KH up
+def finish_job(job_id, status, error=None):
+    conn = db_connect()
+    c = conn.cursor()
+    c.execute('UPDATE jobs SET status = ?, error = ?, payload = NULL, finished_at = CURRENT_TIMESTAMP WHERE job_id = ?', (status, error, job_id))
+    conn.commit()
+    conn.close()
 
-# GRE over IPv6
-ip -6 tunnel add GRE6Tun_To_KH mode ip6gre remote {iran_ipv6} local {kharej_ipv6}
-ip addr add 172.20.40.2/30 dev GRE6Tun_To_KH
-ip link set GRE6Tun_To_KH mtu {mtu_gre}
-ip link set GRE6Tun_To_KH up
+# progress is written by one background thread, in order, so a slow shared database never stalls the loop;
+# a write that can't get the lock in time is dropped, the next one carries newer progress anyway
+JOB_PROGRESS_BUSY_TIMEOUT = 1
+progress_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="progress")
 
-exit 0
-"""
-    kharej_ipsec_conf_content = f"""config setup
-    charondebug="none"
+def write_job_progress(job_id, progress):
+    try:
+        conn = db_connect(JOB_PROGRESS_BUSY_TIMEOUT)
+        try:
+            conn.execute('UPDATE jobs SET progress = ? WHERE job_id = ?', (progress, job_id))
+            conn.commit()
+        finally:
+            conn.close()
+    except sqlite3.Error as e:
+        log_event(logging.DEBUG, "job progress not saved", job_id=job_id, error=str(e))
 
-conn gre6tunnel
-    left={kharej_ipv6}
-    leftid=@kharej
-    leftsubnet={kharej_ipv6}/128
-    right={iran_ipv6}
-    rightid=@iran
-    rightsubnet={iran_ipv6}/128
-    authby=secret
-    auto=start
-    keyexchange=ikev2
-    ike=aes256-sha2_256-modp2048!
-    esp=aes256-sha2_256!
-"""
-    kharej_ipsec_secrets_content = f'@iran @kharej : PSK "{psk}"'
+def set_job_progress(job, progress):
+    job['progress'] = progress
+    progress_executor.submit(write_job_progress, job['job_id'], progress)
 
-    iran_recycle_script_content = f"""#!/bin/bash
-ipsec restart
-ip link set GRE6Tun_To_IR down
-ip link set 6to4_To_IR down
-sleep 1
-ip link set 6to4_To_IR up
-ip link set GRE6Tun_To_IR up
-"""
+def get_job(job_id):
+    conn = db_connect()
+    conn.row_factory = sqlite3.Row
+    c = conn.cursor()
+    c.execute('SELECT job_id, kind, user_id, title, status, progress FROM jobs WHERE job_id = ?', (job_id,))
+    job = c.fetchone()
+    conn.close()
+    return dict(job) if job else None
 
-    kharej_recycle_script_content = f"""#!/bin/bash
-ipsec restart
-ip link set GRE6Tun_To_KH down
-ip link set 6to4_To_KH down
-sleep 1
-ip link set 6to4_To_KH up
-ip link set GRE6Tun_To_KH up
-"""
+def list_active_jobs(role, user_id):
+    conn = db_connect()
+    conn.row_factory = sqlite3.Row
+    c = conn.cursor()
+    if role == 'admin':
+        c.execute("SELECT job_id, kind, user_id, title, status, progress FROM jobs WHERE status IN ('queued', 'running') ORDER BY created_at, rowid")
+    else:
+        c.execute("SELECT job_id, kind, user_id, title, status, progress FROM jobs WHERE user_id = ? AND status IN ('queued', 'running') ORDER BY created_at, rowid", (user_id,))
+    jobs = [dict(job) for job in c.fetchall()]
+    conn.close()
+    return jobs
 
-    iran_commands = [
-        f"echo '{iran_rc_local_content}' | sudo tee /etc/rc.local",
-        "sudo chmod +x /etc/rc.local",
-        "sudo bash /etc/rc.local",
-        f"echo '{iran_ipsec_conf_content}' | sudo tee /etc/ipsec.conf",
-        f"echo '{iran_ipsec_secrets_content}' | sudo tee /etc/ipsec.secrets",
-        "sudo systemctl enable strongswan-starter",
-        "sudo systemctl start strongswan-starter",
-        f"echo '{iran_recycle_script_content}' | sudo tee /usr/local/bin/recycle-gre-ipsec.sh",
-        "sudo chmod +x /usr/local/bin/recycle-gre-ipsec.sh"
-    ]
+def request_job_cancel(job_id, running_here):
+    conn = db_connect()
+    c = conn.cursor()
+    c.execute("UPDATE jobs SET status = 'cancelled', payload = NULL, finished_at = CURRENT_TIMESTAMP WHERE job_id = ? AND status = 'queued'", (job_id,))
+    cancelled = c.rowcount > 0
+    if not cancelled and not running_here:
+        # running on another instance: its heartbeat picks the request up and cancels the task there
+        c.execute("UPDATE jobs SET cancel_requested = 1 WHERE job_id = ? AND status = 'running' AND instance_id != ?", (job_id, INSTANCE_ID))
+        cancelled = c.rowcount > 0
+    conn.commit()
+    conn.close()
+    return cancelled
 
-    for cmd in iran_commands:
-        result = await execute_ssh_command(iran_server_ip, iran_username, iran_password, cmd)
-        if "خطا" in result:
+async def cancel_job(job_id):
+    if await asyncio.get_running_loop().run_in_executor(None, request_job_cancel, job_id, job_id in RUNNING_JOBS):
+        return True
+    task = RUNNING_JOBS.get(job_id)
+    if task:
+        task.cancel()
+        return True
+    return False
+
+async def notify_job(job, text):
+    try:
+        with trace_span(job, "telegram.send"):
             await bot.send_message(
-                chat_id=message.chat.id,
-                text=escape_md(f"❌ خطا در پیکربندی سرور ایران: {result}"),
+                chat_id=job['chat_id'],
+                text=escape_md(text),
                 parse_mode="MarkdownV2"
             )
-            await back_to_main_menu(message, state)
-            return
+    except Exception as e:
+        log_event(logging.WARNING, "job notification failed", job_id=job['job_id'], tunnel_id=job['tunnel_id'], error=str(e))
 
-    kharej_commands = [
-        f"echo '{kharej_rc_local_content}' | sudo tee /etc/rc.local",
-        "sudo chmod +x /etc/rc.local",
-        "sudo bash /etc/rc.local",
-        f"echo '{kharej_ipsec_conf_content}' | sudo tee /etc/ipsec.conf",
-        f"echo '{kharej_ipsec_secrets_content}' | sudo tee /etc/ipsec.secrets",
-        "sudo systemctl enable strongswan-starter",
-        "sudo systemctl start strongswan-starter",
-        f"echo '{kharej_recycle_script_content}' | sudo tee /usr/local/bin/recycle-gre-ipsec.sh",
-        "sudo chmod +x /usr/local/bin/recycle-gre-ipsec.sh"
-    ]
+JOB_PROGRESS_INTERVAL = 2
 
-    for cmd in kharej_commands:
-        result = await execute_ssh_command(kharej_server_ip, kharej_username, kharej_password, cmd)
-        if "خطا" in result:
-            await bot.send_message(
-                chat_id=message.chat.id,
-                text=escape_md(f"❌ خطا در پیکربندی سرور خارج: {result}"),
-                parse_mode="MarkdownV2"
-            )
-            await back_to_main_menu(message, state)
-            return
+async def run_job_commands(job, host, username, password, commands, label, error_prefix):
+    with trace_span(job, f"ssh {host}", label=label):
+        for index, cmd in enumerate(commands, 1):
+            with trace_span(job, describe_command(cmd), host=host):
+                await run_job_command(job, host, username, password, cmd, f"{label} ({index}/{len(commands)})", label, error_prefix)
 
-    await bot.send_message(
-        chat_id=message.chat.id,
-        text=escape_md("✅ تونل با موفقیت نصب شد!"),
-        parse_mode="MarkdownV2"
-    )
-    await bot.send_message(
-        chat_id=message.chat.id,
-        text=escape_md(f"🔗 تونل را برای سرور ایران با آی‌پی زیر پینگ کنید: {kharej_ipv6}"),
-        parse_mode="MarkdownV2"
-    )
-    await bot.send_message(
-        chat_id=message.chat.id,
-        text=escape_md("⏰ لطفاً ساعت را برای ریست تونل وارد کنید (0-23):"),
-        reply_markup=get_back_buttons(),
-        parse_mode="MarkdownV2"
-    )
-    await ServerConfig.CrontabHour.set()
+async def run_job_command(job, host, username, password, cmd, step, label, error_prefix):
+    set_job_progress(job, step)
 
-@dp.message_handler(state=ServerConfig.CrontabHour)
-async def process_crontab_hour(message: types.Message, state: FSMContext):
-    if message.text == "🏠 بازگشت به منوی اصلی":
-        await back_to_main_menu(message, state)
-        return
-    if message.text == "⬅️ بازگشت به مرحله قبل":
-        await bot.send_message(
-            chat_id=message.chat.id,
-            text=escape_md("📏 لطفاً MTU برای تونل GRE را انتخاب کنید:"),
-            reply_markup=get_mtu_gre_selection_keyboard(),
-            parse_mode="MarkdownV2"
-        )
-        await ServerConfig.MTU_GRE.set()
-        return
-    crontab_hour = message.text.strip()
-    if not is_valid_crontab_hour(crontab_hour):
+    def on_line(stream, line):
+        now = time.monotonic()
+        if line.strip() and now - job.get('progress_at', 0) >= JOB_PROGRESS_INTERVAL:
+            job['progress_at'] = now
+            set_job_progress(job, f"{step}: {line.strip()[:80]}")
+
+    result = await stream_ssh_command(host, username, password, cmd, on_line=on_line, deadline=job.get('deadline'), tunnel_id=job['tunnel_id'], step=step)
+    error = result["error"]
+    if not error and result["exit_status"] != 0:
+        error = f"خطا: دستور با کد {result['exit_status']} پایان یافت - میزبان: {host}\n{tail_lines(result['stderr'] or result['stdout'])}"
+    if error:
+        inc("evara_provision_steps", step=label, result="failure")
+        raise JobFailed(f"{error_prefix}: {error}")
+    inc("evara_provision_steps", step=label, result="success")
+
+async def submit_job(chat_id, user_id, kind, tunnel_id, payload, title):
+    job_id = await asyncio.get_running_loop().run_in_executor(None, create_job, kind, user_id, chat_id, tunnel_id, payload, title)
+    if job_id and JOB_WAKEUP:
+        JOB_WAKEUP.set()
+    if not job_id:
         await bot.send_message(
-            chat_id=message.chat.id,
-            text=escape_md("❌ لطفاً یک ساعت معتبر بین 0 تا 23 وارد کنید:"),
-            reply_markup=get_back_buttons(),
+            chat_id=chat_id,
+            text=escape_md(f"⚠️ شما در حال حاضر {JOB_USER_LIMIT} کار فعال دارید. لطفاً تا پایان آن‌ها صبر کنید یا از /jobs یکی را لغو کنید."),
+            reply_markup=get_main_menu_keyboard(),
             parse_mode="MarkdownV2"
         )
-        return
-
-    data = await state.get_data()
-    iran_server_ip = data['iran_server_ip']
-    iran_username = data['iran_username']
-    iran_password = data['iran_password']
-    kharej_server_ip = data['kharej_server_ip']
-    kharej_username = data['kharej_username']
-    kharej_password = data['kharej_password']
-
+        return None
     await bot.send_message(
-        chat_id=message.chat.id,
-        text=escape_md("⏳ لطفاً منتظر بمانید، در حال تنظیم زمان‌بندی ریست تونل هستیم..."),
+        chat_id=chat_id,
+        text=escape_md(f"📥 درخواست «{JOB_KINDS[kind]}» برای '{title}' در صف قرار گرفت.\nنتیجه همین‌جا اطلاع داده می‌شود. برای مشاهده وضعیت از /jobs استفاده کنید."),
+        reply_markup=get_main_menu_keyboard(),
         parse_mode="MarkdownV2"
     )
-    
-    await state.update_data(crontab_hour=crontab_hour)
-    await save_to_db(await state.get_data())
+    return job_id
 
-    crontab_time = f"0 {crontab_hour} * * *"
-    crontab_cmd = f"(crontab -l 2>/dev/null; echo '{crontab_time} /usr/local/bin/recycle-gre-ipsec.sh >/dev/null 2>&1') | crontab -"
+async def job_worker():
+    while True:
+        try:
+            await run_next_job()
+        except Exception as e:
+            # a failed claim or status write (e.g. a locked database) must not end the worker
+            log_event(logging.ERROR, "job worker error", error=str(e))
+            await asyncio.sleep(JOB_POLL_INTERVAL)
 
-    result = await execute_ssh_command(iran_server_ip, iran_username, iran_password, crontab_cmd)
-    if "خطا" in result:
-        await bot.send_message(
-            chat_id=message.chat.id,
-            text=escape_md(f"❌ خطا در تنظیم کرون‌تب برای سرور ایران: {result}"),
-            parse_mode="MarkdownV2"
-        )
-        await back_to_main_menu(message, state)
+async def run_next_job():
+    loop = asyncio.get_running_loop()
+    JOB_WAKEUP.clear()
+    job = await loop.run_in_executor(None, claim_next_job)
+    if not job:
+        # not wait_for: it can swallow the worker's cancellation at shutdown
+        waiter = asyncio.ensure_future(JOB_WAKEUP.wait())
+        try:
+            await asyncio.wait([waiter], timeout=JOB_POLL_INTERVAL)
+        finally:
+            waiter.cancel()
         return
-    
-    result = await execute_ssh_command(kharej_server_ip, kharej_username, kharej_password, crontab_cmd)
-    if "خطا" in result:
-        await bot.send_message(
-            chat_id=message.chat.id,
-            text=escape_md(f"❌ خطا در تنظیم کرون‌تب سرور خارج: {result}"),
-            parse_mode="MarkdownV2"
-        )
-        await back_to_main_menu(message, state)
+    job['deadline'] = time.monotonic() + JOB_DEADLINES[job['kind']]
+    started = time.monotonic()
+    log_event(logging.INFO, "job started", job_id=job['job_id'], kind=job['kind'], tunnel_id=job['tunnel_id'], user_id=job['user_id'])
+    task = asyncio.ensure_future(run_traced_job(job))
+    RUNNING_JOBS[job['job_id']] = task
+    timed_out = False
+    try:
+        done, pending = await asyncio.wait([task], timeout=JOB_DEADLINES[job['kind']])
+        if pending:
+            timed_out = True
+            task.cancel()
+            await asyncio.wait([task])
+    finally:
+        RUNNING_JOBS.pop(job['job_id'], None)
+    if timed_out:
+        await loop.run_in_executor(None, finish_job, job['job_id'], 'failed', 'deadline exceeded')
+        await notify_job(job, f"⌛ «{JOB_KINDS[job['kind']]}» برای '{job['title']}' در مهلت {JOB_DEADLINES[job['kind']] // 60} دقیقه تمام نشد و متوقف شد.")
+    elif task.cancelled():
+        await loop.run_in_executor(None, finish_job, job['job_id'], 'cancelled')
+        await notify_job(job, f"🚫 «{JOB_KINDS[job['kind']]}» برای '{job['title']}' لغو شد.")
+    elif isinstance(task.exception(), JobFailed):
+        await loop.run_in_executor(None, finish_job, job['job_id'], 'failed', str(task.exception()))
+        await notify_job(job, str(task.exception()))
+    elif task.exception():
+        await loop.run_in_executor(None, finish_job, job['job_id'], 'failed', str(task.exception()))
+        await notify_job(job, f"❌ خطای غیرمنتظره در «{JOB_KINDS[job['kind']]}» برای '{job['title']}': {str(task.exception())}")
+    else:
+        await loop.run_in_executor(None, finish_job, job['job_id'], 'done')
+    status = 'failed' if timed_out or (not task.cancelled() and task.exception()) else ('cancelled' if task.cancelled() else 'done')
+    log_event(logging.INFO if status == 'done' else logging.WARNING, "job finished", job_id=job['job_id'], kind=job['kind'], tunnel_id=job['tunnel_id'], status=status, duration=time.monotonic() - started)
+    JOB_WAKEUP.set()
+
+HEARTBEAT_INTERVAL = getattr(config, 'HEARTBEAT_INTERVAL', 5)
+HEARTBEAT_BUSY_TIMEOUT = 5
+IS_LEADER = not CLUSTER_MODE
+
+def heartbeat_transaction(timeout=DB_BUSY_TIMEOUT):
+    now = time.time()
+    conn = db_connect(timeout)
+    c = conn.cursor()
+    c.execute('BEGIN IMMEDIATE')
+    c.execute('INSERT OR IGNORE INTO instances (instance_id, started_at, heartbeat_at) VALUES (?, ?, ?)', (INSTANCE_ID, now, now))
+    c.execute('UPDATE instances SET heartbeat_at = ? WHERE instance_id = ?', (now, INSTANCE_ID))
+    c.executemany('UPDATE leases SET expires_at = ? WHERE name = ? AND owner = ?', [(now + LEASE_TTL, name, INSTANCE_ID) for name in list(HELD_LEASES)])
+    c.execute('DELETE FROM instances WHERE heartbeat_at < ?', (now - LEASE_TTL,))
+    # jobs of an instance that stopped heartbeating are lost with its process; their tunnel and host leases simply expire
+    c.execute('''
+        UPDATE jobs SET status = 'failed', error = 'interrupted', payload = NULL, finished_at = CURRENT_TIMESTAMP
+        WHERE status = 'running' AND (instance_id IS NULL OR instance_id NOT IN (SELECT instance_id FROM instances))
+    ''')
+    reaped = c.rowcount
+    c.execute('DELETE FROM leases WHERE name = ? AND expires_at < ?', ("leader", now))
+    c.execute('INSERT OR IGNORE INTO leases (name, owner, expires_at) VALUES (?, ?, ?)', ("leader", INSTANCE_ID, now + LEASE_TTL))
+    c.execute('UPDATE leases SET expires_at = ? WHERE name = ? AND owner = ?', (now + LEASE_TTL, "leader", INSTANCE_ID))
+    leader = c.rowcount > 0
+    c.execute("SELECT job_id FROM jobs WHERE status = 'running' AND instance_id = ? AND cancel_requested = 1", (INSTANCE_ID,))
+    cancelled = [row[0] for row in c.fetchall()]
+    conn.commit()
+    conn.close()
+    return leader, reaped, cancelled
+
+def apply_heartbeat(leader, reaped, cancelled):
+    global IS_LEADER
+    was_leader, IS_LEADER = IS_LEADER, leader
+    for job_id in cancelled:
+        task = RUNNING_JOBS.get(job_id)
+        if task:
+            task.cancel()
+    if reaped:
+        log_event(logging.WARNING, "jobs of stopped instances marked interrupted", count=reaped)
+    if was_leader and not IS_LEADER:
+        # another instance took over after this one stalled past the lease; stopping polling ends the process and systemd restarts it as a follower
+        log_event(logging.WARNING, "leadership lost", instance=INSTANCE_ID)
+        dp.stop_polling()
+
+def instance_heartbeat_once():
+    apply_heartbeat(*heartbeat_transaction())
+
+async def instance_heartbeat():
+    # the transaction runs in the executor with a busy timeout well below LEASE_TTL: a contended database
+    # costs a skipped beat, not a frozen loop that lets this instance's own leases and leadership expire
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            apply_heartbeat(*await loop.run_in_executor(None, heartbeat_transaction, HEARTBEAT_BUSY_TIMEOUT))
+        except sqlite3.Error as e:
+            log_event(logging.WARNING, "instance heartbeat failed", error=str(e))
+        await asyncio.sleep(HEARTBEAT_INTERVAL)
+
+def leave_cluster():
+    conn = db_connect()
+    c = conn.cursor()
+    c.execute('DELETE FROM leases WHERE owner = ?', (INSTANCE_ID,))
+    c.execute('DELETE FROM instances WHERE instance_id = ?', (INSTANCE_ID,))
+    conn.commit()
+    conn.close()
+    HELD_LEASES.clear()
+
+def start_job_workers():
+    global JOB_WAKEUP
+    JOB_WAKEUP = asyncio.Event()
+    if CLUSTER_MODE:
+        # other instances may be running jobs right now; only jobs of instances that stopped heartbeating are reset
+        instance_heartbeat_once()
+        asyncio.ensure_future(instance_heartbeat())
+    else:
+        conn = db_connect()
+        c = conn.cursor()
+        c.execute("UPDATE jobs SET status = 'failed', error = 'interrupted', payload = NULL, finished_at = CURRENT_TIMESTAMP WHERE status = 'running'")
+        conn.commit()
+        conn.close()
+    for _ in range(JOB_WORKERS):
+        asyncio.ensure_future(job_worker())
+
+SSH_CONNECT_TIMEOUT = getattr(config, 'SSH_CONNECT_TIMEOUT', 10)
+SSH_PORT = getattr(config, 'SSH_PORT', 22)
+
+COMMAND_TIMEOUTS = {
+    "short": 15,
+    "default": 60,
+    "install": 900
+}
+
+def command_timeout(command):
+    if re.search(r'\b(apt|apt-get|dpkg)\b', command):
+        return COMMAND_TIMEOUTS["install"]
+    if re.match(r'^(sudo )?(ip|modprobe|lsmod|chmod|rm|ping|crontab|systemctl)\b', command) or command.startswith("(crontab"):
+        return COMMAND_TIMEOUTS["short"]
+    return COMMAND_TIMEOUTS["default"]
+
+def test_ssh_connection(host, username, password):
+    ssh = paramiko.SSHClient()
+    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    try:
+        ssh.connect(host, port=SSH_PORT, username=username, password=password, timeout=SSH_CONNECT_TIMEOUT, banner_timeout=SSH_CONNECT_TIMEOUT, auth_timeout=SSH_CONNECT_TIMEOUT)
+    finally:
+        ssh.close()
+
+def open_sftp(host, username, password):
+    ssh = paramiko.SSHClient()
+    ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    ssh.connect(host, port=SSH_PORT, username=username, password=password, timeout=SSH_CONNECT_TIMEOUT, banner_timeout=SSH_CONNECT_TIMEOUT, auth_timeout=SSH_CONNECT_TIMEOUT)
+    sftp = ssh.open_sftp()
+    sftp.get_channel().settimeout(COMMAND_TIMEOUTS["install"])
+    return ssh, sftp
+
+def sftp_put_files(host, username, password, files, remote_dir):
+    ssh, sftp = open_sftp(host, username, password)
+    track_ssh_connection(1)
+    try:
+        try:
+            sftp.mkdir(remote_dir, 0o700)
+        except IOError:
+            pass
+        for path in files:
+            sftp.put(path, f"{remote_dir}/{os.path.basename(path)}")
+    finally:
+        sftp.close()
+        ssh.close()
+        track_ssh_connection(-1)
+
+def sftp_get_files(host, username, password, remote_dir, local_dir, suffix):
+    ssh, sftp = open_sftp(host, username, password)
+    track_ssh_connection(1)
+    try:
+        names = [name for name in sftp.listdir(remote_dir) if name.endswith(suffix)]
+        for name in names:
+            sftp.get(f"{remote_dir}/{name}", os.path.join(local_dir, name))
+        return names
+    finally:
+        sftp.close()
+        ssh.close()
+        track_ssh_connection(-1)
+
+REMOTE_PID_MARKER = "__EVARA_PID__"
+REMOTE_KILL_GRACE = 5
+# signalling the user-owned shell succeeds even when root-owned children (sudo apt ...) would ignore a plain kill,
+# so the signal goes through sudo whenever it can, and survivors of the grace period get SIGKILL
+REMOTE_KILL_SCRIPT = (
+    "k=kill; sudo -n true 2>/dev/null && k='sudo -n kill'; "
+    "$k -TERM -- -{pid} 2>/dev/null; "
+    "for i in $(seq {grace}); do $k -0 -- -{pid} 2>/dev/null || exit 0; sleep 1; done; "
+    "$k -KILL -- -{pid} 2>/dev/null"
+)
+
+def kill_remote_command(ssh, pid):
+    if not pid:
         return
+    try:
+        stdin, stdout, stderr = ssh.exec_command(REMOTE_KILL_SCRIPT.format(pid=pid, grace=REMOTE_KILL_GRACE), timeout=REMOTE_KILL_GRACE + 5)
+        stdout.channel.status_event.wait(REMOTE_KILL_GRACE + 5)
+    except Exception as e:
+        log_event(logging.WARNING, "remote kill failed", pid=pid, error=str(e))
 
-    await bot.send_message(
-        chat_id=message.chat.id,
-        text=escape_md("✅ تنظیم ریست تونل برای هر دو سرور با موفقیت انجام شد!"),
-        parse_mode="MarkdownV2"
-    )
-    await bot.send_message(
-        chat_id=message.chat.id,
-        text=escape_md("🎉 نصب تونل با موفقیت به پایان رسید!"),
-        reply_markup=types.ReplyKeyboardRemove(),
-        parse_mode="MarkdownV2"
-    )
-    await bot.send_message(
-        chat_id=message.chat.id,
-        text=escape_md("‼️ نکته: برای دایرکت تونل باید داخل سرور ایران آی‌پی 172.20.40.2 را استفاده کنید.\n✅ پیشنهاد ما استفاده از این ابزار است\n📌 [ابزار IPTABLE-Tunnel](https://github.com/azavaxhuman/IPTABLE-Tunnel-multi-port)"),
-        parse_mode="MarkdownV2"
-    )
-    await bot.send_message(
-        chat_id=message.chat.id,
-        text=escape_md("🌟 حالا می‌توانید وضعیت تونل را از منوی اصلی بررسی کنید یا تونل جدیدی ایجاد کنید!"),
-        parse_mode="MarkdownV2"
-    )
-    await state.finish()
-    await bot.send_message(
-        chat_id=message.chat.id,
-        text=escape_md("🏠 به منوی اصلی بازگشتید! لطفاً یک گزینه را انتخاب کنید."),
-        reply_markup=get_main_menu_keyboard(),
-        parse_mode="MarkdownV2"
-    )
-    await ServerConfig.MainMenu.set()
+SSH_OUTPUT_TAIL_LINES = 200
+# commands hold a thread for as long as they run; keeping them off the default executor leaves that one free
+# for the wizard's connection tests and the database calls
+SSH_WORKERS = getattr(config, 'SSH_WORKERS', 32)
+ssh_executor = concurrent.futures.ThreadPoolExecutor(max_workers=SSH_WORKERS, thread_name_prefix="ssh")
+SSH_LINE_MAX = 2000
+SSH_STREAM_QUEUE = 256
 
-async def execute_ssh_command(host: str, username: str, password: str, command: str) -> str:
+def pump_ssh_command(host, username, password, command, timeout, cancel_event, emit=None, log_fields=None):
+    result = {"exit_status": None, "stdout": "", "stderr": "", "error": None, "lines": 0}
+    tails = {"stdout": deque(maxlen=SSH_OUTPUT_TAIL_LINES), "stderr": deque(maxlen=SSH_OUTPUT_TAIL_LINES)}
+    partial = {"stdout": b"", "stderr": b""}
+    remote = {"pid": None}
+
+    def feed(stream, data, final=False):
+        lines = (partial[stream] + data).split(b"\n")
+        partial[stream] = b"" if final else lines.pop()
+        if len(partial[stream]) > SSH_LINE_MAX:
+            lines.append(partial[stream])
+            partial[stream] = b""
+        for raw in lines:
+            if final and not raw:
+                continue
+            line = raw.rstrip(b"\r").decode('utf-8', 'replace')[:SSH_LINE_MAX]
+            if stream == "stdout" and remote["pid"] is None and line.startswith(REMOTE_PID_MARKER):
+                remote["pid"] = line[len(REMOTE_PID_MARKER):].strip()
+                continue
+            tails[stream].append(line)
+            result["lines"] += 1
+            if emit:
+                emit(stream, line)
+
+    log_fields = dict(log_fields or {}, host=host)
+    started = time.monotonic()
     ssh = None
     try:
-        print(f"اتصال SSH به {host} برای اجرای دستور: {command}")
+        log_event(logging.DEBUG, "ssh command", command=command[:200], **log_fields)
         ssh = paramiko.SSHClient()
         ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
-        ssh.connect(host, username=username, password=password, timeout=30)
-        print(f"اتصال SSH به {host} برقرار شد")
-        stdin, stdout, stderr = ssh.exec_command(command, timeout=40)
-        output = stdout.read().decode('utf-8')
-        error = stderr.read().decode('utf-8')
-        print(f"خروجی دستور {command}: {output}")
-        if error and "Permission denied" in error:
-            print(f"خطا در دسترسی: {error}")
-            return f"خطا: دسترسی غیرمجاز برای اجرای دستور {command}"
-        return output if output else error
+        ssh.connect(host, port=SSH_PORT, username=username, password=password, timeout=min(SSH_CONNECT_TIMEOUT, timeout), banner_timeout=SSH_CONNECT_TIMEOUT, auth_timeout=SSH_CONNECT_TIMEOUT)
+        track_ssh_connection(1)
+        log_fields['connect'] = time.monotonic() - started
+        observe("evara_ssh_connect_seconds", log_fields['connect'])
+        expires = time.monotonic() + timeout
+        channel = ssh.get_transport().open_session()
+        # sshd makes the remote shell a session leader, so its pid is also the process group to kill on cancel
+        channel.exec_command(f"echo {REMOTE_PID_MARKER}$$; {command}")
+        while True:
+            if cancel_event.is_set() or time.monotonic() >= expires:
+                kill_remote_command(ssh, remote["pid"])
+                channel.close()
+                if cancel_event.is_set():
+                    result["error"] = f"خطا: اجرای دستور لغو شد - میزبان: {host}, دستور: {command}"
+                else:
+                    result["error"] = f"خطا: اجرای دستور بیش از {int(timeout)} ثانیه طول کشید - میزبان: {host}, دستور: {command}"
+                break
+            if channel.recv_ready():
+                feed("stdout", channel.recv(32768))
+            elif channel.recv_stderr_ready():
+                feed("stderr", channel.recv_stderr(32768))
+            elif channel.exit_status_ready() and channel.eof_received:
+                feed("stdout", b"", final=True)
+                feed("stderr", b"", final=True)
+                result["exit_status"] = channel.recv_exit_status()
+                break
+            else:
+                cancel_event.wait(0.05)
     except Exception as e:
-        error_msg = f"خطا: {str(e)} - میزبان: {host}, دستور: {command}"
-        print(error_msg)
-        return error_msg
+        result["error"] = f"خطا: {str(e)} - میزبان: {host}, دستور: {command}"
     finally:
         if ssh:
+            if 'connect' in log_fields:
+                track_ssh_connection(-1)
             ssh.close()
-            print(f"اتصال SSH به {host} بسته شد")
+    if 'connect' in log_fields:
+        observe("evara_ssh_command_seconds", time.monotonic() - started - log_fields['connect'], program=command_program(command))
+    log_event(
+        logging.WARNING if result["error"] else logging.INFO,
+        "ssh command failed" if result["error"] else "ssh command finished",
+        duration=time.monotonic() - started,
+        exit_status=result["exit_status"],
+        lines=result["lines"],
+        error=result["error"] and result["error"].split(" - ")[0],
+        **log_fields
+    )
+    result["stdout"] = "\n".join(tails["stdout"])
+    result["stderr"] = "\n".join(tails["stderr"])
+    return result
+
+async def stream_ssh_command(host: str, username: str, password: str, command: str, on_line=None, timeout: float = None, deadline: float = None, tunnel_id: str = None, step: str = None) -> dict:
+    timeout = timeout or command_timeout(command)
+    if deadline is not None:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return {"exit_status": None, "stdout": "", "stderr": "", "lines": 0, "error": f"خطا: مهلت کلی عملیات به پایان رسید - میزبان: {host}, دستور: {command}"}
+        timeout = min(timeout, remaining)
+    loop = asyncio.get_running_loop()
+    cancel_event = threading.Event()
+    queue = asyncio.Queue(maxsize=SSH_STREAM_QUEUE)
+
+    def emit(stream, line):
+        future = asyncio.run_coroutine_threadsafe(queue.put((stream, line)), loop)
+        while not cancel_event.is_set():
+            try:
+                future.result(0.5)
+                return
+            except concurrent.futures.TimeoutError:
+                continue
+        future.cancel()
+
+    register_secret(password)
+    log_fields = {"tunnel_id": tunnel_id, "step": step}
+    future = loop.run_in_executor(ssh_executor, pump_ssh_command, host, username, password, command, timeout, cancel_event, emit if on_line else None, log_fields)
+    try:
+        while on_line and not (future.done() and queue.empty()):
+            getter = asyncio.ensure_future(queue.get())
+            await asyncio.wait([getter, future], return_when=asyncio.FIRST_COMPLETED)
+            if not getter.done():
+                getter.cancel()
+                continue
+            stream, line = getter.result()
+            callback_result = on_line(stream, line)
+            if asyncio.iscoroutine(callback_result):
+                await callback_result
+        return await future
+    except asyncio.CancelledError:
+        cancel_event.set()
+        raise
+
+async def execute_ssh_command(host: str, username: str, password: str, command: str, timeout: float = None, deadline: float = None, on_line=None, tunnel_id: str = None, step: str = None) -> str:
+    result = await stream_ssh_command(host, username, password, command, on_line=on_line, timeout=timeout, deadline=deadline, tunnel_id=tunnel_id, step=step)
+    if result["error"]:
+        return result["error"]
+    if result["stderr"] and "Permission denied" in result["stderr"]:
+        log_event(logging.WARNING, "ssh permission denied", host=host, tunnel_id=tunnel_id, step=step, stderr=tail_lines(result['stderr'], 5))
+        return f"خطا: دسترسی غیرمجاز برای اجرای دستور {command}"
+    return result["stdout"] if result["stdout"] else result["stderr"]
+
+def tail_lines(text, count=20, max_chars=1500):
+    return "\n".join(text.splitlines()[-count:])[-max_chars:]
+
+WEBHOOK_URL = getattr(config, 'WEBHOOK_URL', None)
+WEBHOOK_PATH = getattr(config, 'WEBHOOK_PATH', f"/webhook/{hashlib.sha256(API_TOKEN.encode()).hexdigest()[:32]}")
+WEBHOOK_HOST = getattr(config, 'WEBHOOK_HOST', '127.0.0.1')
+WEBHOOK_PORT = getattr(config, 'WEBHOOK_PORT', 8443)
+
+async def start_webhook_server():
+    runner = web.AppRunner(get_new_configured_app(dp, WEBHOOK_PATH))
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    await bot.set_webhook(WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH)
+    log_event(logging.INFO, "webhook endpoint started", host=WEBHOOK_HOST, port=WEBHOOK_PORT, instance=INSTANCE_ID)
+    return runner
 
 async def main():
+    start_job_workers()
+    if TRAFFIC_INTERVAL:
+        asyncio.ensure_future(traffic_collector())
+    if FAILOVER_INTERVAL:
+        asyncio.ensure_future(failover_monitor())
+    metrics_runner = await start_metrics_server()
+    webhook_runner = None
     try:
-        await dp.start_polling()
+        if WEBHOOK_URL:
+            # behind a load balancer every instance handles updates
+            webhook_runner = await start_webhook_server()
+            await asyncio.Event().wait()
+        else:
+            # Telegram allows one getUpdates consumer per token, so only the leader polls; the rest run jobs until it is gone
+            while not IS_LEADER:
+                await asyncio.sleep(HEARTBEAT_INTERVAL)
+            await dp.start_polling()
     except KeyboardInterrupt:
         pass
     finally:
+        if webhook_runner:
+            await webhook_runner.cleanup()
+        if CLUSTER_MODE:
+            leave_cluster()
         await dp.storage.close()
         await dp.storage.wait_closed()
         await bot.session.close()
+        if AGENT_SESSION:
+            await AGENT_SESSION.close()
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        log_listener.stop()
 
 if __name__ == '__main__':
     asyncio.run(main())
\ No newline at end of file